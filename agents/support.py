@@ -1,23 +1,63 @@
 import random
-from typing import Optional, Type, Union, List
+import re
+from typing import Callable, Optional, Type, Union, List, TYPE_CHECKING
 
-from langchain.chains import LLMChain
-from langchain.chat_models import ChatOpenAI
-from langchain.prompts import PromptTemplate
 from langchain.tools import Tool
 from pydantic import BaseModel, Field
 
+from cache.response_cache import ResponseCache
 from data.chat import MessageHistory, Role
-from data.graph import MessageOutput
+from data.graph import ConversationState, MessageOutput
 from data.validation import UserProfile, PhoneCallRequest, PhoneCallTicket
 from graph.chain_based_edge import ZeroShotChainBasedEdge
 from graph.chain_based_node import MultiRetrievalNode, MultifunctionNode
 from graph.node import BaseNode, BaseEdge, NodeInput
+from graph.pre_extractor import PreExtractor, RegexExtractor, RuleExtractor
+from graph.router import KeywordDomainClassifier
+from graph.shared import shared
 from graph.static_text_node import StaticTextNode
 from graph.text_based_edge import PydanticTextBasedEdge
-from tools.audio_transcribe import call_customer
-from tools.rag_responder import HelpCenterAgent
-from tools.user_info_db import search_user_info_on_db, search_user_subscription_on_db
+from tools.user_info_db import find_user_profile, search_user_profile_on_db
+
+if TYPE_CHECKING:
+    from tools.rag_responder import HelpCenterAgent
+
+EMAIL_PATTERN = re.compile(r"[\w.+-]+@[\w-]+(?:\.[\w-]+)+")
+# the format the GreetingNode asks for
+PHONE_PATTERN = re.compile(r"\b\d{3}-\d{3}-\d{4}\b")
+
+
+def lookup_user(message: str) -> Optional[UserProfile]:
+    """Profile of the user identified by the email or phone number of the
+    message, None lets the agent try"""
+    email = EMAIL_PATTERN.search(message)
+    phone = PHONE_PATTERN.search(message)
+    if email is None and phone is None:
+        return None
+    return find_user_profile(
+        email=email.group(0) if email is not None else None,
+        phone=phone.group(0) if phone is not None else None,
+    )
+
+
+# answers to the GreetingNode resolved without the user info agent
+USER_LOOKUP_EXTRACTORS: List[PreExtractor] = [RuleExtractor(lookup_user)]
+
+# explicit call requests with a phone number, in either order, messages with
+# a negation are left to the llm
+NEGATION = r"^(?!.*\b(?:not|no|never|don'?t|won'?t)\b)"
+CALL_REQUEST_EXTRACTORS: List[PreExtractor] = [
+    RegexExtractor(
+        NEGATION + r".*?\b(?:call|ring)\b.*?(?P<phone_number>\b\d{3}-\d{3}-\d{4})\b",
+        PhoneCallRequest,
+        flags=re.IGNORECASE | re.DOTALL,
+    ),
+    RegexExtractor(
+        NEGATION + r".*?(?P<phone_number>\b\d{3}-\d{3}-\d{4})\b.*?\b(?:call|ring)\b",
+        PhoneCallRequest,
+        flags=re.IGNORECASE | re.DOTALL,
+    ),
+]
 
 
 class GreetingNode(BaseNode[str]):
@@ -30,23 +70,25 @@ class GreetingNode(BaseNode[str]):
         "\nPlease provide a full email address or phone number(in the format xxx-xxx-xxxx)"
     ]
 
-    def greeting_message(self) -> Optional[MessageOutput]:
+    def greeting_message(self, state: ConversationState) -> Optional[MessageOutput]:
         prompt = random.choice(self.STATIC_PROMPT)
         return MessageOutput(prompt, role=Role.ASSISTANT)
 
-    def no_edges_found(self, **kwargs) -> Optional[MessageOutput]:
+    def no_edges_found(
+        self, user_input: str, state: ConversationState
+    ) -> Optional[MessageOutput]:
         prompt = random.choice(self.RETRY_PROMPT)
         return MessageOutput(prompt, role=Role.ASSISTANT)
 
 
 class UserInfoChainBasedEdge(ZeroShotChainBasedEdge):
     _prompt_prefix = """Your goal is to find out the user information and their subscription type.
-- You MUST ALWAYS combine the output of different tools to achieve your final answer.
+- The user profile tool returns the user information and the subscription in one call.
 - The user subscription must be either free or premium, never empty
 
 To achieve this you have access to the following tools:"""
 
-    _prompt_suffix = """\nYour final answer should combine the information of previous Observations 
+    _prompt_suffix = """\nYour final answer should be the user profile of the previous Observation 
 {format_instructions}
 Begin! 
 Question: {input}
@@ -56,14 +98,10 @@ Question: {input}
     def _get_tools(self):
         tools = [
             Tool.from_function(
-                func=search_user_info_on_db,
-                description="Database tool to search user information, input should be their email as text",
-                name="user_info_db_search",
-            ),
-            Tool.from_function(
-                func=search_user_subscription_on_db,
-                description="Database tool to search user subscription type by user id, requires a number as input,",
-                name="user_subscription_db_search",
+                func=search_user_profile_on_db,
+                description="Database tool to search the user information and subscription type, "
+                "input should be their email, phone number or user id as text",
+                name="user_profile_db_search",
             ),
         ]
         return tools
@@ -81,58 +119,141 @@ class AuthenticatedUserNode(MultiRetrievalNode):
         "Hi, {user_name} I am your Shopify Agent for today, you have the {subscription} subscription "
         "I can help you with any Help or you can ask me to call you at anytime!"
     ]
+    PREMIUM_KNOWLEDGE_BASE = "Premium Subscription Knowledge Base"
+    FREE_KNOWLEDGE_BASE = "Free Subscription Knowledge Base"
 
     def __init__(
         self,
         llm_model,
         pydantic_object: Optional[Type[BaseNode]],
         edges: List[BaseEdge] = None,
+        concurrent_edges=False,
+        response_cache: Optional[ResponseCache] = None,
+        deterministic_routing=False,
+        help_center_agent: Union[
+            "HelpCenterAgent", Callable[[], "HelpCenterAgent"], None
+        ] = None,
+        speculative_fallback=False,
     ):
-        self._hc_agent = HelpCenterAgent()
-        super().__init__(llm_model, pydantic_object, edges)
+        """
+        help_center_agent (HelpCenterAgent): answers the questions, or a
+            function building it, called the first time the node needs it
+        speculative_fallback (bool): answer the question while the call
+            request edge is checked, most turns are questions
+        """
+        self._hc_agent = help_center_agent
+        super().__init__(
+            llm_model,
+            pydantic_object,
+            edges,
+            concurrent_edges=concurrent_edges,
+            response_cache=response_cache,
+            deterministic_routing=deterministic_routing,
+            speculative_fallback=speculative_fallback,
+        )
+
+    def _help_center_agent(self) -> "HelpCenterAgent":
+        from tools.rag_responder import HelpCenterAgent
+
+        if self._hc_agent is None:
+            self._hc_agent = shared(HelpCenterAgent, HelpCenterAgent)
+        elif not isinstance(self._hc_agent, HelpCenterAgent):
+            self._hc_agent = self._hc_agent()
+        return self._hc_agent
+
+    def _init_chain(self, *kwargs):
+        from tools.rag_responder import HelpCenterAgent
+
+        if self._deterministic_routing:
+            self._domain_classifier = shared(
+                KeywordDomainClassifier,
+                lambda: KeywordDomainClassifier.from_directories(
+                    [
+                        HelpCenterAgent.FREE_SUB_DOC_PATH,
+                        HelpCenterAgent.PREMIUM_SUB_DOC_PATH,
+                    ]
+                ),
+            )
+        super()._init_chain()
 
-    def greeting_message(self) -> Optional[MessageOutput]:
+    def greeting_message(self, state: ConversationState) -> Optional[MessageOutput]:
         prompt = random.choice(self.STATIC_PROMPT)
-        user_profile: UserProfile = self._node_input
+        user_profile: UserProfile = self.node_input(state)
 
         prompt = prompt.format(
             user_name=user_profile.name, subscription=user_profile.subscription
         )
         return MessageOutput(prompt, role=Role.ASSISTANT)
 
+    def _route(self, state: ConversationState) -> Optional[str]:
+        user_profile: UserProfile = self.node_input(state)
+        if user_profile.subscription.lower() == "free":
+            return self.FREE_KNOWLEDGE_BASE
+        return self.PREMIUM_KNOWLEDGE_BASE
+
+    def _retrievers_key(self):
+        # the agent is shared by the pipelines with the same embeddings and
+        # persist root, and so is the chain
+        return id(self._help_center_agent())
+
     def _get_retriever_infos(self):
         retriever_infos = [
             {
-                "name": "Premium Subscription Knowledge Base",
+                "name": self.PREMIUM_KNOWLEDGE_BASE,
                 "description": "Contains information for user with a premium subscription",
-                "retriever": self._hc_agent.paid_sub_retriever(),
+                "retriever": self._help_center_agent().paid_sub_retriever(),
             },
             {
-                "name": "Free Subscription Knowledge Base",
+                "name": self.FREE_KNOWLEDGE_BASE,
                 "description": "Contains information for user with a free subscription",
-                "retriever": self._hc_agent.free_sub_retriever(),
+                "retriever": self._help_center_agent().free_sub_retriever(),
             },
         ]
         return retriever_infos
 
     def _get_default_chain(self):
+        from langchain.prompts import PromptTemplate
+
+        from graph.cached_chain import CachedLLMChain
+
         template = """You are a helpful assistant, you should tell the user that his query is outside of your domain 
     in a friendly way"
     Human: """
 
         prompt_template = PromptTemplate.from_template(template)
-        chain = LLMChain(
+        chain = CachedLLMChain(
             llm=self._llm_model, prompt=prompt_template, output_key="result"
         )
         return chain
 
-    def no_edges_found(self, user_input: MessageHistory) -> Optional[MessageOutput]:
-        message = self._predict(user_input)
+    def _cache_namespace(self, state: ConversationState) -> str:
+        # premium and free users are answered from different knowledge bases
+        user_profile: UserProfile = self.node_input(state)
+        return user_profile.subscription.lower()
+
+    def no_edges_found(
+        self, user_input: MessageHistory, state: ConversationState
+    ) -> Optional[MessageOutput]:
+        message = self._answer(user_input, state)
+        return MessageOutput(message=message, role=Role.ASSISTANT)
+
+    async def ano_edges_found(
+        self, user_input: MessageHistory, state: ConversationState
+    ) -> Optional[MessageOutput]:
+        message = await self._aanswer(user_input, state)
         return MessageOutput(message=message, role=Role.ASSISTANT)
 
 
 class CallCustomerEdge(PydanticTextBasedEdge):
-    def __init__(self, llm_model, max_retries: int = 3, out_node: BaseNode = None):
+    def __init__(
+        self,
+        llm_model,
+        max_retries: int = 3,
+        out_node: BaseNode = None,
+        priority: int = 0,
+        combined: bool = False,
+        pre_extractors: Optional[List[PreExtractor]] = None,
+    ):
         super().__init__(
             condition="Is there any pending call requests coming from the user?",
             parse_prompt="Extract the phone number from the user message",
@@ -140,6 +261,9 @@ class CallCustomerEdge(PydanticTextBasedEdge):
             llm_model=llm_model,
             max_retries=max_retries,
             out_node=out_node,
+            priority=priority,
+            combined=combined,
+            pre_extractors=pre_extractors,
         )
 
     def _get_message_output(
@@ -163,12 +287,25 @@ class CallCustomerEdge(PydanticTextBasedEdge):
 
 
 class CallCustomerNode(MultifunctionNode):
-    def greeting_message(self) -> Optional[MessageOutput]:
+    def _call_request(self, state: ConversationState) -> MessageHistory:
+        phone_call: PhoneCallRequest = self.node_input(state)
         message_history = MessageHistory(messages=[])
         message_history.add_user_message(
-            content=f"Call user on his phone number: {self._node_input.phone_number}"
+            content=f"Call user on his phone number: {phone_call.phone_number}"
         )
-        completion = self._predict(message_history)
+        return message_history
+
+    def greeting_message(self, state: ConversationState) -> Optional[MessageOutput]:
+        completion = self._predict(self._call_request(state))
+        return self._ticket_message(completion)
+
+    async def agreeting_message(
+        self, state: ConversationState
+    ) -> Optional[MessageOutput]:
+        completion = await self._apredict(self._call_request(state))
+        return self._ticket_message(completion)
+
+    def _ticket_message(self, completion: str) -> Optional[MessageOutput]:
         if self._output_parser is not None:
             ticket_request: PhoneCallTicket = self._output_parser.parse(completion)
             return MessageOutput(
@@ -180,10 +317,15 @@ class CallCustomerNode(MultifunctionNode):
             )
         return None
 
-    def no_edges_found(self, user_input: NodeInput) -> Optional[MessageOutput]:
+    def no_edges_found(
+        self, user_input: NodeInput, state: ConversationState
+    ) -> Optional[MessageOutput]:
         return None
 
     def _get_tools(self):
+        # whisper is only imported once a call is requested
+        from tools.audio_transcribe import call_customer
+
         tools = [
             Tool.from_function(
                 func=call_customer,
@@ -0,0 +1,418 @@
+"""Batch runner of recorded conversations
+
+Reads conversations from a JSONL file, one per line, the user turns in order
+and optionally the earlier messages the conversation carries over:
+
+    {"id": "c1", "turns": ["rafaelpossas@gmail.com", "Please call me"]}
+
+Replays them through CustomerSupportPipeline on a pool of workers, starting
+with the greeting, and writes one JSON line per turn, with the assistant
+messages and the node transition, and one per finished conversation. The
+output is also the checkpoint, the lines of a conversation are written
+together once it is finished, so an interrupted run continues with --resume
+and only replays the conversations the output does not have.
+
+    python -m batch.runner transcripts.jsonl --output results.jsonl --workers 8
+    python -m batch.runner benchmarks/data/conversations.jsonl --output out.jsonl \\
+        --stub-llm --llm-latency-ms 200 --fake-embeddings --repeat 100 --async
+"""
+import argparse
+import asyncio
+import dataclasses
+import json
+import os
+import threading
+import time
+from typing import Awaitable, Callable, Iterable, Iterator, List, Optional, Set, Tuple
+
+from customer_support import CustomerSupportPipeline
+from data.graph import MessageOutput
+
+
+@dataclasses.dataclass
+class Conversation:
+    conversation_id: str
+    # user inputs, the greeting turn is not part of them
+    turns: List[str]
+    # earlier messages the conversation carries over
+    messages: List[dict] = dataclasses.field(default_factory=list)
+
+
+@dataclasses.dataclass
+class BatchStats:
+    conversations: int = 0
+    turns: int = 0
+    # conversations that raised, their turns up to the error are written
+    failed: int = 0
+    # conversations of the output the run skipped
+    resumed: int = 0
+    seconds: float = 0.0
+
+    @property
+    def conversations_per_second(self) -> float:
+        return self.conversations / self.seconds if self.seconds else 0.0
+
+    @property
+    def turns_per_second(self) -> float:
+        return self.turns / self.seconds if self.seconds else 0.0
+
+
+def read_conversations(path: str, repeat: int = 1) -> Iterator[Conversation]:
+    """Conversations of the JSONL file, read lazily, the file is read `repeat`
+    times and the ids of the copies get a #n suffix"""
+    for copy in range(repeat):
+        with open(path) as f:
+            for number, line in enumerate(f, start=1):
+                if not line.strip():
+                    continue
+                data = json.loads(line)
+                conversation_id = str(data.get("id", number))
+                if repeat > 1:
+                    conversation_id = f"{conversation_id}#{copy}"
+                yield Conversation(
+                    conversation_id=conversation_id,
+                    turns=list(data["turns"]),
+                    messages=list(data.get("messages", [])),
+                )
+
+
+class CheckpointedOutput:
+
+    """JSONL output of the runner, it is also the checkpoint, a conversation
+    is done once its `conversation` line is in the file"""
+
+    def __init__(self, path: str, resume: bool = False):
+        """
+        path (str): the output file
+        resume (bool): keep the conversations the file has and append, the
+            lines of a conversation cut short by a crash are dropped
+        """
+        self.done: Set[str] = set()
+        if resume and os.path.exists(path):
+            self.done = self._recover(path)
+            self._file = open(path, "a")
+        else:
+            self._file = open(path, "w")
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _recover(path: str) -> Set[str]:
+        done = set()
+        end = 0
+        with open(path, "rb+") as f:
+            offset = 0
+            for line in f:
+                offset += len(line)
+                if not line.endswith(b"\n"):
+                    break
+                record = json.loads(line)
+                if record.get("type") == "conversation":
+                    done.add(record["conversation_id"])
+                    end = offset
+            f.truncate(end)
+        return done
+
+    def write(self, records: List[dict]):
+        """Writes the lines of a finished conversation at once"""
+        lines = "".join(json.dumps(record) + "\n" for record in records)
+        with self._lock:
+            self._file.write(lines)
+            self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self) -> "CheckpointedOutput":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class _Replay:
+
+    """Records of one conversation as it is replayed"""
+
+    def __init__(self, conversation: Conversation):
+        self.conversation = conversation
+        self.records: List[dict] = []
+        self.is_over = False
+        self.error: Optional[str] = None
+        self._start = time.perf_counter()
+
+    def inputs(self) -> List[Optional[str]]:
+        return [None] + self.conversation.turns
+
+    def turn(
+        self,
+        user_input: Optional[str],
+        from_node: Optional[str],
+        to_node: Optional[str],
+        output: Tuple[List[MessageOutput], bool],
+        seconds: float,
+    ):
+        assistant_output, self.is_over = output
+        self.records.append(
+            {
+                "type": "turn",
+                "conversation_id": self.conversation.conversation_id,
+                "turn": len(self.records),
+                "user_input": user_input,
+                "from_node": from_node,
+                "to_node": to_node,
+                "messages": [
+                    {"role": str(message.role), "content": message.message}
+                    for message in assistant_output
+                ],
+                "is_over": self.is_over,
+                "latency_ms": round(seconds * 1000, 3),
+            }
+        )
+
+    def fail(self, error: Exception):
+        self.error = f"{type(error).__name__}: {error}"
+
+    def finish(self, final_node: Optional[str]) -> List[dict]:
+        return self.records + [
+            {
+                "type": "conversation",
+                "conversation_id": self.conversation.conversation_id,
+                "turns": len(self.records),
+                # user turns left after the conversation was over or failed
+                "skipped_turns": len(self.inputs()) - len(self.records),
+                "final_node": final_node,
+                "is_over": self.is_over,
+                "error": self.error,
+                "seconds": round(time.perf_counter() - self._start, 3),
+            }
+        ]
+
+
+def replay(
+    pipeline: CustomerSupportPipeline, conversation: Conversation
+) -> List[dict]:
+    """Runs the greeting and the turns of the conversation until it is over"""
+    replay_ = _Replay(conversation)
+    try:
+        for user_input in replay_.inputs():
+            from_node = pipeline.current_node_id
+            start = time.perf_counter()
+            output = pipeline.run(user_input)
+            replay_.turn(
+                user_input, from_node, pipeline.current_node_id, output,
+                time.perf_counter() - start,
+            )
+            if replay_.is_over:
+                break
+    except Exception as e:
+        replay_.fail(e)
+    return replay_.finish(pipeline.current_node_id)
+
+
+async def areplay(
+    pipeline: CustomerSupportPipeline, conversation: Conversation
+) -> List[dict]:
+    """Async version of `replay`"""
+    replay_ = _Replay(conversation)
+    try:
+        for user_input in replay_.inputs():
+            from_node = pipeline.current_node_id
+            start = time.perf_counter()
+            output = await pipeline.arun(user_input)
+            replay_.turn(
+                user_input, from_node, pipeline.current_node_id, output,
+                time.perf_counter() - start,
+            )
+            if replay_.is_over:
+                break
+    except Exception as e:
+        replay_.fail(e)
+    return replay_.finish(pipeline.current_node_id)
+
+
+class BatchRunner:
+
+    """Replays conversations on `workers` threads, or on as many tasks of one
+    event loop, every worker takes the next conversation of the input when it
+    is done with one, so the input is read as it goes"""
+
+    def __init__(
+        self,
+        pipeline_factory: Callable[[Conversation], CustomerSupportPipeline],
+        output: CheckpointedOutput,
+        workers: int = 4,
+        use_async: bool = False,
+    ):
+        """
+        pipeline_factory (callable): a new pipeline for a conversation, the
+            pipelines share the graph, see CustomerSupportPipeline
+        output (CheckpointedOutput): where the records go, its finished
+            conversations are skipped
+        workers (int): conversations replayed at once
+        use_async (bool): drive the conversations with arun on one event loop
+        """
+        self._pipeline_factory = pipeline_factory
+        self._output = output
+        self._workers = workers
+        self._use_async = use_async
+        self._stats = BatchStats()
+        self._lock = threading.Lock()
+
+    def run(self, conversations: Iterable[Conversation]) -> BatchStats:
+        pending = self._pending(iter(conversations))
+        start = time.perf_counter()
+        if self._use_async:
+            asyncio.run(self._arun(self._apending(pending)))
+        else:
+            threads = [
+                threading.Thread(target=self._work, args=(pending,), name=f"batch-{i}")
+                for i in range(self._workers)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self._stats.seconds = time.perf_counter() - start
+        return dataclasses.replace(self._stats)
+
+    def _pending(
+        self, conversations: Iterator[Conversation]
+    ) -> Callable[[], Optional[Conversation]]:
+        """Next conversation to replay, None once the input is exhausted,
+        safe to call from every worker"""
+        lock = threading.Lock()
+
+        def next_conversation() -> Optional[Conversation]:
+            with lock:
+                for conversation in conversations:
+                    if conversation.conversation_id not in self._output.done:
+                        return conversation
+                    self._stats.resumed += 1
+                return None
+
+        return next_conversation
+
+    @staticmethod
+    def _apending(
+        pending: Callable[[], Optional[Conversation]]
+    ) -> Callable[[], Awaitable[Optional[Conversation]]]:
+        """Async version of `_pending`, the input is read on a worker thread so
+        the event loop keeps driving the other conversations meanwhile"""
+        lock = asyncio.Lock()
+
+        async def next_conversation() -> Optional[Conversation]:
+            async with lock:
+                return await asyncio.to_thread(pending)
+
+        return next_conversation
+
+    def _record(self, records: List[dict]):
+        self._output.write(records)
+        summary = records[-1]
+        with self._lock:
+            self._stats.conversations += 1
+            self._stats.turns += summary["turns"]
+            if summary["error"] is not None:
+                self._stats.failed += 1
+
+    def _work(self, pending: Callable[[], Optional[Conversation]]):
+        while (conversation := pending()) is not None:
+            self._record(replay(self._pipeline_factory(conversation), conversation))
+
+    async def _arun(self, pending: Callable[[], Awaitable[Optional[Conversation]]]):
+        async def work():
+            while (conversation := await pending()) is not None:
+                pipeline = self._pipeline_factory(conversation)
+                records = await areplay(pipeline, conversation)
+                await asyncio.to_thread(self._record, records)
+
+        await asyncio.gather(*(work() for _ in range(self._workers)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("input", help="JSONL file of conversations")
+    parser.add_argument("--output", required=True, help="JSONL file of the turns")
+    parser.add_argument("--resume", action="store_true",
+                        help="skip the conversations the output already has")
+    parser.add_argument("--workers", type=int, default=4,
+                        help="conversations replayed at once")
+    parser.add_argument("--async", dest="use_async", action="store_true",
+                        help="drive the conversations with arun on one event loop")
+    parser.add_argument("--repeat", type=int, default=1,
+                        help="replay the input that many times, for capacity planning")
+    parser.add_argument("--persist-root", default="chroma_db",
+                        help="where the knowledge bases and the caches are stored")
+    parser.add_argument("--no-response-cache", dest="response_cache", action="store_false")
+    parser.add_argument("--no-completion-cache", dest="completion_cache", action="store_false",
+                        help="always call the llm, for regression runs against a new model")
+    parser.add_argument("--persist-completions", action="store_true",
+                        help="keep the completions, with the user profiles of their "
+                             "prompts, under the persist root to replay them in later runs")
+    parser.add_argument("--no-pre-extraction", dest="pre_extraction", action="store_false")
+    parser.add_argument("--speculative", action="store_true",
+                        help="answer the help questions while the edges are checked")
+    parser.add_argument("--stub-llm", action="store_true",
+                        help="answer with the local stub server instead of OpenAI")
+    parser.add_argument("--llm-latency-ms", type=float, default=0.0,
+                        help="simulated latency of the stub server")
+    parser.add_argument("--fake-embeddings", action="store_true",
+                        help="deterministic fake embeddings instead of the sentence transformer")
+    args = parser.parse_args()
+
+    server = None
+    if args.stub_llm:
+        from benchmarks.stub_llm_server import StubLLMServer
+
+        server = StubLLMServer(latency=args.llm_latency_ms / 1000).start()
+        # read by the LLMClientPool when the graph creates the default model
+        os.environ["OPENAI_API_BASE"] = server.base_url
+        os.environ.setdefault("OPENAI_API_KEY", "sk-offline-batch")
+
+    embeddings = None
+    if args.fake_embeddings:
+        from cache.embedding_cache import LazyEmbeddings
+
+        def fake_embeddings():
+            from langchain.embeddings import DeterministicFakeEmbedding
+
+            return DeterministicFakeEmbedding(size=384)
+
+        embeddings = LazyEmbeddings(fake_embeddings, model_id="DeterministicFakeEmbedding")
+
+    def pipeline_factory(conversation: Conversation) -> CustomerSupportPipeline:
+        return CustomerSupportPipeline(
+            embeddings=embeddings,
+            persist_root=args.persist_root,
+            response_cache=args.response_cache,
+            completion_cache=args.completion_cache,
+            persist_completions=args.persist_completions,
+            pre_extraction=args.pre_extraction,
+            speculative_fallback=args.speculative,
+            messages=conversation.messages,
+            # the graph is shared, the first conversations build it
+            warm_up=False,
+        )
+
+    try:
+        with CheckpointedOutput(args.output, resume=args.resume) as output:
+            stats = BatchRunner(
+                pipeline_factory, output, workers=args.workers, use_async=args.use_async
+            ).run(read_conversations(args.input, repeat=args.repeat))
+    finally:
+        if server is not None:
+            server.stop()
+
+    print(
+        f"conversations={stats.conversations} turns={stats.turns} "
+        f"failed={stats.failed} resumed={stats.resumed} "
+        f"seconds={stats.seconds:.2f}"
+    )
+    print(
+        f"conversations/s={stats.conversations_per_second:.2f} "
+        f"turns/s={stats.turns_per_second:.2f}"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,309 @@
+"""Offline benchmark of the conversation graph
+
+Replays scripted conversations through CustomerSupportPipeline with a scripted
+llm, fake embeddings and a local Chroma store, so only the engine overhead and
+the simulated llm latency are measured.
+
+    python -m benchmarks.bench_pipeline --history 0 4 16 --concurrency 1 8 \
+        --output bench.json
+    python -m benchmarks.bench_pipeline --output new.json --compare bench.json
+"""
+import argparse
+import asyncio
+import contextvars
+import json
+import platform
+import statistics
+import tempfile
+import time
+import tracemalloc
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+from langchain.embeddings import DeterministicFakeEmbedding
+
+from benchmarks.common import git_commit, percentile
+from benchmarks.fake_llm import HELP_ANSWER, LLMUsage, ScriptedChatModel
+from customer_support import CustomerSupportPipeline
+from data.chat import Role
+from graph.callbacks import use_callbacks
+from graph.shared import clear_shared
+from graph.speculation import SpeculationStats
+
+EMAIL = "rafaelpossas@gmail.com"
+HELP_QUESTIONS = [
+    "How do I connect my POS hardware?",
+    "How can I add a new product to my store?",
+    "How do I refund an order?",
+    "Can I change the currency of my store?",
+]
+CALL_REQUEST = "Please call me on 123-456-7890"
+
+# (label, user input) of every turn of a conversation
+Turn = Tuple[str, Optional[str]]
+
+
+def conversation() -> List[Turn]:
+    return [
+        ("greeting", None),
+        ("user_lookup", EMAIL),
+        ("help_question", HELP_QUESTIONS[0]),
+        ("call_request", CALL_REQUEST),
+    ]
+
+
+def earlier_messages(history: int) -> List[dict]:
+    """`history` earlier question and answer pairs the replayed conversation
+    carries over, they grow every prompt that includes the history"""
+    messages = []
+    for i in range(history):
+        messages.append(
+            {"role": Role.USER, "content": HELP_QUESTIONS[i % len(HELP_QUESTIONS)]}
+        )
+        messages.append({"role": Role.ASSISTANT, "content": HELP_ANSWER})
+    return messages
+
+
+class Sample:
+    def __init__(self, label: str, seconds: float, usage: LLMUsage):
+        self.label = label
+        self.seconds = seconds
+        self.calls = usage.calls
+        self.prompt_tokens = usage.prompt_tokens
+
+
+def _replay(pipeline: CustomerSupportPipeline, turns: List[Turn]) -> List[Sample]:
+    samples = []
+    for label, user_input in turns:
+        usage = LLMUsage()
+        start = time.perf_counter()
+        with use_callbacks([usage]):
+            pipeline.run(user_input)
+        samples.append(Sample(label, time.perf_counter() - start, usage))
+    return samples
+
+
+async def _areplay(pipeline: CustomerSupportPipeline, turns: List[Turn]) -> List[Sample]:
+    samples = []
+    for label, user_input in turns:
+        usage = LLMUsage()
+        start = time.perf_counter()
+        with use_callbacks([usage]):
+            await pipeline.arun(user_input)
+        samples.append(Sample(label, time.perf_counter() - start, usage))
+    return samples
+
+
+def run_point(
+    pipeline_factory, history: int, concurrency: int, conversations: int, use_async: bool
+) -> Tuple[List[Sample], float]:
+    turns = conversation()
+    messages = earlier_messages(history)
+    pipelines = [pipeline_factory(messages) for _ in range(conversations)]
+
+    start = time.perf_counter()
+    if use_async:
+
+        async def replay_all():
+            semaphore = asyncio.Semaphore(concurrency)
+
+            async def replay(pipeline):
+                async with semaphore:
+                    return await _areplay(pipeline, turns)
+
+            return await asyncio.gather(*(replay(p) for p in pipelines))
+
+        results = asyncio.run(replay_all())
+    else:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            futures = [
+                executor.submit(contextvars.copy_context().run, _replay, p, turns)
+                for p in pipelines
+            ]
+            results = [future.result() for future in futures]
+    elapsed = time.perf_counter() - start
+
+    return [sample for samples in results for sample in samples], elapsed
+
+
+def summarize(samples: List[Sample]) -> Dict:
+    latencies = [s.seconds * 1000 for s in samples]
+    return {
+        "turns": len(samples),
+        "p50_ms": round(percentile(latencies, 50), 3),
+        "p99_ms": round(percentile(latencies, 99), 3),
+        "mean_ms": round(statistics.fmean(latencies), 3),
+        "llm_calls_per_turn": round(statistics.fmean(s.calls for s in samples), 3),
+        "prompt_tokens_per_turn": round(
+            statistics.fmean(s.prompt_tokens for s in samples), 1
+        ),
+    }
+
+
+def speculation_delta(
+    pipeline: CustomerSupportPipeline, before: Dict[str, SpeculationStats]
+) -> Dict:
+    """Speculative fallbacks of the nodes since `before`"""
+    report = {}
+    for node_id, stats in pipeline.speculation_stats().items():
+        old = before.get(node_id, SpeculationStats())
+        delta = SpeculationStats(
+            launched=stats.launched - old.launched,
+            used=stats.used - old.used,
+            wasted=stats.wasted - old.wasted,
+            cancelled=stats.cancelled - old.cancelled,
+            wasted_seconds=stats.wasted_seconds - old.wasted_seconds,
+        )
+        report[node_id] = {
+            "launched": delta.launched,
+            "used": delta.used,
+            "wasted": delta.wasted,
+            "cancelled": delta.cancelled,
+            "wasted_ms": round(delta.wasted_seconds * 1000, 1),
+            "waste_rate": round(delta.waste_rate, 3),
+        }
+    return report
+
+
+def benchmark(args) -> Dict:
+    # temperature 0 like the production model
+    llm = ScriptedChatModel(temperature=0, latency=args.llm_latency_ms / 1000)
+    embeddings = DeterministicFakeEmbedding(size=args.embedding_size)
+    persist_root = args.persist_root or tempfile.mkdtemp(prefix="bench_chroma_")
+
+    def pipeline_factory(messages=None):
+        return CustomerSupportPipeline(
+            llm_model=llm,
+            embeddings=embeddings,
+            persist_root=persist_root,
+            response_cache=args.response_cache,
+            completion_cache=args.completion_cache,
+            pre_extraction=args.pre_extraction,
+            speculative_fallback=args.speculative,
+            messages=messages,
+        )
+
+    # builds the graph and the local knowledge bases outside of the measurements
+    build_start = time.perf_counter()
+    warmup = pipeline_factory()
+    for _, user_input in conversation():
+        warmup.run(user_input)
+    build_seconds = time.perf_counter() - build_start
+    static_prompt_tokens = warmup.static_prompt_tokens()
+    # the nodes, and their stats, are shared with the measured conversations
+    speculation = warmup.speculation_stats()
+
+    points = []
+    for history in args.history:
+        for concurrency in args.concurrency:
+            if args.allocations:
+                tracemalloc.start()
+            samples, elapsed = run_point(
+                pipeline_factory,
+                history,
+                concurrency,
+                args.conversations or concurrency,
+                args.use_async,
+            )
+            point = {"history": history, "concurrency": concurrency}
+            point.update(summarize(samples))
+            point["turns_per_second"] = round(len(samples) / elapsed, 2)
+            if args.speculative:
+                point["speculation"] = speculation_delta(warmup, speculation)
+                speculation = warmup.speculation_stats()
+            if args.allocations:
+                _, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+                point["peak_allocated_kb"] = round(peak / 1024, 1)
+
+            by_label = defaultdict(list)
+            for sample in samples:
+                by_label[sample.label].append(sample)
+            point["per_turn"] = {
+                label: summarize(label_samples)
+                for label, label_samples in by_label.items()
+            }
+            points.append(point)
+            print(
+                f"history={history:<3} concurrency={concurrency:<3} "
+                f"p50={point['p50_ms']:.1f}ms p99={point['p99_ms']:.1f}ms "
+                f"calls/turn={point['llm_calls_per_turn']} "
+                f"tokens/turn={point['prompt_tokens_per_turn']}"
+            )
+
+    clear_shared()
+    return {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "mode": "async" if args.use_async else "sync",
+        "llm_latency_ms": args.llm_latency_ms,
+        "response_cache": args.response_cache,
+        "completion_cache": args.completion_cache,
+        "pre_extraction": args.pre_extraction,
+        "speculative": args.speculative,
+        "build_seconds": round(build_seconds, 3),
+        "static_prompt_tokens": static_prompt_tokens,
+        "points": points,
+    }
+
+
+def compare(current: Dict, baseline: Dict):
+    """Prints the relative change of every metric of the points both runs share"""
+    metrics = ["p50_ms", "p99_ms", "llm_calls_per_turn", "prompt_tokens_per_turn"]
+    baseline_points = {(p["history"], p["concurrency"]): p for p in baseline["points"]}
+
+    print(f"\n{baseline.get('commit')} -> {current.get('commit')}")
+    for point in current["points"]:
+        old = baseline_points.get((point["history"], point["concurrency"]))
+        if old is None:
+            continue
+        changes = []
+        for metric in metrics:
+            before, after = old.get(metric), point.get(metric)
+            if not before or after is None:
+                continue
+            changes.append(f"{metric} {(after - before) / before:+.1%}")
+        print(
+            f"history={point['history']:<3} concurrency={point['concurrency']:<3} "
+            + "  ".join(changes)
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--history", type=int, nargs="+", default=[0, 4, 16],
+                        help="earlier question and answer pairs in the history")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8])
+    parser.add_argument("--conversations", type=int, default=None,
+                        help="conversations per point, defaults to the concurrency")
+    parser.add_argument("--llm-latency-ms", type=float, default=0.0)
+    parser.add_argument("--embedding-size", type=int, default=384)
+    parser.add_argument("--persist-root", default=None,
+                        help="local Chroma directory, a temporary one by default")
+    parser.add_argument("--response-cache", action="store_true")
+    parser.add_argument("--completion-cache", action="store_true",
+                        help="replay the temperature 0 completions, warm after the warmup run")
+    parser.add_argument("--no-pre-extraction", dest="pre_extraction", action="store_false",
+                        help="always ask the llm, even for the email lookup and call requests")
+    parser.add_argument("--speculative", action="store_true",
+                        help="answer the help questions while the edges are checked")
+    parser.add_argument("--async", dest="use_async", action="store_true",
+                        help="drive the conversations with arun on one event loop")
+    parser.add_argument("--no-allocations", dest="allocations", action="store_false",
+                        help="skip tracemalloc, it slows the engine down")
+    parser.add_argument("--output", default=None, help="where to write the JSON results")
+    parser.add_argument("--compare", default=None, help="JSON results to compare with")
+    args = parser.parse_args()
+
+    results = benchmark(args)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
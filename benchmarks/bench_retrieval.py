@@ -0,0 +1,167 @@
+"""Recall and latency of the Help Center retrievers
+
+Runs the labeled questions of benchmarks/data/help_center_questions.jsonl
+through the dense, BM25, hybrid and reranked hybrid retrievers of the tier
+each question belongs to. A question is recalled when one of the returned
+chunks contains its answer span.
+
+    python -m benchmarks.bench_retrieval --k 3 --output retrieval.json
+    python -m benchmarks.bench_retrieval --fake-embeddings --no-rerank
+"""
+import argparse
+import json
+import statistics
+import tempfile
+import time
+from typing import Callable, Dict, List
+
+from langchain.embeddings import (
+    DeterministicFakeEmbedding,
+    SentenceTransformerEmbeddings,
+)
+from langchain.schema import Document
+from langchain.vectorstores import Chroma
+
+from benchmarks.common import git_commit, percentile
+from data.history import count_tokens
+from tools.hybrid_retriever import (
+    BM25Index,
+    CrossEncoderReranker,
+    HybridRetriever,
+    matches_filter,
+)
+from tools.ingest import ingest, persist_directory
+
+QUESTIONS_FILE = "benchmarks/data/help_center_questions.jsonl"
+
+Retrieve = Callable[[str, str], List[Document]]
+
+
+def load_questions(path: str) -> List[dict]:
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def evaluate(retrieve: Retrieve, questions: List[dict]) -> Dict:
+    latencies, ranks, tokens = [], [], []
+    for question in questions:
+        start = time.perf_counter()
+        documents = retrieve(question["question"], question["tier"])
+        latencies.append((time.perf_counter() - start) * 1000)
+        tokens.append(sum(count_tokens(doc.page_content) for doc in documents))
+        ranks.append(
+            next(
+                (
+                    rank
+                    for rank, doc in enumerate(documents, start=1)
+                    if question["answer"] in doc.page_content
+                ),
+                None,
+            )
+        )
+
+    return {
+        "recall": round(sum(rank is not None for rank in ranks) / len(ranks), 3),
+        "mrr": round(statistics.fmean(1 / rank if rank else 0.0 for rank in ranks), 3),
+        "p50_ms": round(percentile(latencies, 50), 3),
+        "p99_ms": round(percentile(latencies, 99), 3),
+        "context_tokens": round(statistics.fmean(tokens), 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--questions", default=QUESTIONS_FILE)
+    parser.add_argument("--k", type=int, default=3, help="chunks returned per question")
+    parser.add_argument("--fetch-k", type=int, default=10,
+                        help="candidates of each search fused by the hybrid retriever")
+    parser.add_argument("--persist-root", default=None,
+                        help="where the collection is ingested, a temporary one by default")
+    parser.add_argument("--fake-embeddings", action="store_true",
+                        help="deterministic random vectors, measures the keyword side only")
+    parser.add_argument("--no-rerank", dest="rerank", action="store_false")
+    parser.add_argument("--output", default=None, help="where to write the JSON results")
+    args = parser.parse_args()
+
+    if args.fake_embeddings:
+        embeddings = DeterministicFakeEmbedding(size=384)
+    else:
+        embeddings = SentenceTransformerEmbeddings(model_name="all-MiniLM-L6-v2")
+    persist_root = args.persist_root or tempfile.mkdtemp(prefix="bench_retrieval_")
+    ingest(embeddings, persist_root)
+
+    db = Chroma(
+        persist_directory=persist_directory(persist_root), embedding_function=embeddings
+    )
+    contents = db.get(include=["documents", "metadatas"])
+    documents = [
+        Document(page_content=text, metadata=metadata)
+        for text, metadata in zip(contents["documents"], contents["metadatas"])
+    ]
+    index = BM25Index([doc.page_content for doc in documents])
+
+    def hybrid(reranker=None) -> Retrieve:
+        retrievers = {}
+
+        def retrieve(query: str, tier: str) -> List[Document]:
+            if tier not in retrievers:
+                retrievers[tier] = HybridRetriever.from_documents(
+                    db,
+                    documents,
+                    index=index,
+                    where={tier: True},
+                    k=args.k,
+                    fetch_k=args.fetch_k,
+                    reranker=reranker,
+                )
+            return retrievers[tier].get_relevant_documents(query)
+
+        return retrieve
+
+    def dense(query: str, tier: str) -> List[Document]:
+        return db.similarity_search(query, k=args.k, filter={tier: True})
+
+    def bm25(query: str, tier: str) -> List[Document]:
+        allowed = {
+            i
+            for i, doc in enumerate(documents)
+            if matches_filter(doc.metadata, {tier: True})
+        }
+        return [documents[i] for i, _ in index.search(query, args.k, allowed)]
+
+    retrievers: Dict[str, Retrieve] = {
+        "dense": dense,
+        "bm25": bm25,
+        "hybrid": hybrid(),
+    }
+    if args.rerank:
+        retrievers["hybrid_rerank"] = hybrid(CrossEncoderReranker())
+
+    questions = load_questions(args.questions)
+    results = {}
+    for name, retrieve in retrievers.items():
+        # the first query loads the models and warms the caches
+        retrieve(questions[0]["question"], questions[0]["tier"])
+        results[name] = evaluate(retrieve, questions)
+        print(
+            f"{name:<14} recall@{args.k}={results[name]['recall']:.2f}"
+            f" mrr={results[name]['mrr']:.2f} p50={results[name]['p50_ms']:.1f}ms"
+            f" p99={results[name]['p99_ms']:.1f}ms"
+            f" context_tokens={results[name]['context_tokens']}"
+        )
+
+    if args.output:
+        output = {
+            "commit": git_commit(),
+            "k": args.k,
+            "fetch_k": args.fetch_k,
+            "embeddings": "fake" if args.fake_embeddings else "all-MiniLM-L6-v2",
+            "questions": len(questions),
+            "retrievers": results,
+        }
+        with open(args.output, "w") as f:
+            json.dump(output, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,212 @@
+"""Cold start benchmark of the support pipeline
+
+Starts a fresh interpreter per run and times, from the first import, how long
+CustomerSupportPipeline takes to show its greeting, which heavy modules were
+loaded by then, how long the background warm up of the next nodes takes and
+the first turns after it. The llm is the local stub server, so no network is
+needed, and the embeddings are fake unless --sentence-transformer is given.
+
+    python -m benchmarks.bench_startup --runs 5 --output startup.json
+    python -m benchmarks.bench_startup --no-warm-up --output cold.json --compare startup.json
+"""
+import argparse
+import importlib
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List
+
+# modules the greeting must not wait for
+HEAVY_MODULES = [
+    "langchain.agents",
+    "langchain.chains",
+    "langchain.chat_models",
+    "langchain.embeddings",
+    "openai",
+    "chromadb",
+    "sentence_transformers",
+    "torch",
+    "whisper",
+]
+# the modules llm_app.py imports besides streamlit
+APP_MODULES = ["customer_support", "session.store", "ui.graph_renderer"]
+
+EMAIL = "rafaelpossas@gmail.com"
+HELP_QUESTION = "How do I connect my POS hardware?"
+PHASES = ["import", "construct", "greeting", "first_greeting", "warm_up"]
+
+
+def child(config: Dict) -> Dict:
+    """One cold start, run in a fresh interpreter, only the standard library
+    is imported before the clock starts"""
+    start = time.perf_counter()
+    imports = {}
+    for module in APP_MODULES:
+        module_start = time.perf_counter()
+        try:
+            importlib.import_module(module)
+        except ImportError:
+            imports[module] = None
+            continue
+        imports[module] = time.perf_counter() - module_start
+    imported = time.perf_counter()
+
+    from cache.embedding_cache import LazyEmbeddings
+    from customer_support import CustomerSupportPipeline
+
+    embeddings = None
+    if not config["sentence_transformer"]:
+
+        def fake_embeddings():
+            from langchain.embeddings import DeterministicFakeEmbedding
+
+            return DeterministicFakeEmbedding(size=384)
+
+        embeddings = LazyEmbeddings(fake_embeddings, model_id="DeterministicFakeEmbedding")
+
+    pipeline = CustomerSupportPipeline(
+        embeddings=embeddings,
+        persist_root=config["persist_root"],
+        warm_up=config["warm_up"],
+    )
+    constructed = time.perf_counter()
+    pipeline.run("")
+    greeted = time.perf_counter()
+    loaded = [module for module in HEAVY_MODULES if module in sys.modules]
+
+    # the user is typing, the background warm up has that long
+    pipeline.wait_for_warm_up()
+    warmed = time.perf_counter()
+
+    turns = {}
+    for label, user_input in [("user_lookup", EMAIL), ("help_question", HELP_QUESTION)]:
+        turn_start = time.perf_counter()
+        pipeline.run(user_input)
+        turns[label] = time.perf_counter() - turn_start
+
+    return {
+        "import": imported - start,
+        "construct": constructed - imported,
+        "greeting": greeted - constructed,
+        "first_greeting": greeted - start,
+        "warm_up": warmed - greeted,
+        "turns": turns,
+        "app_imports": imports,
+        "loaded_at_greeting": loaded,
+    }
+
+
+def run_child(config: Dict, env: Dict[str, str]) -> Dict:
+    with tempfile.NamedTemporaryFile("r", suffix=".json", delete=False) as f:
+        output = f.name
+    try:
+        subprocess.run(
+            [sys.executable, "-m", "benchmarks.bench_startup",
+             "--child", json.dumps(config), "--output", output],
+            env=env,
+            check=True,
+            stdout=subprocess.DEVNULL,
+        )
+        with open(output) as f:
+            return json.load(f)
+    finally:
+        os.remove(output)
+
+
+def summarize(values: List[float]) -> Dict:
+    return {
+        "median_ms": round(statistics.median(values) * 1000, 1),
+        "min_ms": round(min(values) * 1000, 1),
+    }
+
+
+def benchmark(args) -> Dict:
+    from benchmarks.common import git_commit
+    from benchmarks.stub_llm_server import StubLLMServer
+
+    config = {
+        "persist_root": args.persist_root or tempfile.mkdtemp(prefix="bench_startup_"),
+        "warm_up": args.warm_up,
+        "sentence_transformer": args.sentence_transformer,
+    }
+    with StubLLMServer() as server:
+        env = dict(os.environ, OPENAI_API_BASE=server.base_url)
+        env.setdefault("OPENAI_API_KEY", "sk-offline-benchmark")
+        # builds the local knowledge bases, the runs measure a warm disk
+        run_child(config, env)
+        runs = [run_child(config, env) for _ in range(args.runs)]
+
+    phases = {phase: summarize([run[phase] for run in runs]) for phase in PHASES}
+    turns = {
+        label: summarize([run["turns"][label] for run in runs])
+        for label in runs[0]["turns"]
+    }
+    app_imports = {
+        module: None if runs[0]["app_imports"][module] is None
+        else summarize([run["app_imports"][module] for run in runs])
+        for module in APP_MODULES
+    }
+    for phase, summary in phases.items():
+        print(f"{phase:<16} median={summary['median_ms']:.1f}ms min={summary['min_ms']:.1f}ms")
+    for label, summary in turns.items():
+        print(f"{label:<16} median={summary['median_ms']:.1f}ms min={summary['min_ms']:.1f}ms")
+    print(f"loaded at greeting: {', '.join(runs[0]['loaded_at_greeting']) or 'none'}")
+
+    return {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "runs": args.runs,
+        "warm_up": args.warm_up,
+        "sentence_transformer": args.sentence_transformer,
+        "phases": phases,
+        "turns": turns,
+        "app_imports": app_imports,
+        "loaded_at_greeting": runs[0]["loaded_at_greeting"],
+    }
+
+
+def compare(current: Dict, baseline: Dict):
+    """Prints the relative change of the median of every phase and turn"""
+    print(f"\n{baseline.get('commit')} -> {current.get('commit')}")
+    for group in ["phases", "turns"]:
+        for name, summary in current[group].items():
+            old = baseline.get(group, {}).get(name)
+            if not old or not old["median_ms"]:
+                continue
+            change = (summary["median_ms"] - old["median_ms"]) / old["median_ms"]
+            print(f"{name:<16} median {change:+.1%}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5, help="cold starts to measure")
+    parser.add_argument("--persist-root", default=None,
+                        help="local Chroma directory, a temporary one by default")
+    parser.add_argument("--no-warm-up", dest="warm_up", action="store_false",
+                        help="build the nodes on first use instead of in the background")
+    parser.add_argument("--sentence-transformer", action="store_true",
+                        help="load the real embedding model instead of fake embeddings")
+    parser.add_argument("--child", default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--output", default=None, help="where to write the JSON results")
+    parser.add_argument("--compare", default=None, help="JSON results to compare with")
+    args = parser.parse_args()
+
+    if args.child is not None:
+        results = child(json.loads(args.child))
+    else:
+        results = benchmark(args)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
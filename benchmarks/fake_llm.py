@@ -0,0 +1,130 @@
+import asyncio
+import json
+import os
+import re
+import time
+from typing import Any, List
+
+from langchain.callbacks.base import BaseCallbackHandler
+from langchain.chat_models import ChatOpenAI
+from langchain.schema import AIMessage, ChatGeneration, ChatResult
+from langchain.schema.messages import BaseMessage
+
+from data.history import count_tokens
+from tools.user_info_db import find_user_profile
+
+# the OpenAI client is created by ChatOpenAI but never used by the fake
+os.environ.setdefault("OPENAI_API_KEY", "sk-offline-benchmark")
+
+EMAIL_PATTERN = re.compile(r"[\w.+-]+@[\w-]+\.[\w.]+")
+PHONE_PATTERN = re.compile(r"\d{3}-\d{3}-\d{4}")
+
+HELP_ANSWER = (
+    "To connect your POS hardware open the Shopify POS app, go to Settings, "
+    "select Hardware and follow the pairing instructions for your device."
+)
+
+
+class ScriptedChatModel(ChatOpenAI):
+
+    """Offline stand-in for ChatOpenAI
+    answers every prompt of the support graph with a scripted completion after
+    `latency` seconds, so the engine can be measured without network calls.
+    It subclasses ChatOpenAI because the OpenAI functions agent requires it.
+    """
+
+    latency: float = 0.0
+
+    def _reply(self, messages: List[BaseMessage]) -> str:
+        prompt = "\n".join(str(message.content) for message in messages)
+
+        if "user_profile_db_search" in prompt:
+            return self._user_info_step(prompt)
+        if "does the input satisfy the condition" in prompt:
+            return self._validation(prompt)
+        if "Extract the phone number" in prompt:
+            phone = PHONE_PATTERN.search(prompt.split("Input:")[-1])
+            return json.dumps({"phone_number": phone.group(0) if phone else ""})
+        if "next_inputs" in prompt:
+            return json.dumps(
+                {
+                    "destination": "Premium Subscription Knowledge Base",
+                    "next_inputs": prompt.split("<< INPUT >>")[-1].strip()[:200],
+                }
+            )
+        if "Call user on his phone number" in prompt:
+            return json.dumps(
+                {
+                    "agent_name": "Alex",
+                    "customer_name": "Customer",
+                    "call_summary": "The customer asked for help with POS hardware.",
+                }
+            )
+        return HELP_ANSWER
+
+    @staticmethod
+    def _user_info_step(prompt: str) -> str:
+        question = prompt.split("Begin!")[-1]
+        email = EMAIL_PATTERN.search(question)
+        email = email.group(0) if email else ""
+
+        if "Observation:" not in question:
+            return (
+                "Thought: I need to find the user profile"
+                f"\nAction: user_profile_db_search\nAction Input: {email}"
+            )
+
+        profile = find_user_profile(email=email)
+        if profile is None:
+            return "Final Answer: the user could not be found"
+        return f"Final Answer: {profile.model_dump_json()}"
+
+    @staticmethod
+    def _validation(prompt: str) -> str:
+        query = prompt.split("Input:")[-1]
+        is_valid = "call" in query.lower()
+        if "fill the result" not in prompt:
+            return json.dumps({"is_valid": is_valid})
+
+        phone = PHONE_PATTERN.search(query)
+        result = {"phone_number": phone.group(0)} if is_valid and phone else None
+        return json.dumps({"is_valid": is_valid, "result": result})
+
+    def _result(self, messages: List[BaseMessage]) -> ChatResult:
+        message = AIMessage(content=self._reply(messages))
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        if self.latency:
+            time.sleep(self.latency)
+        return self._result(messages)
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return self._result(messages)
+
+
+class LLMUsage(BaseCallbackHandler):
+
+    """Counts the llm calls and prompt tokens of everything it is attached to"""
+
+    def __init__(self):
+        self.calls = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+
+    def on_llm_start(self, serialized, prompts: List[str], **kwargs: Any):
+        self.calls += 1
+        self.prompt_tokens += sum(count_tokens(prompt) for prompt in prompts)
+
+    def on_chat_model_start(self, serialized, messages, **kwargs: Any):
+        self.calls += 1
+        self.prompt_tokens += sum(
+            count_tokens(str(message.content)) for batch in messages for message in batch
+        )
+
+    def on_llm_end(self, response, **kwargs: Any):
+        for generations in response.generations:
+            for generation in generations:
+                self.completion_tokens += count_tokens(generation.text)
@@ -0,0 +1,213 @@
+"""Local stand-in for the OpenAI chat completions API
+
+Answers /v1/chat/completions with the scripted completions of
+benchmarks.fake_llm, streamed or not, after a simulated latency, and can
+reject a share of the requests with 429s to exercise the LLMClientPool
+retries. Point the pool to it with OPENAI_API_BASE or `base_url`.
+
+    python -m benchmarks.stub_llm_server --port 8089 --latency-ms 200 --rate-limit-every 5
+    OPENAI_API_BASE=http://127.0.0.1:8089/v1 python -m customer_support
+"""
+import argparse
+import json
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+
+from langchain.adapters.openai import convert_dict_to_message
+
+from benchmarks.fake_llm import ScriptedChatModel
+from data.history import count_tokens
+
+
+class StubLLMServer:
+
+    """Serves the scripted completions on a background thread
+
+    latency (float): seconds before every answer
+    rate_limit_every (int): every n-th request gets a 429, 0 never
+    retry_after (float): `retry-after` of the 429 responses
+    """
+
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        latency: float = 0.0,
+        rate_limit_every: int = 0,
+        retry_after: float = 0.0,
+    ):
+        self.latency = latency
+        self.rate_limit_every = rate_limit_every
+        self.retry_after = retry_after
+        self.model = ScriptedChatModel()
+        self.requests = 0
+        self.rate_limited = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._handler())
+        self._server.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self) -> "StubLLMServer":
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, name="StubLLMServer", daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self) -> "StubLLMServer":
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _admit(self) -> bool:
+        """Counts the request, False when it must be rate limited"""
+        with self._lock:
+            self.requests += 1
+            limited = (
+                self.rate_limit_every > 0 and self.requests % self.rate_limit_every == 0
+            )
+            if limited:
+                self.rate_limited += 1
+            return not limited
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def _send_json(self, status: int, body: dict, headers: Optional[dict] = None):
+                payload = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def do_GET(self):
+                if self.path.rstrip("/") != "/stats":
+                    return self._send_json(404, {"error": {"message": "not found"}})
+                self._send_json(
+                    200,
+                    {"requests": server.requests, "rate_limited": server.rate_limited},
+                )
+
+            def do_POST(self):
+                if not self.path.rstrip("/").endswith("/chat/completions"):
+                    return self._send_json(404, {"error": {"message": "not found"}})
+                length = int(self.headers.get("Content-Length", 0))
+                request = json.loads(self.rfile.read(length) or b"{}")
+
+                if not server._admit():
+                    return self._send_json(
+                        429,
+                        {"error": {"message": "rate limited", "type": "requests"}},
+                        {"retry-after": str(server.retry_after)},
+                    )
+                if server.latency:
+                    time.sleep(server.latency)
+
+                messages = [convert_dict_to_message(m) for m in request["messages"]]
+                text = server.model._reply(messages)
+                completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+                model = request.get("model", "gpt-3.5-turbo")
+
+                if not request.get("stream"):
+                    prompt_tokens = sum(count_tokens(str(m.content)) for m in messages)
+                    completion_tokens = count_tokens(text)
+                    return self._send_json(
+                        200,
+                        {
+                            "id": completion_id,
+                            "object": "chat.completion",
+                            "created": int(time.time()),
+                            "model": model,
+                            "choices": [
+                                {
+                                    "index": 0,
+                                    "message": {"role": "assistant", "content": text},
+                                    "finish_reason": "stop",
+                                }
+                            ],
+                            "usage": {
+                                "prompt_tokens": prompt_tokens,
+                                "completion_tokens": completion_tokens,
+                                "total_tokens": prompt_tokens + completion_tokens,
+                            },
+                        },
+                    )
+
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                deltas = [{"role": "assistant", "content": ""}]
+                deltas += [{"content": word} for word in text.split(" ")[:1]]
+                deltas += [{"content": f" {word}"} for word in text.split(" ")[1:]]
+                for delta in deltas + [{}]:
+                    chunk = {
+                        "id": completion_id,
+                        "object": "chat.completion.chunk",
+                        "created": int(time.time()),
+                        "model": model,
+                        "choices": [
+                            {
+                                "index": 0,
+                                "delta": delta,
+                                "finish_reason": None if delta else "stop",
+                            }
+                        ],
+                    }
+                    self._write_chunk(f"data: {json.dumps(chunk)}\n\n")
+                self._write_chunk("data: [DONE]\n\n")
+                self._write_chunk("")
+
+            def _write_chunk(self, data: str):
+                payload = data.encode("utf-8")
+                self.wfile.write(f"{len(payload):x}\r\n".encode("ascii"))
+                self.wfile.write(payload + b"\r\n")
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    parser.add_argument("--rate-limit-every", type=int, default=0,
+                        help="answer every n-th request with a 429")
+    parser.add_argument("--retry-after", type=float, default=0.0,
+                        help="seconds advertised by the 429 responses")
+    args = parser.parse_args()
+
+    server = StubLLMServer(
+        args.host, args.port, args.latency_ms / 1000, args.rate_limit_every, args.retry_after
+    )
+    print(f"serving on {server.base_url}")
+    try:
+        server.start()._thread.join()
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+import dataclasses
+import hashlib
+import json
+import threading
+import time
+from typing import Any, List, Optional, Sequence
+
+from langchain.load.dump import dumps
+from langchain.load.load import loads
+from langchain.schema import Generation
+
+from cache.response_cache import CacheEntry, InMemoryBackend, ResponseCacheBackend
+
+
+@dataclasses.dataclass
+class CompletionCacheStats:
+    hits: int = 0
+    misses: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+
+def llm_key(llm: Any, stop: Optional[Sequence[str]] = None, **kwargs: Any) -> str:
+    """Identifies the model and the parameters a completion was generated with,
+    streamed and non-streamed completions are the same"""
+    params = dict(getattr(llm, "_identifying_params", {}))
+    params.pop("stream", None)
+    params.update(kwargs, stop=list(stop) if stop else None)
+    llm_string = f"{type(llm).__name__}:{json.dumps(params, sort_keys=True, default=repr)}"
+    return hashlib.sha256(llm_string.encode("utf-8")).hexdigest()
+
+
+def is_deterministic(llm: Any) -> bool:
+    """Only temperature 0 single completions are worth replaying"""
+    return getattr(llm, "temperature", None) == 0 and getattr(llm, "n", 1) in (None, 1)
+
+
+class CompletionCache:
+
+    """Completions of the deterministic llm calls keyed by model, parameters
+    and rendered prompt. The most recent ones are kept in memory, every one of
+    them in `backend` when given, e.g. a SQLiteBackend, so replays and test
+    runs survive restarts.
+    """
+
+    def __init__(
+        self, max_entries: int = 1024, backend: Optional[ResponseCacheBackend] = None
+    ):
+        """
+        max_entries (int): completions kept in the in memory LRU layer
+        backend (ResponseCacheBackend): persistent layer behind the memory one
+        """
+        self._memory = InMemoryBackend(max_entries)
+        self._backend = backend
+        self._stats = CompletionCacheStats()
+        self._stats_lock = threading.Lock()
+
+    @property
+    def persistent(self) -> bool:
+        return self._backend is not None
+
+    def stats(self) -> CompletionCacheStats:
+        with self._stats_lock:
+            return dataclasses.replace(self._stats)
+
+    def _count(self, hits: int, misses: int):
+        with self._stats_lock:
+            self._stats.hits += hits
+            self._stats.misses += misses
+
+    def get(self, llm_key: str, prompts: Sequence[str]) -> List[Optional[List[Generation]]]:
+        """Cached generations of every prompt, None for the missing ones"""
+        found: List[Optional[List[Generation]]] = []
+        for prompt in prompts:
+            entry = self._memory.get(llm_key, prompt)
+            if entry is None and self._backend is not None:
+                entry = self._backend.get(llm_key, prompt)
+                if entry is not None:
+                    self._memory.put(entry)
+            found.append(None if entry is None else loads(entry.response))
+
+        hits = sum(generations is not None for generations in found)
+        self._count(hits, len(found) - hits)
+        return found
+
+    def put(self, llm_key: str, prompt: str, generations: List[Generation]):
+        entry = CacheEntry(
+            namespace=llm_key,
+            query=prompt,
+            response=dumps(generations),
+            embedding=None,
+            created_at=time.time(),
+        )
+        self._memory.put(entry)
+        if self._backend is not None:
+            self._backend.put(entry)
@@ -0,0 +1,274 @@
+import contextlib
+import fcntl
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+from langchain.schema.embeddings import Embeddings
+
+DIGEST_SIZE = 32
+
+
+def model_id(embeddings: Embeddings) -> str:
+    """Identifies the embedding model, vectors of different models never mix"""
+    if isinstance(embeddings, (CachedEmbeddings, LazyEmbeddings)):
+        return embeddings.model_id
+    model = getattr(embeddings, "model_name", None) or getattr(embeddings, "size", "")
+    return f"{type(embeddings).__name__}:{model}"
+
+
+class EmbeddingStore:
+
+    """Append only store of float32 vectors keyed by a 32 bytes digest.
+
+    The vectors live in `{path}.f32`, read through a memory map, and the keys
+    in `{path}.keys`, one digest per row, loaded in memory on open. Several
+    stores, of other processes too, may share the files, `put` appends under
+    an exclusive lock of `{path}.lock` and first reads the rows the other
+    writers appended.
+    """
+
+    def __init__(self, path: str):
+        self._vectors_path = f"{path}.f32"
+        self._keys_path = f"{path}.keys"
+        self._meta_path = f"{path}.json"
+        self._lock_path = f"{path}.lock"
+        self._lock = threading.Lock()
+        self._rows: Dict[bytes, int] = {}
+        # rows of the files this store has read, the keys of other writers
+        # may repeat some of them
+        self._size = 0
+        self._dim: Optional[int] = None
+        self._mapped: Optional[np.memmap] = None
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with self._lock, self._file_lock(fcntl.LOCK_SH):
+            self._refresh()
+
+    @contextlib.contextmanager
+    def _file_lock(self, operation: int):
+        with open(self._lock_path, "a") as f:
+            fcntl.flock(f, operation)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _refresh(self):
+        """Reads the rows appended to the files since the last refresh, must
+        be called holding both locks"""
+        if self._dim is None and os.path.exists(self._meta_path):
+            with open(self._meta_path, encoding="utf-8") as f:
+                self._dim = json.load(f)["dim"]
+        rows = self._complete_rows()
+        if rows <= self._size:
+            return
+        with open(self._keys_path, "rb") as f:
+            f.seek(self._size * DIGEST_SIZE)
+            keys = f.read((rows - self._size) * DIGEST_SIZE)
+        for offset in range(rows - self._size):
+            key = keys[offset * DIGEST_SIZE : (offset + 1) * DIGEST_SIZE]
+            self._rows.setdefault(key, self._size + offset)
+        self._size = rows
+
+    def _complete_rows(self) -> int:
+        """Rows written to both files, the keys are appended after the vectors
+        so the rest of an interrupted append is ignored, and overwritten by
+        the next one"""
+        if (
+            self._dim is None
+            or not os.path.exists(self._vectors_path)
+            or not os.path.exists(self._keys_path)
+        ):
+            return 0
+        key_rows = os.path.getsize(self._keys_path) // DIGEST_SIZE
+        vector_rows = os.path.getsize(self._vectors_path) // (self._dim * 4)
+        return min(key_rows, vector_rows)
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def get(self, key: bytes) -> Optional[np.ndarray]:
+        with self._lock:
+            row = self._rows.get(key)
+            if row is None:
+                return None
+            if self._mapped is None or row >= self._mapped.shape[0]:
+                self._mapped = np.memmap(
+                    self._vectors_path,
+                    dtype=np.float32,
+                    mode="r",
+                    shape=(self._size, self._dim),
+                )
+            return np.array(self._mapped[row])
+
+    def put(self, keys: List[bytes], vectors: np.ndarray):
+        with self._lock, self._file_lock(fcntl.LOCK_EX):
+            self._refresh()
+            new = list(
+                {
+                    key: vector
+                    for key, vector in zip(keys, vectors)
+                    if key not in self._rows
+                }.items()
+            )
+            if not new:
+                return
+            if self._dim is None:
+                self._dim = vectors.shape[1]
+                with open(self._meta_path, "w", encoding="utf-8") as f:
+                    json.dump({"dim": self._dim}, f)
+
+            rows = self._size
+            self._write_at(
+                self._vectors_path,
+                rows * self._dim * 4,
+                np.asarray([v for _, v in new], dtype=np.float32).tobytes(),
+            )
+            self._write_at(
+                self._keys_path, rows * DIGEST_SIZE, b"".join(key for key, _ in new)
+            )
+            for offset, (key, _) in enumerate(new):
+                self._rows[key] = rows + offset
+            self._size = rows + len(new)
+
+    @staticmethod
+    def _write_at(path: str, position: int, data: bytes):
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            os.lseek(fd, position, os.SEEK_SET)
+            while data:
+                data = data[os.write(fd, data) :]
+        finally:
+            os.close(fd)
+
+
+class LazyEmbeddings(Embeddings):
+
+    """Embedding model built by `factory` the first time a text is embedded,
+    or by `warm_up`, loading a sentence transformer takes seconds and the
+    conversation does not need it before the user is identified.
+    """
+
+    def __init__(self, factory: Callable[[], Embeddings], model_id: str):
+        """
+        factory (callable): builds the embedding model
+        model_id (str): `model_id` of the model `factory` builds, so the
+            caches and the collections are keyed without building it
+        """
+        self.model_id = model_id
+        self._factory = factory
+        self._embeddings: Optional[Embeddings] = None
+        self._lock = threading.Lock()
+
+    @property
+    def embeddings(self) -> Embeddings:
+        if self._embeddings is None:
+            with self._lock:
+                if self._embeddings is None:
+                    self._embeddings = self._factory()
+        return self._embeddings
+
+    def warm_up(self):
+        self.embeddings
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.embeddings.embed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embeddings.embed_query(text)
+
+
+class CachedEmbeddings(Embeddings):
+
+    """Embeddings
+    content addressed cache in front of an embedding model, texts embedded
+    once, by the ingestion or by a query, are never sent to the model again.
+    The most recent vectors are kept in memory, all of them on disk when a
+    `path` is given.
+    """
+
+    def __init__(
+        self, embeddings: Embeddings, path: Optional[str] = None, max_entries: int = 4096
+    ):
+        """
+        embeddings (Embeddings): the model computing the missing vectors
+        path (str): file prefix of the disk store, memory only when None
+        max_entries (int): vectors kept in the in memory LRU layer
+        """
+        self.embeddings = embeddings
+        self.model_id = model_id(embeddings)
+        self._store = EmbeddingStore(path) if path is not None else None
+        self._max_entries = max_entries
+        self._lru: "OrderedDict[bytes, np.ndarray]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _key(self, text: str, kind: str) -> bytes:
+        # some models embed queries and documents differently
+        key = f"{self.model_id}\0{kind}\0{text}"
+        return hashlib.sha256(key.encode("utf-8")).digest()
+
+    def _lookup(self, key: bytes) -> Optional[np.ndarray]:
+        with self._lock:
+            vector = self._lru.get(key)
+            if vector is not None:
+                self._lru.move_to_end(key)
+                return vector
+        if self._store is not None:
+            vector = self._store.get(key)
+            if vector is not None:
+                self._remember(key, vector)
+        return vector
+
+    def _remember(self, key: bytes, vector: np.ndarray):
+        with self._lock:
+            self._lru[key] = vector
+            self._lru.move_to_end(key)
+            while len(self._lru) > self._max_entries:
+                self._lru.popitem(last=False)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys = [self._key(text, "document") for text in texts]
+        vectors: List[Optional[np.ndarray]] = [self._lookup(key) for key in keys]
+
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+        with self._lock:
+            self.hits += len(texts) - len(missing)
+            self.misses += len(missing)
+        if missing:
+            # one model call for every missing text, duplicates embedded once
+            unique = list(dict.fromkeys(texts[i] for i in missing))
+            computed = np.asarray(
+                self.embeddings.embed_documents(unique), dtype=np.float32
+            )
+            by_text = dict(zip(unique, computed))
+            for i in missing:
+                vectors[i] = by_text[texts[i]]
+                self._remember(keys[i], vectors[i])
+            if self._store is not None:
+                self._store.put(
+                    [self._key(text, "document") for text in unique], computed
+                )
+
+        return [vector.tolist() for vector in vectors]
+
+    def embed_query(self, text: str) -> List[float]:
+        key = self._key(text, "query")
+        vector = self._lookup(key)
+        with self._lock:
+            if vector is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        if vector is None:
+            vector = np.asarray(self.embeddings.embed_query(text), dtype=np.float32)
+            self._remember(key, vector)
+            if self._store is not None:
+                self._store.put([key], vector[None, :])
+        return vector.tolist()
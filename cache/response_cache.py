@@ -0,0 +1,390 @@
+import abc
+import dataclasses
+import functools
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from langchain.schema.embeddings import Embeddings
+
+
+@dataclasses.dataclass
+class CacheEntry:
+    namespace: str
+    query: str
+    response: str
+    embedding: Optional[np.ndarray]
+    created_at: float
+
+
+@dataclasses.dataclass
+class CacheStats:
+    hits: int = 0
+    semantic_hits: int = 0
+    misses: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.semantic_hits + self.misses
+        return (self.hits + self.semantic_hits) / lookups if lookups else 0.0
+
+
+class ResponseCacheBackend(abc.ABC):
+
+    """Stores the cache entries, evicting the least recently used ones once
+    `max_entries` is reached"""
+
+    @abc.abstractmethod
+    def get(self, namespace: str, query: str) -> Optional[CacheEntry]:
+        pass
+
+    @abc.abstractmethod
+    def put(self, entry: CacheEntry):
+        pass
+
+    @abc.abstractmethod
+    def delete(self, namespace: str, query: str):
+        pass
+
+    @abc.abstractmethod
+    def entries(self, namespace: str) -> List[CacheEntry]:
+        pass
+
+
+class InMemoryBackend(ResponseCacheBackend):
+    def __init__(self, max_entries: int = 1024):
+        self._max_entries = max_entries
+        self._entries: "OrderedDict[Tuple[str, str], CacheEntry]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, namespace: str, query: str) -> Optional[CacheEntry]:
+        with self._lock:
+            entry = self._entries.get((namespace, query))
+            if entry is not None:
+                self._entries.move_to_end((namespace, query))
+            return entry
+
+    def put(self, entry: CacheEntry):
+        with self._lock:
+            self._entries[(entry.namespace, entry.query)] = entry
+            self._entries.move_to_end((entry.namespace, entry.query))
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, namespace: str, query: str):
+        with self._lock:
+            self._entries.pop((namespace, query), None)
+
+    def entries(self, namespace: str) -> List[CacheEntry]:
+        with self._lock:
+            return [e for e in self._entries.values() if e.namespace == namespace]
+
+
+class SQLiteBackend(ResponseCacheBackend):
+
+    """Persists the cache on disk so it survives restarts and can be shared
+    by every worker of the same host"""
+
+    def __init__(self, path: str, max_entries: int = 10000, touch_interval: float = 60.0):
+        """
+        path (str): the database file
+        max_entries (int): rows kept, the least recently used are evicted
+        touch_interval (float): seconds before a hit writes its `last_used`
+            again, hits of a hot entry do not all cost a write
+        """
+        self._max_entries = max_entries
+        self._touch_interval = touch_interval
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            " namespace TEXT NOT NULL,"
+            " query TEXT NOT NULL,"
+            " response TEXT NOT NULL,"
+            " embedding BLOB,"
+            " created_at REAL NOT NULL,"
+            " last_used REAL NOT NULL,"
+            " PRIMARY KEY (namespace, query))"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)"
+        )
+        self._conn.commit()
+
+    @staticmethod
+    def _entry(row) -> CacheEntry:
+        namespace, query, response, embedding, created_at = row
+        return CacheEntry(
+            namespace=namespace,
+            query=query,
+            response=response,
+            embedding=None
+            if embedding is None
+            else np.frombuffer(embedding, dtype=np.float32),
+            created_at=created_at,
+        )
+
+    def get(self, namespace: str, query: str) -> Optional[CacheEntry]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT namespace, query, response, embedding, created_at, last_used"
+                " FROM responses WHERE namespace = ? AND query = ?",
+                (namespace, query),
+            ).fetchone()
+            if row is None:
+                return None
+            now = time.time()
+            if now - row[-1] >= self._touch_interval:
+                self._conn.execute(
+                    "UPDATE responses SET last_used = ? WHERE namespace = ? AND query = ?",
+                    (now, namespace, query),
+                )
+                self._conn.commit()
+        return self._entry(row[:-1])
+
+    def put(self, entry: CacheEntry):
+        embedding = (
+            None
+            if entry.embedding is None
+            else np.asarray(entry.embedding, dtype=np.float32).tobytes()
+        )
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    entry.namespace,
+                    entry.query,
+                    entry.response,
+                    embedding,
+                    entry.created_at,
+                    time.time(),
+                ),
+            )
+            self._conn.execute(
+                "DELETE FROM responses WHERE rowid IN ("
+                " SELECT rowid FROM responses ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                (self._max_entries,),
+            )
+            self._conn.commit()
+
+    def delete(self, namespace: str, query: str):
+        with self._lock:
+            self._conn.execute(
+                "DELETE FROM responses WHERE namespace = ? AND query = ?",
+                (namespace, query),
+            )
+            self._conn.commit()
+
+    def entries(self, namespace: str) -> List[CacheEntry]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT namespace, query, response, embedding, created_at"
+                " FROM responses WHERE namespace = ?",
+                (namespace,),
+            ).fetchall()
+        return [self._entry(row) for row in rows]
+
+
+class _SimilarityIndex:
+
+    """Normalized query embeddings of one namespace as a matrix, so a
+    semantic lookup is one matrix product instead of reading every entry
+    of the backend"""
+
+    def __init__(self, entries: List[CacheEntry], loaded_at: float):
+        self.loaded_at = loaded_at
+        self._queries: List[str] = []
+        self._rows: Dict[str, int] = {}
+        self._created_at = np.empty(0)
+        self._matrix: Optional[np.ndarray] = None
+        for entry in entries:
+            if entry.embedding is not None:
+                self.add(entry.query, entry.embedding, entry.created_at)
+
+    def add(self, query: str, embedding: np.ndarray, created_at: float):
+        embedding = np.asarray(embedding, dtype=np.float32)
+        row = self._rows.get(query)
+        if row is None:
+            row = len(self._queries)
+            if self._matrix is None:
+                self._matrix = np.empty((16, embedding.shape[0]), dtype=np.float32)
+                self._created_at = np.empty(16)
+            elif row == self._matrix.shape[0]:
+                # doubled so adding is amortized constant time
+                self._matrix = np.concatenate([self._matrix, np.empty_like(self._matrix)])
+                self._created_at = np.concatenate([self._created_at, self._created_at])
+            self._queries.append(query)
+            self._rows[query] = row
+        self._matrix[row] = embedding
+        self._created_at[row] = created_at
+
+    def remove(self, query: str):
+        row = self._rows.pop(query, None)
+        if row is None:
+            return
+        last = len(self._queries) - 1
+        if row != last:
+            # the last row takes the place of the removed one
+            moved = self._queries[last]
+            self._queries[row] = moved
+            self._rows[moved] = row
+            self._matrix[row] = self._matrix[last]
+            self._created_at[row] = self._created_at[last]
+        self._queries.pop()
+
+    def best(
+        self, embedding: np.ndarray, threshold: float, created_after: Optional[float]
+    ) -> Optional[str]:
+        """The most similar query above `threshold` created after `created_after`"""
+        count = len(self._queries)
+        if not count:
+            return None
+        similarities = self._matrix[:count] @ embedding
+        if created_after is not None:
+            similarities[self._created_at[:count] < created_after] = -np.inf
+        best = int(np.argmax(similarities))
+        if similarities[best] < threshold:
+            return None
+        return self._queries[best]
+
+
+class ResponseCache:
+
+    """Cache
+    answers repeated questions without calling the llm. Queries are
+    normalized and looked up exactly first, when `embeddings` is given a
+    miss falls back to the most similar cached query of the same namespace
+    above `similarity_threshold`.
+    """
+
+    def __init__(
+        self,
+        embeddings: Optional[Embeddings] = None,
+        similarity_threshold: float = 0.92,
+        ttl_seconds: Optional[float] = 24 * 60 * 60,
+        backend: Optional[ResponseCacheBackend] = None,
+        index_refresh_seconds: float = 60.0,
+    ):
+        """
+        embeddings (Embeddings): used to match near duplicated queries
+        similarity_threshold (float): minimum cosine similarity for a semantic hit
+        ttl_seconds (float): how long a response stays valid, None to never expire
+        backend (ResponseCacheBackend): where entries are stored, in memory by default
+        index_refresh_seconds (float): how often the in-memory embeddings of a
+            namespace are reloaded, to see the entries other workers added
+        """
+        self._embeddings = embeddings
+        self._similarity_threshold = similarity_threshold
+        self._ttl_seconds = ttl_seconds
+        self._backend = backend if backend is not None else InMemoryBackend()
+        self._stats = CacheStats()
+        self._stats_lock = threading.Lock()
+        # a miss is followed by a put of the same query, embed it only once
+        self._embed = functools.lru_cache(maxsize=256)(self._embed_query)
+        self._index_refresh_seconds = index_refresh_seconds
+        self._indexes: Dict[str, _SimilarityIndex] = {}
+        self._index_lock = threading.Lock()
+
+    @staticmethod
+    def normalize(query: str) -> str:
+        query = re.sub(r"[^\w\s]", " ", query.lower())
+        return " ".join(query.split())
+
+    def stats(self) -> CacheStats:
+        with self._stats_lock:
+            return dataclasses.replace(self._stats)
+
+    def _count(self, field: str):
+        with self._stats_lock:
+            setattr(self._stats, field, getattr(self._stats, field) + 1)
+
+    def _expired(self, entry: CacheEntry) -> bool:
+        return (
+            self._ttl_seconds is not None
+            and time.time() - entry.created_at > self._ttl_seconds
+        )
+
+    def _embed_query(self, query: str) -> np.ndarray:
+        vector = np.asarray(self._embeddings.embed_query(query), dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def get(self, namespace: str, query: str) -> Optional[str]:
+        query = self.normalize(query)
+
+        entry = self._backend.get(namespace, query)
+        if entry is not None and self._expired(entry):
+            self._delete(namespace, query)
+            entry = None
+        if entry is not None:
+            self._count("hits")
+            return entry.response
+
+        if self._embeddings is not None:
+            response = self._similar(namespace, self._embed(query))
+            if response is not None:
+                self._count("semantic_hits")
+                return response
+
+        self._count("misses")
+        return None
+
+    def _delete(self, namespace: str, query: str):
+        self._backend.delete(namespace, query)
+        with self._index_lock:
+            index = self._indexes.get(namespace)
+            if index is not None:
+                index.remove(query)
+
+    def _index(self, namespace: str) -> _SimilarityIndex:
+        """The similarity index of the namespace, loaded from the backend on
+        first use and every `index_refresh_seconds`"""
+        now = time.monotonic()
+        with self._index_lock:
+            index = self._indexes.get(namespace)
+            if index is not None and now - index.loaded_at < self._index_refresh_seconds:
+                return index
+        index = _SimilarityIndex(self._backend.entries(namespace), loaded_at=now)
+        with self._index_lock:
+            self._indexes[namespace] = index
+        return index
+
+    def _similar(self, namespace: str, embedding: np.ndarray) -> Optional[str]:
+        created_after = (
+            time.time() - self._ttl_seconds if self._ttl_seconds is not None else None
+        )
+        index = self._index(namespace)
+        with self._index_lock:
+            query = index.best(embedding, self._similarity_threshold, created_after)
+        if query is None:
+            return None
+
+        # the backend may have evicted the entry since it was indexed
+        entry = self._backend.get(namespace, query)
+        if entry is None or self._expired(entry):
+            with self._index_lock:
+                index.remove(query)
+            return None
+        return entry.response
+
+    def put(self, namespace: str, query: str, response: str):
+        query = self.normalize(query)
+        embedding = self._embed(query) if self._embeddings is not None else None
+        entry = CacheEntry(
+            namespace=namespace,
+            query=query,
+            response=response,
+            embedding=embedding,
+            created_at=time.time(),
+        )
+        self._backend.put(entry)
+        if embedding is not None:
+            with self._index_lock:
+                index = self._indexes.get(namespace)
+                if index is not None:
+                    index.add(query, embedding, entry.created_at)
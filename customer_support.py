@@ -1,82 +1,473 @@
-from typing import Optional, List, Tuple
+import asyncio
+import contextlib
+import os
+import queue
+import threading
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, Iterator, Optional, List, Tuple, Union, TYPE_CHECKING
 
-from langchain.chat_models import ChatOpenAI
+from langchain.schema.embeddings import Embeddings
 
 from agents.support import UserInfoChainBasedEdge, AuthenticatedUserNode, GreetingNode, \
-    CallCustomerEdge, CallCustomerNode
+    CallCustomerEdge, CallCustomerNode, CALL_REQUEST_EXTRACTORS, USER_LOOKUP_EXTRACTORS
+from cache.completion_cache import CompletionCache
+from cache.embedding_cache import CachedEmbeddings, LazyEmbeddings
+from cache.response_cache import ResponseCache, SQLiteBackend
 from data.chat import MessageHistory, Role
-from data.graph import MessageOutput, EdgeOutput
+from data.graph import (
+    ConversationState,
+    MessageOutput,
+    EdgeOutput,
+    StreamEvent,
+    StreamEventType,
+)
+from data.history import HistoryPolicy
+from data.tracing import SpanKind
 from data.validation import UserProfile, PhoneCallTicket
+from graph.callbacks import use_callbacks
+from graph.completion_cache import use_completion_cache
+from graph.conversation import ConversationGraph
+from graph.lazy_edge import LazyEdge
 from graph.node import BaseNode
+from graph.shared import shared
+from graph.speculation import SpeculationStats
+from graph.streaming import StreamingHandler
+from graph.tracing import Tracer, trace, use_tracer
+from session.store import SessionRecord, SessionStore
+from tools.ingest import EMBEDDING_CACHE_FILE
+
+if TYPE_CHECKING:
+    from tools.rag_responder import HelpCenterAgent
+
+EMBEDDING_MODEL = "all-MiniLM-L6-v2"
+
+
+def sentence_transformer() -> Embeddings:
+    from langchain.embeddings import SentenceTransformerEmbeddings
+
+    return SentenceTransformerEmbeddings(model_name=EMBEDDING_MODEL)
+
+
+def warm_up_executor() -> ThreadPoolExecutor:
+    """Background worker building the nodes the conversations are likely to
+    reach next, one at a time so the turns keep the cpu"""
+    return shared(
+        (ThreadPoolExecutor, "warm_up"),
+        lambda: ThreadPoolExecutor(max_workers=1, thread_name_prefix="warm_up"),
+    )
+
+
+class SupportGraphBuilder:
+
+    """Builds the support graph, only the greeting node up front. The rest of
+    the graph, and the llm stack, retrievers and agents it loads, is built the
+    first time the user info edge is needed, usually by the background warm up
+    while the user is typing their email."""
+
+    def __init__(
+        self,
+        llm_model,
+        embeddings: Embeddings,
+        persist_root: str,
+        response_cache_file: Optional[str],
+        pre_extraction: bool,
+        speculative_fallback: bool = False,
+    ):
+        """
+        llm_model (LangChain chat model): None for gpt-3.5-turbo through the
+            process wide LLMClientPool
+        embeddings (Embeddings): of the help center and the response cache
+        persist_root (str): where the knowledge bases are stored
+        response_cache_file (str): response cache database, None disables it
+        pre_extraction (bool): see CustomerSupportPipeline
+        speculative_fallback (bool): see CustomerSupportPipeline
+        """
+        self._llm_model = llm_model
+        self._embeddings = embeddings
+        self._persist_root = persist_root
+        self._response_cache_file = response_cache_file
+        self._pre_extraction = pre_extraction
+        self._speculative_fallback = speculative_fallback
+
+    def build(self) -> ConversationGraph:
+        start_node = GreetingNode(edges=[LazyEdge(self._user_info_edge)])
+        return ConversationGraph(start_node)
+
+    def _llm(self):
+        if self._llm_model is None:
+            from llm.client_pool import default_pool
+
+            #gpt-3.5-turbo
+            self._llm_model = default_pool().chat_model(
+                "gpt-3.5-turbo", temperature=0, streaming=True
+            )
+        return self._llm_model
+
+    def _user_info_edge(self) -> UserInfoChainBasedEdge:
+        llm_model = self._llm()
+        call_customer_node = CallCustomerNode(llm_model=llm_model,
+                                              pydantic_object=PhoneCallTicket,
+                                              edges=[],
+                                              final_state=True)
+        call_customer_edge = CallCustomerEdge(
+            llm_model=llm_model,
+            out_node=call_customer_node,
+            combined=True,
+            pre_extractors=CALL_REQUEST_EXTRACTORS if self._pre_extraction else None,
+        )
+
+        help_node = AuthenticatedUserNode(
+            llm_model=llm_model,
+            pydantic_object=None,
+            edges=[call_customer_edge],
+            response_cache=self._response_cache(),
+            deterministic_routing=True,
+            help_center_agent=self._help_center_agent,
+            speculative_fallback=self._speculative_fallback,
+        )
+
+        return UserInfoChainBasedEdge(
+            model=llm_model,
+            pydantic_object=UserProfile,
+            out_node=help_node,
+            pre_extractors=USER_LOOKUP_EXTRACTORS if self._pre_extraction else None,
+        )
+
+    def _help_center_agent(self) -> "HelpCenterAgent":
+        from tools.rag_responder import HelpCenterAgent
+
+        return shared(
+            (HelpCenterAgent, id(self._embeddings), self._persist_root),
+            lambda: HelpCenterAgent(
+                embeddings=self._embeddings, persist_root=self._persist_root
+            ),
+        )
+
+    def _response_cache(self) -> Optional[ResponseCache]:
+        if self._response_cache_file is None:
+            return None
+        os.makedirs(self._persist_root, exist_ok=True)
+        return ResponseCache(
+            embeddings=self._embeddings,
+            backend=SQLiteBackend(self._response_cache_file),
+        )
 
 
 class CustomerSupportPipeline:
+    RESPONSE_CACHE_FILE = "response_cache.sqlite3"
+    COMPLETION_CACHE_FILE = "completion_cache.sqlite3"
 
-    def __init__(self):
-        #gpt-3.5-turbo
-        self._llm_model = ChatOpenAI(temperature=0, model_name="gpt-3.5-turbo")
-        self._message_history = MessageHistory([])
-        self._current_node = None
+    def __init__(
+        self,
+        history_policy: Optional[HistoryPolicy] = None,
+        llm_model=None,
+        embeddings: Optional[Embeddings] = None,
+        persist_root: str = "chroma_db",
+        response_cache: bool = True,
+        embedding_cache: bool = True,
+        completion_cache: bool = True,
+        persist_completions: bool = False,
+        pre_extraction: bool = True,
+        messages: Optional[List[dict]] = None,
+        tracer: Optional[Tracer] = None,
+        session_store: Optional[SessionStore] = None,
+        session_id: Optional[str] = None,
+        warm_up: bool = True,
+        speculative_fallback: bool = False,
+    ):
+        """
+        history_policy (HistoryPolicy): how much history goes into the prompts
+        llm_model (LangChain chat model): defaults to gpt-3.5-turbo through the
+            process wide LLMClientPool, created when first needed
+        embeddings (Embeddings): defaults to the all-MiniLM-L6-v2 sentence
+            transformer, loaded when first needed
+        persist_root (str): where the knowledge bases and the caches are stored
+        response_cache (bool): answer repeated help center questions from cache
+        embedding_cache (bool): cache the query and document embeddings on disk
+        completion_cache (bool): replay the temperature 0 completions of the
+            graph chains instead of calling the llm again, kept in memory
+        persist_completions (bool): also keep the completions on disk, in
+            `{persist_root}/completion_cache.sqlite3`, so they survive restarts.
+            The prompts hold the profile of the authenticated user, name,
+            email and phone number, only enable it for test and replay runs
+        pre_extraction (bool): resolve the email lookups and the explicit call
+            requests with rules, the llm is only called when they do not match
+        messages (list): earlier messages the conversation carries over
+        tracer (Tracer): records a span tree of every turn
+        session_store (SessionStore): saves the conversation after every turn
+        session_id (str): conversation to resume from `session_store`, a new
+            conversation is started when it is not found
+        warm_up (bool): build the nodes the conversation can reach next in a
+            background thread while the user is typing
+        speculative_fallback (bool): start answering a help center question
+            while the call request edge is checked, the answer is thrown away
+            when it continues
+        """
+        embeddings = embeddings or shared(
+            (LazyEmbeddings, EMBEDDING_MODEL),
+            lambda: LazyEmbeddings(
+                sentence_transformer,
+                model_id=f"SentenceTransformerEmbeddings:{EMBEDDING_MODEL}",
+            ),
+        )
+        self._base_embeddings = embeddings
+        if embedding_cache:
+            # repeated queries and rebuilt collections skip the embedding model
+            embeddings = shared(
+                (CachedEmbeddings, id(embeddings), persist_root),
+                lambda: CachedEmbeddings(
+                    embeddings, path=f"{persist_root}/{EMBEDDING_CACHE_FILE}"
+                ),
+            )
+        self._persist_root = persist_root
+        self._completion_cache = (
+            shared(
+                (CompletionCache, persist_root, persist_completions),
+                lambda: self._get_completion_cache(persist_completions),
+            )
+            if completion_cache
+            else None
+        )
+
+        # the graph is shared by every conversation, the conversation itself
+        # only owns its message history and state
+        self._graph = shared(
+            (
+                ConversationGraph,
+                id(llm_model),
+                id(embeddings),
+                persist_root,
+                response_cache,
+                pre_extraction,
+                speculative_fallback,
+            ),
+            SupportGraphBuilder(
+                llm_model,
+                embeddings,
+                persist_root,
+                response_cache_file=(
+                    f"{persist_root}/{self.RESPONSE_CACHE_FILE}" if response_cache else None
+                ),
+                pre_extraction=pre_extraction,
+                speculative_fallback=speculative_fallback,
+            ).build,
+        )
+        self._message_history = MessageHistory(
+            list(messages or []), policy=history_policy
+        )
+        self._state = ConversationState()
+        self._tracer = tracer
+        self._warm_up = warm_up
+        self._warm_up_task: Optional[Future] = None
+
+        self._session_store = session_store
+        self.session_id = session_id or uuid.uuid4().hex
+        if session_store is not None:
+            record = session_store.load(self.session_id)
+            if record is not None:
+                self._resume(record, history_policy)
+        if self._current_node is not None:
+            self._start_warm_up(self._current_node)
+
+    def _get_completion_cache(self, persistent: bool) -> CompletionCache:
+        if not persistent:
+            return CompletionCache()
+        os.makedirs(self._persist_root, exist_ok=True)
+        return CompletionCache(
+            backend=SQLiteBackend(
+                f"{self._persist_root}/{self.COMPLETION_CACHE_FILE}"
+            )
+        )
+
+    def _resume(self, record: SessionRecord, history_policy: Optional[HistoryPolicy]):
+        self._message_history = MessageHistory(record.messages, policy=history_policy)
+        self._state = ConversationState(
+            current_node=record.current_node,
+            node_inputs=record.node_inputs,
+            num_fails=record.num_fails,
+        )
+
+    def _save_session(self):
+        if self._session_store is None:
+            return
+        self._session_store.save(
+            SessionRecord(
+                session_id=self.session_id,
+                messages=self._message_history.messages,
+                current_node=self._state.current_node,
+                node_inputs=dict(self._state.node_inputs),
+                num_fails=dict(self._state.num_fails),
+            )
+        )
 
-    def _get_pipeline(self) -> BaseNode:
-        self._call_customer_node = CallCustomerNode(llm_model=self._llm_model,
-                                                    pydantic_object=PhoneCallTicket,
-                                                    edges=[],
-                                                    final_state=True)
-        self._call_customer_edge = CallCustomerEdge(llm_model=self._llm_model, out_node=self._call_customer_node)
+    @property
+    def messages(self) -> List[dict]:
+        """Every message of the conversation so far"""
+        return list(self._message_history.messages)
 
-        self._help_node = AuthenticatedUserNode(llm_model=self._llm_model,
-                                                pydantic_object=None,
-                                                edges=[self._call_customer_edge])
+    def static_prompt_tokens(self) -> Dict[str, Dict[str, int]]:
+        """Tokens of the static prompt prefixes of the graph edges, shared by
+        every call through the provider prompt cache"""
+        return self._graph.static_prompt_tokens()
 
-        self._user_info_chain = UserInfoChainBasedEdge(model=self._llm_model,
-                                                       pydantic_object=UserProfile,
-                                                       out_node=self._help_node)
+    def speculation_stats(self) -> Dict[str, SpeculationStats]:
+        """Speculative fallbacks of the graph nodes, shared by every
+        conversation, used and wasted, by node id"""
+        return self._graph.speculation_stats()
 
-        self._start_node = GreetingNode(edges=[self._user_info_chain])
-        return self._start_node
+    @property
+    def current_node_id(self) -> Optional[str]:
+        return self._state.current_node
+
+    @property
+    def _current_node(self) -> Optional[BaseNode]:
+        if self._state.current_node is None:
+            return None
+        return self._graph.node(self._state.current_node)
+
+    def _start_warm_up(self, node: BaseNode):
+        """Builds what the turns following `node` need in the background, the
+        user takes seconds to answer and the first build takes as long"""
+        if self._warm_up:
+            self._warm_up_task = warm_up_executor().submit(self._warm_up_next, node)
+
+    def _warm_up_next(self, node: BaseNode):
+        node.warm_up_next()
+        if isinstance(self._base_embeddings, LazyEmbeddings):
+            self._base_embeddings.warm_up()
+
+    def wait_for_warm_up(self, timeout: Optional[float] = None):
+        """Blocks until the background warm up started by the last turn is
+        done, raising its error if it failed"""
+        if self._warm_up_task is not None:
+            self._warm_up_task.result(timeout)
 
     def _set_current_node(self, node: BaseNode) -> MessageOutput:
-        self._current_node = node
-        return node.greeting_message()
+        self._state.current_node = node.node_id
+        greeting = node.greeting_message(self._state)
+        self._start_warm_up(node)
+        return greeting
 
-    def run(self, user_input: Optional[str]) -> Tuple[List[MessageOutput], bool]:
+    async def _aset_current_node(self, node: BaseNode) -> MessageOutput:
+        self._state.current_node = node.node_id
+        greeting = await node.agreeting_message(self._state)
+        self._start_warm_up(node)
+        return greeting
+
+    def _add_user_input(self, user_input: Optional[str]):
         if user_input is not None and user_input != "":
             self._message_history.add_user_message(content=user_input)
 
+    def _start(self, greeting: MessageOutput) -> Tuple[List[MessageOutput], bool]:
+        self._message_history.add_message(content=greeting.message, role=greeting.role)
+        return [greeting], self._current_node.is_node_final()
+
+    def _record_output(
+        self,
+        output: Union[EdgeOutput, MessageOutput, None],
+        assistant_output: List[MessageOutput],
+    ) -> Optional[BaseNode]:
+        """Adds the node output to the history, returns the next node if any"""
+        if isinstance(output, EdgeOutput):
+            if output.message_output is not None:
+                for msg_output in output.message_output:
+                    self._record_message(msg_output, assistant_output)
+            return output.next_node
+
+        elif isinstance(output, MessageOutput):
+            self._record_message(output, assistant_output)
+
+        return None
+
+    def _record_message(
+        self, output: Optional[MessageOutput], assistant_output: List[MessageOutput]
+    ):
+        if output is None:
+            return
+        self._message_history.add_message(content=output.message, role=output.role)
+        if output.role == Role.ASSISTANT:
+            assistant_output.append(output)
+
+    @contextlib.contextmanager
+    def _turn(self):
+        with use_tracer(self._tracer), use_completion_cache(self._completion_cache):
+            with trace("turn", SpanKind.TURN, node=self._state.current_node):
+                yield
+
+    def run(self, user_input: Optional[str]) -> Tuple[List[MessageOutput], bool]:
+        with self._turn():
+            output = self._run(user_input)
+        self._save_session()
+        return output
+
+    def _run(self, user_input: Optional[str]) -> Tuple[List[MessageOutput], bool]:
+        self._add_user_input(user_input)
+
+        if self._current_node is None:
+            return self._start(self._set_current_node(self._graph.start_node))
+
         assistant_output: List[MessageOutput] = []
+        output = self._current_node.execute(self._message_history, self._state)
+        next_node = self._record_output(output, assistant_output)
+        if next_node is not None:
+            node_output = self._set_current_node(next_node)
+            self._record_message(node_output, assistant_output)
+
+        return assistant_output, self._current_node.is_node_final()
+
+    async def arun(self, user_input: Optional[str]) -> Tuple[List[MessageOutput], bool]:
+        """Async version of `run`, llm calls are awaited instead of blocking
+        so a single event loop can drive many conversations concurrently"""
+        with self._turn():
+            output = await self._arun(user_input)
+        await asyncio.to_thread(self._save_session)
+        return output
+
+    async def _arun(self, user_input: Optional[str]) -> Tuple[List[MessageOutput], bool]:
+        self._add_user_input(user_input)
 
         if self._current_node is None:
-            greeting = self._set_current_node(self._get_pipeline())
-            self._message_history.add_message(
-                content=greeting.message,
-                role=greeting.role
-            )
-            return [greeting], self._current_node.is_node_final()
-
-        else:
-            output = self._current_node.execute(self._message_history)
-            if isinstance(output, EdgeOutput):
-                if output.message_output is not None:
-                    for msg_output in output.message_output:
-                        self._message_history.add_message(content=msg_output.message, role=msg_output.role)
-                        if msg_output.role == Role.ASSISTANT:
-                            assistant_output.append(msg_output)
-
-                if output.next_node is not None:
-                    node_output = self._set_current_node(output.next_node)
-                    if isinstance(node_output, MessageOutput):
-                        self._message_history.add_assistant_message(content=node_output.message)
-
-                    if node_output.role == Role.ASSISTANT:
-                        assistant_output.append(node_output)
-
-            elif isinstance(output, MessageOutput):
-                self._message_history.add_message(content=output.message, role=output.role)
-                if output.role == Role.ASSISTANT:
-                    assistant_output.append(output)
-
-            return assistant_output, self._current_node.is_node_final()
+            return self._start(await self._aset_current_node(self._graph.start_node))
+
+        assistant_output: List[MessageOutput] = []
+        output = await self._current_node.aexecute(self._message_history, self._state)
+        next_node = self._record_output(output, assistant_output)
+        if next_node is not None:
+            node_output = await self._aset_current_node(next_node)
+            self._record_message(node_output, assistant_output)
+
+        return assistant_output, self._current_node.is_node_final()
+
+    def stream(self, user_input: Optional[str]) -> Iterator[StreamEvent]:
+        """Runs the turn like `run`, yielding the answer tokens and the tool and
+        retrieval events as they happen, then one MESSAGE event per assistant
+        message and a final DONE event"""
+        events: "queue.Queue[StreamEvent]" = queue.Queue()
+        outcome = {}
+
+        def run_turn():
+            try:
+                with use_callbacks([StreamingHandler(events)]):
+                    outcome["result"] = self.run(user_input)
+            except Exception as e:
+                outcome["error"] = e
+            finally:
+                events.put(None)
+
+        worker = threading.Thread(target=run_turn, daemon=True)
+        worker.start()
+        while (event := events.get()) is not None:
+            yield event
+        worker.join()
+
+        if "error" in outcome:
+            raise outcome["error"]
+
+        assistant_output, is_over = outcome["result"]
+        for message in assistant_output:
+            yield StreamEvent(StreamEventType.MESSAGE, message=message)
+        yield StreamEvent(StreamEventType.DONE, is_over=is_over)
 
 
 if __name__ == "__main__":
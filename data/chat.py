@@ -2,7 +2,9 @@ import dataclasses
 import json
 
 from enum import Enum
-from typing import List
+from typing import Dict, List, Optional
+
+from data.history import HistoryPolicy, count_tokens
 
 
 class Role(str, Enum):
@@ -18,48 +20,107 @@ class Role(str, Enum):
 class ModelInput:
     input: str
     history: str
+    # how many history tokens the history policy left out of the prompt
+    tokens_saved: int = 0
 
 
 @dataclasses.dataclass
 class MessageHistory:
+    """Conversation messages, new messages must be added with the add_*
+    methods so the rendered transcript and the role indexes stay in sync"""
+
     messages: List[dict]
+    policy: Optional[HistoryPolicy] = dataclasses.field(
+        default=None, repr=False, compare=False
+    )
+
+    # incrementally maintained views over `messages`
+    _by_role: Dict[str, List[dict]] = dataclasses.field(
+        default_factory=dict, init=False, repr=False, compare=False
+    )
+    _transcript: str = dataclasses.field(
+        default="", init=False, repr=False, compare=False
+    )
+    _previous_transcript: str = dataclasses.field(
+        default="", init=False, repr=False, compare=False
+    )
+    _rendered: List[str] = dataclasses.field(
+        default_factory=list, init=False, repr=False, compare=False
+    )
+    _tokens: List[int] = dataclasses.field(
+        default_factory=list, init=False, repr=False, compare=False
+    )
+
+    def __post_init__(self):
+        messages, self.messages = self.messages, []
+        for msg in messages:
+            self._append(msg)
 
     def __str__(self):
-        history = ""
-        for msg in self.messages:
-            history += f"\n{msg['role']}: {msg['content']}"
-        return history
+        return self._transcript
+
+    @staticmethod
+    def _render(msg: dict) -> str:
+        return f"\n{msg['role']}: {msg['content']}"
+
+    def _append(self, msg: dict):
+        self.messages.append(msg)
+        self._by_role.setdefault(str(msg["role"]), []).append(msg)
+        rendered = self._render(msg)
+        self._rendered.append(rendered)
+        self._previous_transcript = self._transcript
+        self._transcript += rendered
+
+    def history_without_last(self) -> str:
+        """The rendered transcript without the last message"""
+        return self._previous_transcript
+
+    def rendered_messages(self) -> List[str]:
+        """Every message rendered as it appears in the transcript"""
+        return self._rendered
+
+    def message_tokens(self) -> List[int]:
+        """Token count of every rendered message, each message is only counted once"""
+        for rendered in self._rendered[len(self._tokens) :]:
+            self._tokens.append(count_tokens(rendered))
+        return self._tokens
+
+    def last_message(self, role: Role) -> Optional[dict]:
+        messages = self._by_role.get(str(role))
+        return messages[-1] if messages else None
+
+    def last_user_message(self) -> Optional[dict]:
+        return self.last_message(Role.USER)
 
     def model_input(self) -> ModelInput:
-        history = ""
-        for msg in self.messages[:-1]:
-            history += f"\n{msg['role']}: {msg['content']}"
+        last_msg = self.last_user_message()
+        user_input = self._render(last_msg)
 
-        user_messages = self.role_based_history(role=Role.USER)
-        last_msg = user_messages[-1]
-        user_input = f"\n{last_msg['role']}: {last_msg['content']}"
+        if self.policy is None:
+            return ModelInput(input=user_input, history=self.history_without_last())
 
-        return ModelInput(input=user_input, history=history)
+        history = self.policy.window(self)
+        tokens_saved = 0
+        if len(history) < len(self._previous_transcript):
+            full_tokens = sum(self.message_tokens()[:-1])
+            tokens_saved = max(full_tokens - count_tokens(history), 0)
+        return ModelInput(input=user_input, history=history, tokens_saved=tokens_saved)
 
     def role_based_history(self, role: Role):
-        history = []
-        for msg in self.messages:
-            if msg["role"] == role:
-                history.append(msg)
-        return history
+        return list(self._by_role.get(str(role), []))
 
     @classmethod
     def _message_dict(self, content: str, role: Role):
         return {"content": content, "role": role.value}
 
     def add_system_message(self, content: str):
-        self.messages.append(self._message_dict(content=content, role=Role.SYSTEM))
+        self._append(self._message_dict(content=content, role=Role.SYSTEM))
 
     def add_user_message(self, content: str):
-        self.messages.append(self._message_dict(content=content, role=Role.USER))
+        self._append(self._message_dict(content=content, role=Role.USER))
 
     def add_assistant_message(self, content: str):
-        self.messages.append(self._message_dict(content=content, role=Role.ASSISTANT))
+        self._append(self._message_dict(content=content, role=Role.ASSISTANT))
 
     def add_message(self, content: str, role: Role):
-        self.messages.append(self._message_dict(content=content, role=role))
+        self._append(self._message_dict(content=content, role=role))
@@ -1,7 +1,7 @@
 import dataclasses
+from enum import Enum
 
-
-from typing import Union, Optional, List
+from typing import Any, Dict, Union, Optional, List
 from pydantic import BaseModel
 
 from data.chat import Role
@@ -20,3 +20,40 @@ class EdgeOutput:
     message_output: Optional[List[MessageOutput]]
     num_fails: int
     next_node: "BaseNode"
+
+
+class StreamEventType(str, Enum):
+    TOKEN = "token"
+    TOOL_START = "tool_start"
+    TOOL_END = "tool_end"
+    RETRIEVER_START = "retriever_start"
+    RETRIEVER_END = "retriever_end"
+    MESSAGE = "message"
+    DONE = "done"
+
+    def __str__(self):
+        return str(self.value)
+
+
+@dataclasses.dataclass
+class StreamEvent:
+    type: StreamEventType
+    # the token, tool name or retrieval query
+    content: str = ""
+    # the complete message, for MESSAGE events
+    message: Optional[MessageOutput] = None
+    # if the conversation is over, for DONE events
+    is_over: bool = False
+
+
+@dataclasses.dataclass
+class ConversationState:
+    """Everything a conversation changes while it runs through the graph,
+    nodes and edges are shared between conversations and only read it"""
+
+    # id of the node the conversation is at, None before the greeting
+    current_node: Optional[str] = None
+    # inputs handed to the nodes by the edges leading to them, by node id
+    node_inputs: Dict[str, Any] = dataclasses.field(default_factory=dict)
+    # failed attempts of every edge, by edge id
+    num_fails: Dict[str, int] = dataclasses.field(default_factory=dict)
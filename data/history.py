@@ -0,0 +1,117 @@
+import abc
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, List, Optional, TYPE_CHECKING
+
+try:
+    import tiktoken
+
+    _ENCODING = tiktoken.get_encoding("cl100k_base")
+except ImportError:
+    _ENCODING = None
+
+if TYPE_CHECKING:
+    from data.chat import MessageHistory
+
+
+def count_tokens(text: str) -> int:
+    """Counts tokens with the local tiktoken encoding, falls back to the
+    ~4 characters per token rule of thumb when tiktoken is not installed"""
+    if _ENCODING is not None:
+        return len(_ENCODING.encode(text))
+    return (len(text) + 3) // 4
+
+
+class HistoryPolicy(abc.ABC):
+
+    """Decides which part of the conversation history goes into the prompts"""
+
+    @abc.abstractmethod
+    def window(self, history: "MessageHistory") -> str:
+        """Rendered history, without the last message, to be sent to the model"""
+        pass
+
+
+class FullHistory(HistoryPolicy):
+    def window(self, history: "MessageHistory") -> str:
+        return history.history_without_last()
+
+
+class LastMessages(HistoryPolicy):
+    def __init__(self, max_messages: int):
+        self._max_messages = max_messages
+
+    def window(self, history: "MessageHistory") -> str:
+        lines = history.rendered_messages()[:-1]
+        return "".join(lines[-self._max_messages :]) if self._max_messages else ""
+
+
+class TokenBudget(HistoryPolicy):
+
+    """Keeps the most recent messages that fit in `max_tokens`"""
+
+    def __init__(self, max_tokens: int):
+        self._max_tokens = max_tokens
+
+    def window(self, history: "MessageHistory") -> str:
+        lines = history.rendered_messages()[:-1]
+        tokens = history.message_tokens()[:-1]
+
+        budget = self._max_tokens
+        start = len(lines)
+        while start > 0 and tokens[start - 1] <= budget:
+            budget -= tokens[start - 1]
+            start -= 1
+        return "".join(lines[start:])
+
+
+class RollingSummary(HistoryPolicy):
+
+    """Keeps the last `keep_last` messages verbatim and replaces the older ones
+    with a summary. The summary is refreshed on a background thread, until it
+    catches up the messages it does not cover yet are sent verbatim.
+
+    The policy holds the summary, use one instance per MessageHistory.
+    """
+
+    _executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="RollingSummary")
+
+    def __init__(self, summarize: Callable[[str, str], str], keep_last: int = 6):
+        """
+        summarize (Callable): receives the current summary and the new messages
+            to fold in, returns the updated summary
+        keep_last (int): how many of the most recent messages are kept verbatim
+        """
+        self._summarize = summarize
+        self._keep_last = keep_last
+        self._summary = ""
+        self._summarized = 0
+        self._pending: Optional[Future] = None
+        self._lock = threading.Lock()
+
+    def window(self, history: "MessageHistory") -> str:
+        lines = history.rendered_messages()[:-1]
+        self._refresh(lines)
+
+        with self._lock:
+            summary, summarized = self._summary, self._summarized
+
+        prefix = f"\nSummary of the earlier conversation: {summary}" if summary else ""
+        return prefix + "".join(lines[summarized:])
+
+    def _refresh(self, lines: List[str]):
+        cut = max(len(lines) - self._keep_last, 0)
+        with self._lock:
+            if cut <= self._summarized:
+                return
+            if self._pending is not None and not self._pending.done():
+                return
+            self._pending = self._executor.submit(
+                self._fold, self._summary, "".join(lines[self._summarized : cut]), cut
+            )
+
+    def _fold(self, summary: str, new_lines: str, summarized: int):
+        updated = self._summarize(summary, new_lines)
+        with self._lock:
+            self._summary = updated
+            self._summarized = summarized
@@ -0,0 +1,47 @@
+import dataclasses
+from enum import Enum
+
+from typing import Any, Dict, Optional
+
+
+class SpanKind(str, Enum):
+    TURN = "turn"
+    NODE = "node"
+    EDGE = "edge"
+    CHAIN = "chain"
+    LLM = "llm"
+    TOOL = "tool"
+    RETRIEVER = "retriever"
+
+    def __str__(self):
+        return str(self.value)
+
+
+@dataclasses.dataclass
+class Span:
+    """One timed operation of a conversation turn, spans of the same turn
+    share the trace id and point to the span they ran under"""
+
+    name: str
+    kind: SpanKind
+    trace_id: str
+    span_id: str
+    parent_id: Optional[str]
+    # wall clock, in nanoseconds since the epoch
+    start_ns: int
+    end_ns: Optional[int] = None
+    # token counts, retries, cache hits, ...
+    attributes: Dict[str, Any] = dataclasses.field(default_factory=dict)
+    error: Optional[str] = None
+
+    @property
+    def duration_ms(self) -> Optional[float]:
+        if self.end_ns is None:
+            return None
+        return (self.end_ns - self.start_ns) / 1e6
+
+    def to_dict(self) -> Dict[str, Any]:
+        span = dataclasses.asdict(self)
+        span["kind"] = str(self.kind)
+        span["duration_ms"] = self.duration_ms
+        return span
@@ -1,10 +1,28 @@
-from pydantic import BaseModel, Field
+from typing import Optional, Type
+
+from pydantic import BaseModel, Field, create_model
 
 
 class Validation(BaseModel):
     is_valid: bool = Field(description="if the condition is satisfied")
 
 
+def validated_model(parse_class: Type[BaseModel]) -> Type[BaseModel]:
+    """Wraps `parse_class` with the `Validation` flag so the check and the
+    extraction can be answered by a single completion"""
+    return create_model(
+        f"Validated{parse_class.__name__}",
+        is_valid=(bool, Field(description="if the condition is satisfied")),
+        result=(
+            Optional[parse_class],
+            Field(
+                default=None,
+                description="the extracted information, only when the condition is satisfied",
+            ),
+        ),
+    )
+
+
 class UserProfile(BaseModel):
     name: str = Field(description="User name")
     email: str = Field(description="User email")
@@ -0,0 +1,131 @@
+import asyncio
+from typing import Any, Dict, List, Optional
+
+from langchain.callbacks.manager import (
+    AsyncCallbackManagerForChainRun,
+    CallbackManagerForChainRun,
+)
+from langchain.chains import LLMChain
+from langchain.schema import LLMResult, PromptValue
+from langchain.schema.language_model import BaseLanguageModel
+
+from cache.completion_cache import CompletionCache, is_deterministic, llm_key
+from data.history import count_tokens
+from graph.completion_cache import get_completion_cache
+from graph.prompts import CompiledPromptTemplate
+from graph.tracing import get_tracer, increment_attributes
+
+
+class CachedLLMChain(LLMChain):
+
+    """LLMChain whose temperature 0 completions are looked up in the
+    completion cache of the turn before the llm is called. A hit sends no
+    llm events, the span of the node or edge counts the hits and misses and,
+    for compiled prompts, the static and dynamic prompt tokens."""
+
+    def _trace_prompt_tokens(self, prompts: List[PromptValue]):
+        if get_tracer() is None or not isinstance(self.prompt, CompiledPromptTemplate):
+            return
+        static_length = len(self.prompt.static_prefix)
+        increment_attributes(
+            static_prompt_tokens=self.prompt.static_tokens * len(prompts),
+            dynamic_prompt_tokens=sum(
+                count_tokens(prompt.to_string()[static_length:]) for prompt in prompts
+            ),
+        )
+
+    def prep_prompts(self, input_list, run_manager=None):
+        prompts, stop = super().prep_prompts(input_list, run_manager=run_manager)
+        self._trace_prompt_tokens(prompts)
+        return prompts, stop
+
+    async def aprep_prompts(self, input_list, run_manager=None):
+        prompts, stop = await super().aprep_prompts(input_list, run_manager=run_manager)
+        self._trace_prompt_tokens(prompts)
+        return prompts, stop
+
+    def _cache(self) -> Optional[CompletionCache]:
+        cache = get_completion_cache()
+        if cache is None or not isinstance(self.llm, BaseLanguageModel):
+            return None
+        if not is_deterministic(self.llm):
+            return None
+        return cache
+
+    @staticmethod
+    def _merge(cached: List[Optional[list]], result: Optional[LLMResult]) -> LLMResult:
+        generations = iter(result.generations if result is not None else [])
+        return LLMResult(
+            generations=[
+                found if found is not None else next(generations) for found in cached
+            ],
+            llm_output=result.llm_output if result is not None else None,
+        )
+
+    def generate(
+        self,
+        input_list: List[Dict[str, Any]],
+        run_manager: Optional[CallbackManagerForChainRun] = None,
+    ) -> LLMResult:
+        cache = self._cache()
+        if cache is None:
+            return super().generate(input_list, run_manager=run_manager)
+
+        prompts, stop = self.prep_prompts(input_list, run_manager=run_manager)
+        key = llm_key(self.llm, stop, **self.llm_kwargs)
+        rendered = [prompt.to_string() for prompt in prompts]
+        cached = cache.get(key, rendered)
+        missing = [i for i, found in enumerate(cached) if found is None]
+        increment_attributes(
+            completion_cache_hits=len(cached) - len(missing),
+            completion_cache_misses=len(missing),
+        )
+
+        result = None
+        if missing:
+            result = self.llm.generate_prompt(
+                [prompts[i] for i in missing],
+                stop,
+                callbacks=run_manager.get_child() if run_manager else None,
+                **self.llm_kwargs,
+            )
+            for i, generations in zip(missing, result.generations):
+                cache.put(key, rendered[i], generations)
+        return self._merge(cached, result)
+
+    async def agenerate(
+        self,
+        input_list: List[Dict[str, Any]],
+        run_manager: Optional[AsyncCallbackManagerForChainRun] = None,
+    ) -> LLMResult:
+        cache = self._cache()
+        if cache is None:
+            return await super().agenerate(input_list, run_manager=run_manager)
+
+        prompts, stop = await self.aprep_prompts(input_list, run_manager=run_manager)
+        key = llm_key(self.llm, stop, **self.llm_kwargs)
+        rendered = [prompt.to_string() for prompt in prompts]
+        if cache.persistent:
+            cached = await asyncio.to_thread(cache.get, key, rendered)
+        else:
+            cached = cache.get(key, rendered)
+        missing = [i for i, found in enumerate(cached) if found is None]
+        increment_attributes(
+            completion_cache_hits=len(cached) - len(missing),
+            completion_cache_misses=len(missing),
+        )
+
+        result = None
+        if missing:
+            result = await self.llm.agenerate_prompt(
+                [prompts[i] for i in missing],
+                stop,
+                callbacks=run_manager.get_child() if run_manager else None,
+                **self.llm_kwargs,
+            )
+            for i, generations in zip(missing, result.generations):
+                if cache.persistent:
+                    await asyncio.to_thread(cache.put, key, rendered[i], generations)
+                else:
+                    cache.put(key, rendered[i], generations)
+        return self._merge(cached, result)
@@ -0,0 +1,119 @@
+import contextlib
+import contextvars
+import threading
+from typing import Any, List, Optional, Tuple
+
+from langchain.callbacks.base import BaseCallbackHandler
+
+# tags the llm calls whose output is shown to the user as it is generated
+STREAM_TAG = "stream_to_user"
+
+# callback handlers of the conversation turn being executed, nodes and edges
+# are shared between conversations so they are scoped to the running context
+_callbacks: contextvars.ContextVar[Optional[List[BaseCallbackHandler]]] = (
+    contextvars.ContextVar("graph_callbacks", default=None)
+)
+
+
+def get_callbacks() -> Optional[List[BaseCallbackHandler]]:
+    """Handlers every chain, agent and llm call of the turn should report to"""
+    return _callbacks.get()
+
+
+@contextlib.contextmanager
+def use_callbacks(handlers: List[BaseCallbackHandler]):
+    """Adds `handlers` to every llm call made inside the block, including the
+    ones made by tasks and worker threads started from it"""
+    token = _callbacks.set((get_callbacks() or []) + list(handlers))
+    try:
+        yield
+    finally:
+        _callbacks.reset(token)
+
+
+class HeldCallbackHandler(BaseCallbackHandler):
+
+    """Holds back the events of `handler` until it is known whether the work
+    reporting them is kept, `release` replays them and forwards the next
+    ones, `discard` drops them all"""
+
+    def __init__(self, handler: BaseCallbackHandler):
+        self.handler = handler
+        self._events: List[Tuple[str, tuple, dict]] = []
+        self._released = False
+        self._discarded = False
+        self._lock = threading.Lock()
+
+    def _handle(self, event: str, args: tuple, kwargs: dict):
+        with self._lock:
+            if self._discarded:
+                return
+            if not self._released:
+                self._events.append((event, args, kwargs))
+                return
+        getattr(self.handler, event)(*args, **kwargs)
+
+    def release(self):
+        with self._lock:
+            events, self._events = self._events, []
+            self._released = True
+            for event, args, kwargs in events:
+                getattr(self.handler, event)(*args, **kwargs)
+
+    def discard(self):
+        with self._lock:
+            self._events = []
+            self._discarded = True
+
+    @property
+    def ignore_llm(self) -> bool:
+        return self.handler.ignore_llm
+
+    @property
+    def ignore_chain(self) -> bool:
+        return self.handler.ignore_chain
+
+    @property
+    def ignore_agent(self) -> bool:
+        return self.handler.ignore_agent
+
+    @property
+    def ignore_retriever(self) -> bool:
+        return self.handler.ignore_retriever
+
+    @property
+    def ignore_chat_model(self) -> bool:
+        return self.handler.ignore_chat_model
+
+
+def _held_event(event: str):
+    def handle(self: HeldCallbackHandler, *args: Any, **kwargs: Any):
+        self._handle(event, args, kwargs)
+
+    handle.__name__ = event
+    return handle
+
+
+# every event is recorded or forwarded the same way
+for _event in [name for name in dir(BaseCallbackHandler) if name.startswith("on_")]:
+    setattr(HeldCallbackHandler, _event, _held_event(_event))
+
+
+@contextlib.contextmanager
+def hold_user_facing_callbacks():
+    """Holds back the events of the user facing handlers, e.g. the streamed
+    tokens, of the llm calls made inside the block, including the tasks and
+    worker threads started from it. Yields the held handlers, to release or
+    discard once it is known whether the work is kept."""
+    held: List[HeldCallbackHandler] = []
+    handlers = []
+    for handler in get_callbacks() or []:
+        if getattr(handler, "user_facing", False):
+            handler = HeldCallbackHandler(handler)
+            held.append(handler)
+        handlers.append(handler)
+    token = _callbacks.set(handlers)
+    try:
+        yield held
+    finally:
+        _callbacks.reset(token)
@@ -1,17 +1,19 @@
 import abc
+import asyncio
 from abc import ABC
-from typing import Type, Optional, Union
+from typing import Dict, List, Type, Optional, Union
 
-from langchain.agents import ZeroShotAgent, AgentExecutor, AgentType, initialize_agent
-from langchain.chains import LLMChain
-from langchain.chat_models import ChatOpenAI
 from langchain.output_parsers import PydanticOutputParser
 from langchain.schema import BasePromptTemplate
 from pydantic import BaseModel
 
 from data.chat import MessageHistory, ModelInput
 from data.graph import MessageOutput
+from graph.callbacks import get_callbacks
 from graph.edge import BaseEdge
+from graph.pre_extractor import PreExtractor
+from graph.prompts import compile_prompt
+from graph.shared import shared
 
 
 class ChainBasedEdge(BaseEdge[MessageHistory, MessageOutput], ABC):
@@ -21,19 +23,35 @@ class ChainBasedEdge(BaseEdge[MessageHistory, MessageOutput], ABC):
         pydantic_object: Optional[Type[BaseModel]],
         max_retries=3,
         out_node=None,
+        priority=0,
+        pre_extractors: Optional[List[PreExtractor]] = None,
     ):
-        super().__init__(model=model, max_retries=max_retries, out_node=out_node)
+        super().__init__(
+            model=model,
+            max_retries=max_retries,
+            out_node=out_node,
+            priority=priority,
+            pre_extractors=pre_extractors,
+        )
         if pydantic_object is not None:
-            self._output_parser = PydanticOutputParser(pydantic_object=pydantic_object)
+            self._output_parser = shared(
+                (PydanticOutputParser, pydantic_object),
+                lambda: PydanticOutputParser(pydantic_object=pydantic_object),
+            )
         else:
             self._output_parser = None
 
-        self._init_chain()
+        # chains are built once per edge type, model and output class and
+        # shared between every conversation
+        self._shared_key = (type(self), id(model), pydantic_object)
 
     @abc.abstractmethod
     def _predict(self, model_input: ModelInput) -> str:
         pass
 
+    async def _apredict(self, model_input: ModelInput) -> str:
+        return await asyncio.to_thread(self._predict, model_input)
+
     @abc.abstractmethod
     def _init_chain(self, *kwargs):
         pass
@@ -52,6 +70,14 @@ class ChainBasedEdge(BaseEdge[MessageHistory, MessageOutput], ABC):
     def _parse(self, message_history: MessageHistory) -> Union[str, BaseModel]:
         model_input = message_history.model_input()
         str_to_parse = self._predict(model_input=model_input)
+        return self._parse_output(str_to_parse)
+
+    async def _aparse(self, message_history: MessageHistory) -> Union[str, BaseModel]:
+        model_input = message_history.model_input()
+        str_to_parse = await self._apredict(model_input=model_input)
+        return self._parse_output(str_to_parse)
+
+    def _parse_output(self, str_to_parse: str) -> Union[str, BaseModel]:
         out = (
             self._output_parser.parse(str_to_parse)
             if self._output_parser is not None
@@ -64,53 +90,86 @@ class ZeroShotChainBasedEdge(ChainBasedEdge, ABC):
     _prompt_prefix = None
     _prompt_suffix = None
 
-    def _prompt_input_variables(self):
-        input_variables = ["input", "agent_scratchpad", "history"]
-        if self._output_parser is not None:
-            input_variables += ["format_instructions"]
+    # variables filled on every call, the output format is rendered once
+    _dynamic_variables = ["input", "agent_scratchpad", "history"]
 
-        return input_variables
+    def _prompt_input_variables(self):
+        return list(self._dynamic_variables)
+
+    def _prompt_suffix_with_history(self) -> str:
+        """The suffix with the history inserted right before the line of its
+        first per-turn variable, after the static instructions"""
+        suffix = self._prompt_suffix
+        positions = [
+            suffix.find("{" + variable + "}")
+            for variable in self._dynamic_variables
+            if "{" + variable + "}" in suffix
+        ]
+        split = suffix.rfind("\n", 0, min(positions)) + 1 if positions else len(suffix)
+        history = """Conversation History \n{history}\n"""
+        return suffix[:split] + history + suffix[split:]
 
     def _get_prompt_template(self) -> BasePromptTemplate:
-        input_variables = self._prompt_input_variables()
-        history = """Conversation History \n{history}\n"""
+        from langchain.agents import ZeroShotAgent
 
         prompt = ZeroShotAgent.create_prompt(
             tools=self._tools,
             prefix=self._prompt_prefix,
-            suffix=history + self._prompt_suffix,
-            input_variables=input_variables,
+            suffix=self._prompt_suffix_with_history(),
+            input_variables=self._prompt_input_variables(),
+        )
+
+        static_values = {}
+        if self._output_parser is not None:
+            static_values["format_instructions"] = (
+                self._output_parser.get_format_instructions()
+            )
+        return compile_prompt(
+            prompt.template, static_values, self._prompt_input_variables()
         )
-        return prompt
+
+    def static_prompt_tokens(self) -> Dict[str, int]:
+        self.warm_up()
+        return {"agent": self._prompt.static_tokens}
 
     def _init_chain(self, **kwargs):
+        self._tools, self._prompt, self._llm_chain, self._agent_executor = shared(
+            self._shared_key, self._build_chain
+        )
+
+    def _build_chain(self):
+        from langchain.agents import AgentExecutor, ZeroShotAgent
+
+        from graph.cached_chain import CachedLLMChain
+
         self._tools = self._get_tools()
 
         self._prompt = self._get_prompt_template()
-        self._llm_chain = LLMChain(llm=self._llm_model, prompt=self._prompt)
+        self._llm_chain = CachedLLMChain(llm=self._llm_model, prompt=self._prompt)
 
         agent = ZeroShotAgent(llm_chain=self._llm_chain, tools=self._tools)
         self._agent_executor = AgentExecutor.from_agent_and_tools(
             agent=agent, tools=self._tools, verbose=True, handle_parsing_errors=True
         )
+        return self._tools, self._prompt, self._llm_chain, self._agent_executor
 
     @abc.abstractmethod
     def _get_tools(self):
         pass
 
     def _predict(self, model_input: ModelInput) -> str:
-        if self._output_parser is not None:
-            result = self._agent_executor.run(
-                input=model_input.input,
-                history=model_input.history,
-                format_instructions=self._output_parser.get_format_instructions(),
-            )
-        else:
-            result = self._agent_executor.run(
-                input=model_input.input, history=model_input.history
-            )
+        return self._agent_executor.run(
+            input=model_input.input,
+            history=model_input.history,
+            callbacks=get_callbacks(),
+        )
 
-        return result
+    async def _apredict(self, model_input: ModelInput) -> str:
+        return await self._agent_executor.arun(
+            input=model_input.input,
+            history=model_input.history,
+            callbacks=get_callbacks(),
+        )
 
 
 class MultifunctionEdge(ChainBasedEdge, ABC):
@@ -118,19 +177,29 @@ class MultifunctionEdge(ChainBasedEdge, ABC):
     _prompt_suffix = None
 
     def _init_chain(self, *kwargs):
-        self._tools = self._get_tools()
+        self._tools, self._agent = shared(self._shared_key, self._build_chain)
+
+    def _build_chain(self):
+        from langchain.agents import AgentType, initialize_agent
 
-        self._agent = initialize_agent(
-            self._tools,
-            ChatOpenAI(temperature=0),
+        tools = self._get_tools()
+
+        agent = initialize_agent(
+            tools,
+            self._llm_model,
             agent=AgentType.OPENAI_FUNCTIONS,
             verbose=True,
         )
+        return tools, agent
 
     @abc.abstractmethod
     def _get_tools(self):
         pass
 
     def _predict(self, messages: MessageHistory) -> str:
-        completion = self._agent.run(messages)
+        completion = self._agent.run(messages, callbacks=get_callbacks())
+        return completion
+
+    async def _apredict(self, messages: MessageHistory) -> str:
+        completion = await self._agent.arun(messages, callbacks=get_callbacks())
         return completion
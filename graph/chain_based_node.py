@@ -1,14 +1,32 @@
 import abc
+import asyncio
+import re
 
-from langchain.agents import initialize_agent, AgentType
-from langchain.chains import MultiRetrievalQAChain
 from langchain.output_parsers import PydanticOutputParser
 from pydantic import BaseModel
-from typing import Type, Optional, List
+from typing import Type, Optional, List, TYPE_CHECKING
 
+from cache.response_cache import ResponseCache
 from data.chat import MessageHistory
+from data.graph import ConversationState
+from graph.callbacks import STREAM_TAG, get_callbacks
 from graph.node import BaseNode
+from graph.router import DomainClassifier
 from graph.edge import BaseEdge
+from graph.shared import shared
+from graph.tracing import set_attributes
+
+if TYPE_CHECKING:
+    from langchain.chains.base import Chain
+
+# queries referring to earlier turns, e.g. "and how much is it?", they are
+# answered with the history and never cached
+FOLLOW_UP_PATTERN = re.compile(
+    r"^\W*(?:and|but|so|also|then|what about|how about)\b"
+    r"|\b(?:it|its|that|this|these|those|they|them|their|one|ones|same|else"
+    r"|above|previous|former|latter)\b",
+    re.IGNORECASE,
+)
 
 
 class ChainBasedNode(BaseNode[MessageHistory], abc.ABC):
@@ -18,17 +36,24 @@ class ChainBasedNode(BaseNode[MessageHistory], abc.ABC):
         pydantic_object: Optional[Type[BaseModel]],
         edges: Optional[List[BaseEdge]],
         final_state=False,
+        concurrent_edges=False,
+        speculative_fallback=False,
     ):
         self._llm_model = llm_model
         self._parse_class = pydantic_object
 
         if pydantic_object is not None:
-            self._output_parser = PydanticOutputParser(pydantic_object=pydantic_object)
+            self._output_parser = shared(
+                (PydanticOutputParser, pydantic_object),
+                lambda: PydanticOutputParser(pydantic_object=pydantic_object),
+            )
         else:
             self._output_parser = None
 
-        self._init_chain()
-        super().__init__(edges, final_state)
+        # chains are built once per node type, model and output class and
+        # shared between every conversation
+        self._shared_key = (type(self), id(llm_model), pydantic_object)
+        super().__init__(edges, final_state, concurrent_edges, speculative_fallback)
 
     @abc.abstractmethod
     def _init_chain(self, **kwargs):
@@ -36,6 +61,38 @@ class ChainBasedNode(BaseNode[MessageHistory], abc.ABC):
 
 
 class MultiRetrievalNode(ChainBasedNode, abc.ABC):
+    def __init__(
+        self,
+        llm_model,
+        pydantic_object: Optional[Type[BaseModel]],
+        edges: Optional[List[BaseEdge]],
+        final_state=False,
+        concurrent_edges=False,
+        response_cache: Optional[ResponseCache] = None,
+        deterministic_routing=False,
+        domain_classifier: Optional[DomainClassifier] = None,
+        speculative_fallback=False,
+    ):
+        """
+        response_cache (ResponseCache): answers repeated questions without
+            going through the router and the retrieval chains
+        deterministic_routing (bool): pick the retriever with `_route` instead
+            of spending an llm call on the router
+        domain_classifier (DomainClassifier): with deterministic routing, sends
+            the queries it rejects to the default chain
+        """
+        self._response_cache = response_cache
+        self._deterministic_routing = deterministic_routing
+        self._domain_classifier = domain_classifier
+        super().__init__(
+            llm_model,
+            pydantic_object,
+            edges,
+            final_state,
+            concurrent_edges,
+            speculative_fallback,
+        )
+
     @abc.abstractmethod
     def _get_retriever_infos(self):
         pass
@@ -44,32 +101,208 @@ class MultiRetrievalNode(ChainBasedNode, abc.ABC):
     def _get_default_chain(self):
         pass
 
+    def _retrievers_key(self):
+        """Identity of what the retrievers of `_get_retriever_infos` search,
+        nodes with the same model but different knowledge bases must not
+        share their chain, by default every node builds its own"""
+        return id(self)
+
     def _init_chain(self, *kwargs):
+        self._llm_chain = shared(
+            self._shared_key + (self._retrievers_key(),), self._build_chain
+        )
+
+    def _build_chain(self):
+        """MultiRetrievalQAChain.from_retrievers with every LLMChain, router
+        and retrieval QA ones included, going through the completion cache"""
+        from langchain.chains import (
+            MultiRetrievalQAChain,
+            RetrievalQA,
+            StuffDocumentsChain,
+        )
+        from langchain.chains.question_answering.stuff_prompt import PROMPT_SELECTOR
+        from langchain.chains.router.llm_router import LLMRouterChain, RouterOutputParser
+        from langchain.chains.router.multi_retrieval_prompt import (
+            MULTI_RETRIEVAL_ROUTER_TEMPLATE,
+        )
+        from langchain.prompts import PromptTemplate
+
+        from graph.cached_chain import CachedLLMChain
+
         retriever_infos = self._get_retriever_infos()
 
-        self._llm_chain = MultiRetrievalQAChain.from_retrievers(
-            self._llm_model,
-            retriever_infos,
+        destinations = "\n".join(
+            f"{info['name']}: {info['description']}" for info in retriever_infos
+        )
+        router_prompt = PromptTemplate(
+            template=MULTI_RETRIEVAL_ROUTER_TEMPLATE.format(destinations=destinations),
+            input_variables=["input"],
+            output_parser=RouterOutputParser(next_inputs_inner_key="query"),
+        )
+        router_chain = LLMRouterChain(
+            llm_chain=CachedLLMChain(llm=self._llm_model, prompt=router_prompt)
+        )
+
+        document_prompt = PromptTemplate(
+            input_variables=["page_content"], template="Context:\n{page_content}"
+        )
+        destination_chains = {
+            info["name"]: RetrievalQA(
+                combine_documents_chain=StuffDocumentsChain(
+                    llm_chain=CachedLLMChain(
+                        llm=self._llm_model,
+                        prompt=info.get("prompt")
+                        or PROMPT_SELECTOR.get_prompt(self._llm_model),
+                    ),
+                    document_variable_name="context",
+                    document_prompt=document_prompt,
+                ),
+                retriever=info["retriever"],
+            )
+            for info in retriever_infos
+        }
+
+        return MultiRetrievalQAChain(
+            router_chain=router_chain,
+            destination_chains=destination_chains,
             default_chain=self._get_default_chain(),
             verbose=True,
         )
 
     def _predict(self, messages: MessageHistory) -> str:
-        return self._llm_chain.run(messages)
+        return self._llm_chain.run(
+            messages, callbacks=get_callbacks(), tags=[STREAM_TAG]
+        )
+
+    async def _apredict(self, messages: MessageHistory) -> str:
+        return await self._llm_chain.arun(
+            messages, callbacks=get_callbacks(), tags=[STREAM_TAG]
+        )
+
+    def _route(self, state: ConversationState) -> Optional[str]:
+        """Name of the retriever that answers the conversation, None leaves the
+        decision to the llm router"""
+        return None
+
+    def _routed_chain(
+        self, messages: MessageHistory, state: ConversationState
+    ) -> Optional["Chain"]:
+        if not self._deterministic_routing:
+            return None
+
+        destination = self._route(state)
+        if destination is None:
+            return None
+
+        query = self._user_query(messages)
+        # a follow up has too few words to classify, it stays on the retriever
+        if self._domain_classifier is not None and not self._depends_on_history(query):
+            if not self._domain_classifier.is_in_domain(query):
+                set_attributes(route="default")
+                return self._llm_chain.default_chain
+        set_attributes(route=destination)
+        return self._llm_chain.destination_chains[destination]
+
+    def _routed_predict(
+        self, messages: MessageHistory, state: ConversationState
+    ) -> str:
+        chain = self._routed_chain(messages, state)
+        if chain is None:
+            return self._predict(messages)
+        outputs = chain(
+            {"query": self._routed_query(messages)},
+            callbacks=get_callbacks(),
+            tags=[STREAM_TAG],
+        )
+        return outputs["result"]
+
+    async def _arouted_predict(
+        self, messages: MessageHistory, state: ConversationState
+    ) -> str:
+        chain = self._routed_chain(messages, state)
+        if chain is None:
+            return await self._apredict(messages)
+        outputs = await chain.acall(
+            {"query": self._routed_query(messages)},
+            callbacks=get_callbacks(),
+            tags=[STREAM_TAG],
+        )
+        return outputs["result"]
+
+    def _cache_namespace(self, state: ConversationState) -> str:
+        """Partition of the response cache the conversation reads from, answers
+        that depend on the node input must not be shared across partitions"""
+        return ""
+
+    def _user_query(self, messages: MessageHistory) -> str:
+        return messages.last_user_message()["content"]
+
+    @staticmethod
+    def _depends_on_history(query: str) -> bool:
+        return FOLLOW_UP_PATTERN.search(query) is not None
+
+    def _routed_query(self, messages: MessageHistory) -> str:
+        """Query of the retrieval chain, a follow up comes with the history
+        window of the history policy, like the llm router gets it"""
+        query = self._user_query(messages)
+        if not self._depends_on_history(query):
+            return query
+        model_input = messages.model_input()
+        return model_input.history + model_input.input
+
+    def _answer(self, messages: MessageHistory, state: ConversationState) -> str:
+        """`_predict`, routed and behind the response cache"""
+        query = self._user_query(messages)
+        if self._response_cache is None or self._depends_on_history(query):
+            return self._routed_predict(messages, state)
+
+        namespace = self._cache_namespace(state)
+        answer = self._response_cache.get(namespace, query)
+        set_attributes(response_cache_hit=answer is not None)
+        if answer is None:
+            answer = self._routed_predict(messages, state)
+            self._response_cache.put(namespace, query, answer)
+        return answer
+
+    async def _aanswer(self, messages: MessageHistory, state: ConversationState) -> str:
+        """Async version of `_answer`"""
+        query = self._user_query(messages)
+        if self._response_cache is None or self._depends_on_history(query):
+            return await self._arouted_predict(messages, state)
+
+        namespace = self._cache_namespace(state)
+        answer = await asyncio.to_thread(self._response_cache.get, namespace, query)
+        set_attributes(response_cache_hit=answer is not None)
+        if answer is None:
+            answer = await self._arouted_predict(messages, state)
+            await asyncio.to_thread(self._response_cache.put, namespace, query, answer)
+        return answer
 
 
 class MultifunctionNode(ChainBasedNode, abc.ABC):
     def _init_chain(self, *kwargs):
-        self._tools = self._get_tools()
+        self._tools, self._agent = shared(self._shared_key, self._build_chain)
+
+    def _build_chain(self):
+        from langchain.agents import AgentType, initialize_agent
+
+        tools = self._get_tools()
 
-        self._agent = initialize_agent(
-            self._tools, self._llm_model, agent=AgentType.OPENAI_FUNCTIONS, verbose=True
+        agent = initialize_agent(
+            tools, self._llm_model, agent=AgentType.OPENAI_FUNCTIONS, verbose=True
         )
+        return tools, agent
 
     @abc.abstractmethod
     def _get_tools(self):
         pass
 
     def _predict(self, messages: MessageHistory) -> str:
-        completion = self._agent.run(messages)
+        self.warm_up()
+        completion = self._agent.run(messages, callbacks=get_callbacks())
+        return completion
+
+    async def _apredict(self, messages: MessageHistory) -> str:
+        await self.awarm_up()
+        completion = await self._agent.arun(messages, callbacks=get_callbacks())
         return completion
@@ -0,0 +1,26 @@
+import contextlib
+import contextvars
+from typing import Optional
+
+from cache.completion_cache import CompletionCache
+
+# completion cache of the conversation turn being executed, the chains are
+# shared between conversations so it is scoped to the running context
+_completion_cache: contextvars.ContextVar[Optional[CompletionCache]] = (
+    contextvars.ContextVar("graph_completion_cache", default=None)
+)
+
+
+def get_completion_cache() -> Optional[CompletionCache]:
+    return _completion_cache.get()
+
+
+@contextlib.contextmanager
+def use_completion_cache(cache: Optional[CompletionCache]):
+    """Answers the deterministic CachedLLMChain calls made inside the block
+    from `cache`, None disables the cache"""
+    token = _completion_cache.set(cache)
+    try:
+        yield
+    finally:
+        _completion_cache.reset(token)
@@ -0,0 +1,73 @@
+import threading
+from typing import Dict, List, Optional
+
+from graph.node import BaseNode
+from graph.speculation import SpeculationStats
+
+
+class ConversationGraph:
+
+    """Graph
+    registry of every node reachable from the start node, by node id.
+    The graph is immutable once built, conversations keep their position
+    and everything else they change in a ConversationState
+    """
+
+    def __init__(self, start_node: BaseNode):
+        self._start_node = start_node
+        self._nodes: Optional[Dict[str, BaseNode]] = None
+        self._lock = threading.Lock()
+
+    def _registry(self) -> Dict[str, BaseNode]:
+        """Walks the graph the first time a node is looked up, lazy edges are
+        built by the walk so showing the start node does not need it"""
+        if self._nodes is not None:
+            return self._nodes
+
+        with self._lock:
+            if self._nodes is None:
+                nodes: Dict[str, BaseNode] = {}
+                pending: List[BaseNode] = [self._start_node]
+                while pending:
+                    node = pending.pop()
+                    if node.node_id in nodes:
+                        if nodes[node.node_id] is not node:
+                            raise ValueError(f"Duplicated node id: {node.node_id}")
+                        continue
+
+                    nodes[node.node_id] = node
+                    for edge in node._edges or []:
+                        if edge._out_node is not None:
+                            pending.append(edge._out_node)
+                self._nodes = nodes
+        return self._nodes
+
+    @property
+    def start_node(self) -> BaseNode:
+        return self._start_node
+
+    def node(self, node_id: str) -> BaseNode:
+        if node_id == self._start_node.node_id:
+            return self._start_node
+        return self._registry()[node_id]
+
+    def node_ids(self) -> List[str]:
+        return list(self._registry())
+
+    def static_prompt_tokens(self) -> Dict[str, Dict[str, int]]:
+        """Static prompt prefix tokens of every edge with prompts, by edge id"""
+        report = {}
+        for node in self._registry().values():
+            for edge in node._edges or []:
+                tokens = edge.static_prompt_tokens()
+                if tokens:
+                    report[edge.edge_id] = tokens
+        return report
+
+    def speculation_stats(self) -> Dict[str, SpeculationStats]:
+        """Speculative fallback stats of the nodes that speculate, by node id"""
+        return {
+            node_id: node.speculation_stats()
+            for node_id, node in self._registry().items()
+            if node._speculative_fallback
+        }
@@ -1,30 +1,96 @@
 import abc
-from typing import Generic, TypeVar, Optional, Union, List
+import asyncio
+import threading
+from typing import Dict, Generic, TypeVar, Optional, Union, List
 
 from langchain.schema import OutputParserException
 from pydantic import BaseModel
 
-from data.chat import Role
-from data.graph import EdgeOutput, MessageOutput
+from data.chat import MessageHistory, Role
+from data.graph import ConversationState, EdgeOutput, MessageOutput
+from data.tracing import SpanKind
+from graph.pre_extractor import PreExtractor
+from graph.tracing import set_attributes, trace
 
 EdgeInput = TypeVar("EdgeInput")
 ResultsType = TypeVar("ResultsType")
 
 
 class BaseEdge(abc.ABC, Generic[EdgeInput, ResultsType]):
-    def __init__(self, model, max_retries=3, out_node=None):
+    def __init__(
+        self,
+        model,
+        max_retries=3,
+        out_node=None,
+        priority=0,
+        pre_extractors: Optional[List[PreExtractor]] = None,
+    ):
         self._llm_model = model
 
-        # how many times the edge has failed, for any reason, for deciding to skip
-        # when successful this resets to 0 for posterity.
-        self._num_fails = 0
-
-        # how many retrys are acceptable
+        # how many retrys are acceptable, past them the trace flags the edge,
+        # it still does not continue, the node it leads to needs its result
         self._max_retries = max_retries
 
         # the node the edge directs towards
         self._out_node = out_node
 
+        # edges with a higher priority win over the ones with a lower priority
+        # when more than one continues, ties are broken by the node edge order
+        self.priority = priority
+
+        # tried in order on the user message before the llm, the first
+        # confident match is the edge result
+        self._pre_extractors = pre_extractors or []
+
+        # chains are built by `warm_up`, ahead of time by a background warm up
+        # or by the first execution that needs them
+        self._warm = False
+        self._warm_lock = threading.RLock()
+
+    @property
+    def edge_id(self) -> str:
+        """identifies the edge in the conversation state, edges are shared
+        between conversations so they must not hold per-conversation state"""
+        return type(self).__name__
+
+    def _num_fails(self, state: ConversationState) -> int:
+        # how many times the edge has failed, for any reason, for deciding to skip
+        # when successful this resets to 0 for posterity.
+        return state.num_fails.get(self.edge_id, 0)
+
+    def _reset_fails(self, state: ConversationState):
+        state.num_fails[self.edge_id] = 0
+
+    def _add_fail(self, state: ConversationState) -> int:
+        state.num_fails[self.edge_id] = self._num_fails(state) + 1
+        return state.num_fails[self.edge_id]
+
+    def _init_chain(self):
+        """Builds the chains of the edge, see `warm_up`"""
+        pass
+
+    def warm_up(self):
+        """Builds the chains of the edge, loading the modules they need, so
+        the first execution does not have to. Idempotent and safe to call from
+        a background thread."""
+        if self._warm:
+            return
+        # the background warm up and the first turn may get here at once
+        with self._warm_lock:
+            if not self._warm:
+                self._init_chain()
+                self._warm = True
+
+    async def awarm_up(self):
+        """Async version of `warm_up`, the build runs in a worker thread"""
+        if not self._warm:
+            await asyncio.to_thread(self.warm_up)
+
+    def static_prompt_tokens(self) -> Dict[str, int]:
+        """Tokens of the static prefix of every prompt of the edge, the part
+        a provider prompt cache can reuse between turns"""
+        return {}
+
     @abc.abstractmethod
     def _get_message_output(
         self, msg_input: Union[str, BaseModel]
@@ -39,19 +105,32 @@ class BaseEdge(abc.ABC, Generic[EdgeInput, ResultsType]):
     def _parse(self, model_input: EdgeInput) -> ResultsType:
         pass
 
+    async def acheck(self, model_output: str) -> bool:
+        """async version of `check`, runs the blocking check on a worker thread
+        unless the edge provides a native async implementation"""
+        return await asyncio.to_thread(self.check, model_output)
+
+    async def _aparse(self, model_input: EdgeInput) -> ResultsType:
+        """async version of `_parse`, runs the blocking parse on a worker thread
+        unless the edge provides a native async implementation"""
+        return await asyncio.to_thread(self._parse, model_input)
+
     def _get_edge_output(
-        self, should_continue: bool, result: Optional[ResultsType]
+        self,
+        should_continue: bool,
+        result: Optional[ResultsType],
+        state: ConversationState,
     ) -> EdgeOutput:
         message_output = self._get_message_output(result)
         return EdgeOutput(
             should_continue=should_continue,
             result=result,
-            num_fails=self._num_fails,
+            num_fails=self._num_fails(state),
             next_node=self._out_node,
             message_output=message_output,
         )
 
-    def execute(self, user_input: EdgeInput):
+    def execute(self, user_input: EdgeInput, state: ConversationState):
         """Executes the entire edge
         returns a dictionary:
         {
@@ -61,25 +140,91 @@ class BaseEdge(abc.ABC, Generic[EdgeInput, ResultsType]):
             continue_to: Node     the Node the edge continues to
         }
         """
+        with trace(self.edge_id, SpanKind.EDGE) as span:
+            output = self._pre_extract(user_input, state, span)
+            if output is None:
+                if not self._warm:
+                    set_attributes(cold_start=True)
+                    self.warm_up()
+                output = self._execute(user_input, state)
+            self._trace_output(span, output)
+            return output
+
+    async def aexecute(self, user_input: EdgeInput, state: ConversationState):
+        """Async version of `execute`, same return value"""
+        with trace(self.edge_id, SpanKind.EDGE) as span:
+            output = self._pre_extract(user_input, state, span)
+            if output is None:
+                if not self._warm:
+                    set_attributes(cold_start=True)
+                    await self.awarm_up()
+                output = await self._aexecute(user_input, state)
+            self._trace_output(span, output)
+            return output
+
+    def _pre_extract(
+        self, user_input: EdgeInput, state: ConversationState, span
+    ) -> Optional[EdgeOutput]:
+        """Edge output of the first pre-extractor matching the user message,
+        None when the llm has to decide"""
+        if not self._pre_extractors:
+            return None
+        if isinstance(user_input, MessageHistory):
+            last_message = user_input.last_user_message()
+            message = last_message["content"] if last_message is not None else None
+        else:
+            message = user_input
+        if not isinstance(message, str):
+            return None
+
+        for extractor in self._pre_extractors:
+            result = extractor.extract(message)
+            if result is not None:
+                if span is not None:
+                    span.attributes["pre_extracted"] = type(extractor).__name__
+                self._reset_fails(state)
+                return self._get_edge_output(
+                    should_continue=True, result=result, state=state
+                )
+        return None
+
+    def _trace_output(self, span, output: Optional[EdgeOutput]):
+        if span is None or output is None:
+            return
+        span.attributes.update(
+            should_continue=output.should_continue, num_fails=output.num_fails
+        )
+        if self._max_retries is not None and output.num_fails >= self._max_retries:
+            span.attributes["retries_exhausted"] = True
 
+    def _execute(self, user_input: EdgeInput, state: ConversationState):
         try:
             # attempting to parse
-            self._num_fails = 0
+            self._reset_fails(state)
             return self._get_edge_output(
-                should_continue=True, result=self._parse(user_input)
+                should_continue=True, result=self._parse(user_input), state=state
             )
         except OutputParserException as parsing_exception:
-            # there was some error in parsing.
-            # note, using the retry or correction parser here might be a good idea
-            self._num_fails += 1
-            if self._num_fails >= self._max_retries:
-                return self._get_edge_output(
-                    should_continue=True,
-                    result=MessageOutput(
-                        parsing_exception.llm_output, role=Role.SYSTEM
-                    ),
-                )
+            return self._parse_failed(parsing_exception, state)
+
+    async def _aexecute(self, user_input: EdgeInput, state: ConversationState):
+        try:
+            self._reset_fails(state)
             return self._get_edge_output(
-                should_continue=False,
-                result=MessageOutput(parsing_exception.llm_output, role=Role.SYSTEM),
+                should_continue=True, result=await self._aparse(user_input), state=state
             )
+        except OutputParserException as parsing_exception:
+            return self._parse_failed(parsing_exception, state)
+
+    def _parse_failed(
+        self, parsing_exception: OutputParserException, state: ConversationState
+    ) -> EdgeOutput:
+        # there was some error in parsing, the edge does not continue without
+        # a result however many times it failed, the node asks again.
+        # note, using the retry or correction parser here might be a good idea
+        self._add_fail(state)
+        return self._get_edge_output(
+            should_continue=False,
+            result=MessageOutput(parsing_exception.llm_output, role=Role.SYSTEM),
+            state=state,
+        )
@@ -0,0 +1,73 @@
+import asyncio
+import threading
+from typing import Callable, Dict, List, Optional, Union
+
+from pydantic import BaseModel
+
+from data.graph import ConversationState, MessageOutput
+from graph.edge import BaseEdge
+
+
+class LazyEdge(BaseEdge):
+
+    """Edge built by `factory` the first time it is needed, the node it
+    leaves from can be shown before the edge, the nodes it leads to and the
+    modules and models they load exist. Everything else is delegated to the
+    built edge."""
+
+    def __init__(self, factory: Callable[[], BaseEdge], priority: int = 0):
+        """
+        factory (callable): builds the edge, called once
+        priority (int): must match the priority of the built edge, the node
+            orders its edges without building them
+        """
+        # nothing of BaseEdge is initialized, every call goes to the built edge
+        self.priority = priority
+        self._factory = factory
+        self._edge: Optional[BaseEdge] = None
+        self._lock = threading.Lock()
+
+    @property
+    def edge(self) -> BaseEdge:
+        if self._edge is None:
+            with self._lock:
+                if self._edge is None:
+                    self._edge = self._factory()
+        return self._edge
+
+    @property
+    def edge_id(self) -> str:
+        return self.edge.edge_id
+
+    @property
+    def _out_node(self):
+        return self.edge._out_node
+
+    @property
+    def _warm(self) -> bool:
+        return self._edge is not None and self._edge._warm
+
+    def warm_up(self):
+        self.edge.warm_up()
+
+    def static_prompt_tokens(self) -> Dict[str, int]:
+        return self.edge.static_prompt_tokens()
+
+    def _get_message_output(
+        self, msg_input: Union[str, BaseModel]
+    ) -> Optional[List[MessageOutput]]:
+        return self.edge._get_message_output(msg_input)
+
+    def check(self, model_output: str) -> bool:
+        return self.edge.check(model_output)
+
+    def _parse(self, model_input):
+        return self.edge._parse(model_input)
+
+    def execute(self, user_input, state: ConversationState):
+        return self.edge.execute(user_input, state)
+
+    async def aexecute(self, user_input, state: ConversationState):
+        if self._edge is None:
+            await asyncio.to_thread(lambda: self.edge)
+        return await self._edge.aexecute(user_input, state)
@@ -1,8 +1,22 @@
 import abc
+import asyncio
+import contextvars
+import dataclasses
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Generic, TypeVar, Union, Optional
 
-from data.graph import EdgeOutput, MessageOutput
+from data.graph import ConversationState, EdgeOutput, MessageOutput
+from data.tracing import SpanKind
+from graph.callbacks import hold_user_facing_callbacks
 from graph.edge import BaseEdge
+from graph.speculation import (
+    AsyncSpeculation,
+    Speculation,
+    SpeculationRecorder,
+    SpeculationStats,
+)
+from graph.tracing import set_attributes, trace
 
 
 NodeInput = TypeVar("NodeInput")
@@ -16,53 +30,335 @@ class BaseNode(abc.ABC, Generic[NodeInput]):
     the edges it contains
     """
 
-    def __init__(self, edges: Optional[List[BaseEdge]] = None, final_state=False):
+    def __init__(
+        self,
+        edges: Optional[List[BaseEdge]] = None,
+        final_state=False,
+        concurrent_edges=False,
+        speculative_fallback=False,
+    ):
         """
         prompt (str): what to ask the user
         retry_prompt (str): what to ask the user if all edges fail
         parse_class (Pydantic BaseModel): the structure of the parse
         llm (LangChain LLM): the large language model being used
+        concurrent_edges (bool): evaluate all edges at once instead of one by one
+        speculative_fallback (bool): start `no_edges_found` while the edges are
+            evaluated and throw it away if one continues, for nodes where the
+            edges rarely continue and the fallback calls an llm
         """
 
         self._edges = edges
-        self._node_input = None
         self._final_state = final_state
 
+        # when enabled every edge is evaluated in parallel and the winner is
+        # still picked deterministically, see `_ordered_edges`
+        self._concurrent_edges = concurrent_edges
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+        # the fallback answer is ready as soon as every edge fails, its
+        # streamed tokens are held back until then
+        self._speculative_fallback = speculative_fallback
+        self._speculation = SpeculationRecorder()
+
+        # chains are built by `warm_up`, ahead of time by a background warm up
+        # or by the first execution that needs them
+        self._warm = False
+        self._warm_lock = threading.RLock()
+
     def is_node_final(self):
         return self._final_state
 
-    def set_node_input(self, edge_output: EdgeOutput):
-        self._node_input = edge_output
+    @property
+    def node_id(self) -> str:
+        """identifies the node in the conversation state and the graph"""
+        return type(self).__name__
+
+    def node_input(self, state: ConversationState):
+        """the result of the edge that led the conversation to this node"""
+        return state.node_inputs.get(self.node_id)
+
+    def set_node_input(self, state: ConversationState, edge_output: EdgeOutput):
+        state.node_inputs[self.node_id] = edge_output
+
+    def _init_chain(self):
+        """Builds the chains of the node, see `warm_up`"""
+        pass
+
+    def warm_up(self):
+        """Builds the chains of the node, loading the modules they need, so
+        the first execution does not have to. Idempotent and safe to call from
+        a background thread."""
+        if self._warm:
+            return
+        # the background warm up and the first turn may get here at once
+        with self._warm_lock:
+            if not self._warm:
+                self._init_chain()
+                self._warm = True
+
+    async def awarm_up(self):
+        """Async version of `warm_up`, the build runs in a worker thread"""
+        if not self._warm:
+            await asyncio.to_thread(self.warm_up)
+
+    def warm_up_next(self):
+        """Warms up the node, its edges and the nodes they lead to, every
+        step the conversation can take from here"""
+        self.warm_up()
+        for edge in self._edges or []:
+            edge.warm_up()
+        for edge in self._edges or []:
+            if edge._out_node is not None:
+                edge._out_node.warm_up()
+
+    def speculation_stats(self) -> SpeculationStats:
+        """How many speculative fallbacks were used and how many, and how much
+        time, were wasted because an edge continued"""
+        return self._speculation.stats()
 
-    def run_to_continue(self, user_input: NodeInput) -> Optional[EdgeOutput]:
+    def _speculate(
+        self, user_input: NodeInput, state: ConversationState
+    ) -> Optional[Speculation]:
+        if not self._speculative_fallback:
+            return None
+
+        def fallback():
+            self.warm_up()
+            return self.no_edges_found(user_input, state)
+
+        with hold_user_facing_callbacks() as held:
+            context = contextvars.copy_context()
+        return Speculation(fallback, held, self._speculation, context)
+
+    def _aspeculate(
+        self, user_input: NodeInput, state: ConversationState
+    ) -> Optional[AsyncSpeculation]:
+        if not self._speculative_fallback:
+            return None
+
+        async def fallback():
+            await self.awarm_up()
+            return await self.ano_edges_found(user_input, state)
+
+        with hold_user_facing_callbacks() as held:
+            return AsyncSpeculation(fallback, held, self._speculation)
+
+    def _ordered_edges(self) -> List[BaseEdge]:
+        """Edges in the order they win, highest priority first and list order
+        for ties"""
+        return sorted(self._edges, key=lambda edge: -edge.priority)
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=max(len(self._edges), 1),
+                thread_name_prefix=type(self).__name__,
+            )
+        return self._executor
+
+    def run_to_continue(
+        self, user_input: NodeInput, state: ConversationState
+    ) -> Optional[EdgeOutput]:
         """Run all edges until one continues
         returns the result of the continuing edge, or None
         """
+        if self._concurrent_edges and len(self._edges) > 1:
+            return self._run_edges_concurrently(user_input, state)
+
+        res = None
+        for edge in self._ordered_edges():
+            res = edge.execute(user_input, state)
+            if res is not None and res.should_continue:
+                return res
+        return res
+
+    def _run_edges_concurrently(
+        self, user_input: NodeInput, state: ConversationState
+    ) -> Optional[EdgeOutput]:
+        """Starts every edge at once and collects the results in winning order,
+        so a node costs one llm round trip instead of one per edge. Edges that
+        can no longer win are cancelled, calls already in flight finish in the
+        background and their results are discarded. Every edge runs on a copy
+        of the state and with its user facing callbacks held, only the edges
+        collected up to the winner update the state and reach the user, like
+        when the edges run one by one
+        """
+        executor = self._get_executor()
+        runs = []
+        for edge in self._ordered_edges():
+            edge_state = self._edge_state(state)
+            # the edges run with the callbacks of the calling context
+            with hold_user_facing_callbacks() as held:
+                context = contextvars.copy_context()
+            future = executor.submit(context.run, edge.execute, user_input, edge_state)
+            runs.append((edge, edge_state, held, future))
+
+        res = None
+        collected = 0
+        try:
+            for edge, edge_state, held, future in runs:
+                for handler in held:
+                    handler.release()
+                collected += 1
+                res = future.result()
+                self._merge_edge_state(edge, edge_state, state)
+                if res is not None and res.should_continue:
+                    return res
+        finally:
+            for _, _, held, future in runs[collected:]:
+                for handler in held:
+                    handler.discard()
+                future.cancel()
+        return res
+
+    @staticmethod
+    def _edge_state(state: ConversationState) -> ConversationState:
+        """Copy of the state an edge run concurrently changes, edges only
+        write their failure count"""
+        return dataclasses.replace(state, num_fails=dict(state.num_fails))
+
+    @staticmethod
+    def _merge_edge_state(
+        edge: BaseEdge, edge_state: ConversationState, state: ConversationState
+    ):
+        if edge.edge_id in edge_state.num_fails:
+            state.num_fails[edge.edge_id] = edge_state.num_fails[edge.edge_id]
+
+    async def arun_to_continue(
+        self, user_input: NodeInput, state: ConversationState
+    ) -> Optional[EdgeOutput]:
+        """Async version of `run_to_continue`"""
+        if self._concurrent_edges and len(self._edges) > 1:
+            return await self._arun_edges_concurrently(user_input, state)
+
         res = None
-        for edge in self._edges:
-            res = edge.execute(user_input)
+        for edge in self._ordered_edges():
+            res = await edge.aexecute(user_input, state)
             if res is not None and res.should_continue:
                 return res
         return res
 
-    def execute(self, user_input: NodeInput) -> Union[MessageOutput, EdgeOutput]:
+    async def _arun_edges_concurrently(
+        self, user_input: NodeInput, state: ConversationState
+    ) -> Optional[EdgeOutput]:
+        """Async version of `_run_edges_concurrently`, losing edges are cancelled"""
+        runs = []
+        for edge in self._ordered_edges():
+            edge_state = self._edge_state(state)
+            # the task copies the context, with the held handlers, when created
+            with hold_user_facing_callbacks() as held:
+                task = asyncio.ensure_future(edge.aexecute(user_input, edge_state))
+            runs.append((edge, edge_state, held, task))
+
+        res = None
+        collected = 0
+        try:
+            for edge, edge_state, held, task in runs:
+                for handler in held:
+                    handler.release()
+                collected += 1
+                res = await task
+                self._merge_edge_state(edge, edge_state, state)
+                if res is not None and res.should_continue:
+                    return res
+        finally:
+            for _, _, held, task in runs[collected:]:
+                for handler in held:
+                    handler.discard()
+                task.cancel()
+        return res
+
+    def execute(
+        self, user_input: NodeInput, state: ConversationState
+    ) -> Union[MessageOutput, EdgeOutput]:
         """Handles the current conversational state
         prompts the user, tries again, runs edges, etc.
         returns the result from an adge
         """
-        res = self.run_to_continue(user_input)
-        if res is None or not res.should_continue:
-            return self.no_edges_found(user_input)
-        else:
-            if res.next_node is not None:
-                res.next_node.set_node_input(res.result)
+        with trace(self.node_id, SpanKind.NODE) as span:
+            speculation = self._speculate(user_input, state)
+            try:
+                res = self.run_to_continue(user_input, state)
+            except BaseException:
+                if speculation is not None:
+                    speculation.discard()
+                raise
+            self._trace_result(span, res)
+            if res is None or not res.should_continue:
+                if speculation is not None:
+                    return speculation.result()
+                if not self._warm:
+                    set_attributes(cold_start=True)
+                    self.warm_up()
+                return self.no_edges_found(user_input, state)
+            else:
+                if speculation is not None:
+                    speculation.discard()
+                if res.next_node is not None:
+                    res.next_node.set_node_input(state, res.result)
 
-        return res
+            return res
+
+    async def aexecute(
+        self, user_input: NodeInput, state: ConversationState
+    ) -> Union[MessageOutput, EdgeOutput]:
+        """Async version of `execute`, edges are awaited so the event loop
+        is free to serve other conversations while waiting on the llm
+        """
+        with trace(self.node_id, SpanKind.NODE) as span:
+            speculation = self._aspeculate(user_input, state)
+            try:
+                res = await self.arun_to_continue(user_input, state)
+            except BaseException:
+                if speculation is not None:
+                    speculation.discard()
+                raise
+            self._trace_result(span, res)
+            if res is None or not res.should_continue:
+                if speculation is not None:
+                    return await speculation.result()
+                if not self._warm:
+                    set_attributes(cold_start=True)
+                    await self.awarm_up()
+                return await self.ano_edges_found(user_input, state)
+            else:
+                if speculation is not None:
+                    speculation.discard()
+                if res.next_node is not None:
+                    res.next_node.set_node_input(state, res.result)
+
+            return res
+
+    @staticmethod
+    def _trace_result(span, res: Optional[EdgeOutput]):
+        if span is None:
+            return
+        continues = res is not None and res.should_continue
+        span.attributes["edge_continued"] = continues
+        if continues and res.next_node is not None:
+            span.attributes["next_node"] = res.next_node.node_id
+
+    async def agreeting_message(
+        self, state: ConversationState
+    ) -> Optional[MessageOutput]:
+        """Async version of `greeting_message`, nodes that call an llm
+        to greet should override it"""
+        return self.greeting_message(state)
+
+    async def ano_edges_found(
+        self, user_input: NodeInput, state: ConversationState
+    ) -> Optional[MessageOutput]:
+        """Async version of `no_edges_found`, nodes that call an llm
+        when no edge continues should override it"""
+        return self.no_edges_found(user_input, state)
 
     @abc.abstractmethod
-    def greeting_message(self) -> Optional[MessageOutput]:
+    def greeting_message(self, state: ConversationState) -> Optional[MessageOutput]:
         pass
 
     @abc.abstractmethod
-    def no_edges_found(self, user_input: NodeInput) -> Optional[MessageOutput]:
+    def no_edges_found(
+        self, user_input: NodeInput, state: ConversationState
+    ) -> Optional[MessageOutput]:
         pass
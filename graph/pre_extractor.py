@@ -0,0 +1,52 @@
+import abc
+import re
+from typing import Callable, Optional, Type, Union
+
+from pydantic import BaseModel, ValidationError
+
+
+class PreExtractor(abc.ABC):
+
+    """Deterministic fast path of an edge, fills the edge result straight from
+    the user message so the llm is not called when the answer is obvious"""
+
+    @abc.abstractmethod
+    def extract(self, message: str) -> Optional[BaseModel]:
+        """The edge result when `message` matches confidently, None leaves the
+        decision to the llm"""
+        pass
+
+
+class RegexExtractor(PreExtractor):
+
+    """Builds `parse_class` from the named groups of the first match of
+    `pattern`, a match that does not validate is no match"""
+
+    def __init__(
+        self,
+        pattern: Union[str, "re.Pattern"],
+        parse_class: Type[BaseModel],
+        flags: int = re.IGNORECASE,
+    ):
+        self._pattern = re.compile(pattern, flags) if isinstance(pattern, str) else pattern
+        self._parse_class = parse_class
+
+    def extract(self, message: str) -> Optional[BaseModel]:
+        match = self._pattern.search(message)
+        if match is None:
+            return None
+        try:
+            return self._parse_class(**match.groupdict())
+        except ValidationError:
+            return None
+
+
+class RuleExtractor(PreExtractor):
+
+    """Delegates to `rule`, e.g. a lookup keyed by something found in the message"""
+
+    def __init__(self, rule: Callable[[str], Optional[BaseModel]]):
+        self._rule = rule
+
+    def extract(self, message: str) -> Optional[BaseModel]:
+        return self._rule(message)
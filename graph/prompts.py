@@ -0,0 +1,66 @@
+import string
+from typing import Dict, List
+
+from langchain.prompts import PromptTemplate
+
+from data.history import count_tokens
+
+_FORMATTER = string.Formatter()
+
+
+def _escape(text: str) -> str:
+    return text.replace("{", "{{").replace("}", "}}")
+
+
+class CompiledPromptTemplate(PromptTemplate):
+
+    """PromptTemplate rendered in two parts, the static prefix is rendered
+    once when the prompt is compiled and only the per-turn suffix is formatted
+    on every call. Keeping the static text first lets the provider prompt
+    cache and a local KV cache reuse it between turns and conversations."""
+
+    # literal text before the first per-turn variable
+    static_prefix: str = ""
+    # the rest of the template, formatted on every call
+    dynamic_template: str = ""
+    static_tokens: int = 0
+
+    def format(self, **kwargs) -> str:
+        kwargs = self._merge_partial_and_user_variables(**kwargs)
+        return self.static_prefix + self.dynamic_template.format(**kwargs)
+
+
+def compile_prompt(
+    template: str, static_values: Dict[str, str], input_variables: List[str]
+) -> CompiledPromptTemplate:
+    """Substitutes the `static_values` once, e.g. the format instructions,
+    and splits `template` at its first remaining variable.
+
+    Templates should be laid out with every static fragment ahead of the
+    per-turn variables, anything after the first of them is dynamic.
+    """
+    for name, value in static_values.items():
+        template = template.replace("{" + name + "}", _escape(value))
+
+    prefix: List[str] = []
+    suffix: List[str] = []
+    dynamic = False
+    for literal, field, spec, conversion in _FORMATTER.parse(template):
+        if dynamic:
+            suffix.append(_escape(literal))
+        else:
+            prefix.append(literal)
+            dynamic = field is not None
+        if field is not None:
+            conversion = f"!{conversion}" if conversion else ""
+            spec = f":{spec}" if spec else ""
+            suffix.append(f"{{{field}{conversion}{spec}}}")
+
+    static_prefix = "".join(prefix)
+    return CompiledPromptTemplate(
+        template=template,
+        input_variables=input_variables,
+        static_prefix=static_prefix,
+        dynamic_template="".join(suffix),
+        static_tokens=count_tokens(static_prefix),
+    )
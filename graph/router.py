@@ -0,0 +1,63 @@
+import abc
+import os
+import re
+from typing import Iterable, List, Set
+
+STOP_WORDS = {
+    "a", "about", "an", "and", "are", "as", "at", "be", "by", "can", "could",
+    "do", "does", "for", "from", "have", "how", "i", "if", "in", "is", "it",
+    "me", "my", "of", "on", "or", "please", "should", "so", "that", "the",
+    "this", "to", "was", "what", "when", "where", "which", "who", "why",
+    "will", "with", "would", "you", "your",
+}
+
+
+def content_words(text: str) -> List[str]:
+    return [
+        word
+        for word in re.findall(r"[a-z0-9]+", text.lower())
+        if word not in STOP_WORDS and len(word) > 1
+    ]
+
+
+class DomainClassifier(abc.ABC):
+
+    """Decides locally, without an llm, if a query can be answered by the
+    knowledge bases or should go to the default chain"""
+
+    @abc.abstractmethod
+    def is_in_domain(self, query: str) -> bool:
+        pass
+
+
+class KeywordDomainClassifier(DomainClassifier):
+
+    """In domain when enough of the query content words appear in the
+    knowledge base vocabulary"""
+
+    def __init__(self, vocabulary: Set[str], min_overlap: float = 0.3):
+        self._vocabulary = vocabulary
+        self._min_overlap = min_overlap
+
+    @classmethod
+    def from_texts(cls, texts: Iterable[str], min_overlap: float = 0.3):
+        vocabulary = set()
+        for text in texts:
+            vocabulary.update(content_words(text))
+        return cls(vocabulary, min_overlap)
+
+    @classmethod
+    def from_directories(cls, directories: Iterable[str], min_overlap: float = 0.3):
+        texts = []
+        for directory in directories:
+            for file_name in sorted(os.listdir(directory)):
+                with open(os.path.join(directory, file_name), encoding="utf-8") as f:
+                    texts.append(f.read())
+        return cls.from_texts(texts, min_overlap)
+
+    def is_in_domain(self, query: str) -> bool:
+        words = content_words(query)
+        if not words:
+            return False
+        known = sum(1 for word in words if word in self._vocabulary)
+        return known / len(words) >= self._min_overlap
@@ -0,0 +1,40 @@
+import threading
+from typing import Any, Callable, Dict, Hashable, TypeVar
+
+T = TypeVar("T")
+
+# process wide registry of heavy, read-only objects (llms, parsers, chains,
+# agents, retrievers) shared by every conversation
+_registry: Dict[Hashable, Any] = {}
+_lock = threading.RLock()
+# one lock per key being built, a slow factory, e.g. a background warm up,
+# only blocks the requests for the same object
+_key_locks: Dict[Hashable, threading.RLock] = {}
+
+
+def shared(key: Hashable, factory: Callable[[], T]) -> T:
+    """Returns the object registered under `key`, building it with `factory`
+    the first time it is requested.
+
+    The shared objects must not hold per-conversation state.
+    """
+    try:
+        return _registry[key]
+    except KeyError:
+        pass
+
+    with _lock:
+        key_lock = _key_locks.setdefault(key, threading.RLock())
+    with key_lock:
+        if key not in _registry:
+            value = factory()
+            with _lock:
+                _registry[key] = value
+        return _registry[key]
+
+
+def clear_shared():
+    """Drops every shared object, the next request rebuilds them"""
+    with _lock:
+        _registry.clear()
+        _key_locks.clear()
@@ -0,0 +1,187 @@
+import asyncio
+import contextvars
+import dataclasses
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Awaitable, Callable, List, Optional
+
+from graph.callbacks import HeldCallbackHandler
+from graph.shared import shared
+from graph.tracing import set_attributes
+
+
+@dataclasses.dataclass
+class SpeculationStats:
+    # fallbacks started before the edges were evaluated
+    launched: int = 0
+    # fallbacks whose answer was returned, no edge continued
+    used: int = 0
+    # fallbacks thrown away, running or done, because an edge continued
+    wasted: int = 0
+    # fallbacks thrown away before they started
+    cancelled: int = 0
+    # time spent by the wasted fallbacks
+    wasted_seconds: float = 0.0
+
+    @property
+    def waste_rate(self) -> float:
+        return (self.wasted + self.cancelled) / self.launched if self.launched else 0.0
+
+
+class SpeculationRecorder:
+
+    """SpeculationStats of a node, updated by the turns of every conversation"""
+
+    def __init__(self):
+        self._stats = SpeculationStats()
+        self._lock = threading.Lock()
+
+    def stats(self) -> SpeculationStats:
+        with self._lock:
+            return dataclasses.replace(self._stats)
+
+    def launched(self):
+        with self._lock:
+            self._stats.launched += 1
+
+    def used(self):
+        with self._lock:
+            self._stats.used += 1
+
+    def wasted(self, seconds: float):
+        with self._lock:
+            self._stats.wasted += 1
+            self._stats.wasted_seconds += seconds
+
+    def cancelled(self):
+        with self._lock:
+            self._stats.cancelled += 1
+
+
+def speculation_executor() -> ThreadPoolExecutor:
+    """Worker threads of the speculative fallbacks of every node"""
+    return shared(
+        (ThreadPoolExecutor, "speculation"),
+        lambda: ThreadPoolExecutor(max_workers=32, thread_name_prefix="speculation"),
+    )
+
+
+class _Timed:
+    def __init__(self):
+        self.started: Optional[float] = None
+        self.finished: Optional[float] = None
+
+    def elapsed(self) -> float:
+        if self.started is None:
+            return 0.0
+        return (self.finished or time.perf_counter()) - self.started
+
+
+class Speculation:
+
+    """Fallback running in a worker thread while the edges are evaluated, the
+    events of its user facing callbacks are held back until it is kept"""
+
+    def __init__(
+        self,
+        fallback: Callable[[], Any],
+        held: List[HeldCallbackHandler],
+        recorder: SpeculationRecorder,
+        context: contextvars.Context,
+    ):
+        """
+        fallback (callable): the work, e.g. `no_edges_found`
+        held (list): the user facing handlers the fallback reports to
+        recorder (SpeculationRecorder): of the node
+        context (Context): the fallback runs in it, with the held handlers
+        """
+        self._held = held
+        self._recorder = recorder
+        self._timing = _Timed()
+        recorder.launched()
+        self._future: Future = speculation_executor().submit(
+            context.run, self._run, fallback
+        )
+
+    def _run(self, fallback: Callable[[], Any]):
+        self._timing.started = time.perf_counter()
+        try:
+            return fallback()
+        finally:
+            self._timing.finished = time.perf_counter()
+
+    def result(self) -> Any:
+        """Keeps the fallback, the held events are replayed and the following
+        ones, e.g. the rest of the streamed answer, go straight through"""
+        for handler in self._held:
+            handler.release()
+        set_attributes(speculation="used")
+        self._recorder.used()
+        return self._future.result()
+
+    def discard(self):
+        """Throws the fallback away, a running thread can not be interrupted,
+        it finishes in the background and its time is counted as wasted"""
+        for handler in self._held:
+            handler.discard()
+        if self._future.cancel():
+            set_attributes(speculation="cancelled")
+            self._recorder.cancelled()
+            return
+        set_attributes(
+            speculation="wasted",
+            speculation_wasted_ms=round(self._timing.elapsed() * 1000, 3),
+        )
+        self._future.add_done_callback(
+            lambda _: self._recorder.wasted(self._timing.elapsed())
+        )
+
+
+class AsyncSpeculation:
+
+    """Async version of `Speculation`, the fallback is a task of the running
+    event loop and a discarded one is cancelled, its llm calls included"""
+
+    def __init__(
+        self,
+        fallback: Callable[[], Awaitable[Any]],
+        held: List[HeldCallbackHandler],
+        recorder: SpeculationRecorder,
+    ):
+        self._held = held
+        self._recorder = recorder
+        self._timing = _Timed()
+        recorder.launched()
+        # the task copies the context, with the held handlers, when created
+        self._task = asyncio.ensure_future(self._run(fallback))
+
+    async def _run(self, fallback: Callable[[], Awaitable[Any]]):
+        self._timing.started = time.perf_counter()
+        try:
+            return await fallback()
+        finally:
+            self._timing.finished = time.perf_counter()
+
+    async def result(self) -> Any:
+        for handler in self._held:
+            handler.release()
+        set_attributes(speculation="used")
+        self._recorder.used()
+        return await self._task
+
+    def discard(self):
+        for handler in self._held:
+            handler.discard()
+        self._task.cancel()
+        # the error of a fallback that failed before it was discarded is moot
+        self._task.add_done_callback(lambda task: task.cancelled() or task.exception())
+        if self._timing.started is None:
+            set_attributes(speculation="cancelled")
+            self._recorder.cancelled()
+            return
+        seconds = self._timing.elapsed()
+        set_attributes(
+            speculation="wasted", speculation_wasted_ms=round(seconds * 1000, 3)
+        )
+        self._recorder.wasted(seconds)
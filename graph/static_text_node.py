@@ -3,7 +3,7 @@ import abc
 from typing import List, Optional
 
 
-from data.graph import EdgeOutput
+from data.graph import ConversationState, EdgeOutput
 from graph.edge import BaseEdge
 from graph.node import BaseNode
 
@@ -20,10 +20,10 @@ class StaticTextNode(BaseNode[str]):
     def _node_static_retry(self, **kwargs) -> str:
         pass
 
-    def greeting_message(self):
+    def greeting_message(self, state: ConversationState):
         return self._node_static_prompt()
 
-    def no_edges_found(self, user_input: str) -> EdgeOutput:
+    def no_edges_found(self, user_input: str, state: ConversationState) -> EdgeOutput:
         return EdgeOutput(
             should_continue=False,
             result=self._node_static_retry(),
@@ -0,0 +1,87 @@
+import queue
+from typing import Any, Dict, Optional, Set
+from uuid import UUID
+
+from langchain.callbacks.base import BaseCallbackHandler
+
+from data.graph import StreamEvent, StreamEventType
+from graph.callbacks import STREAM_TAG
+
+
+class StreamingHandler(BaseCallbackHandler):
+
+    """Forwards the tokens of the user facing llm calls, and a system event for
+    every tool call and retrieval, to a queue read by the ui thread"""
+
+    # held back while its events may come from work that is thrown away
+    user_facing = True
+
+    # llm router chains answer with json, never shown to the user
+    _ROUTER_CHAINS = {"LLMRouterChain"}
+
+    def __init__(self, events: "queue.Queue[StreamEvent]"):
+        self._events = events
+        self._streaming_runs: Set[UUID] = set()
+        self._router_runs: Set[UUID] = set()
+
+    def _start_llm(self, run_id: UUID, parent_run_id: Optional[UUID], tags):
+        if tags and STREAM_TAG in tags and parent_run_id not in self._router_runs:
+            self._streaming_runs.add(run_id)
+
+    def on_llm_start(
+        self, serialized, prompts, *, run_id, parent_run_id=None, tags=None, **kwargs
+    ):
+        self._start_llm(run_id, parent_run_id, tags)
+
+    def on_chat_model_start(
+        self, serialized, messages, *, run_id, parent_run_id=None, tags=None, **kwargs
+    ):
+        self._start_llm(run_id, parent_run_id, tags)
+
+    def on_llm_new_token(self, token: str, *, run_id: UUID, **kwargs: Any):
+        if run_id in self._streaming_runs and token:
+            self._events.put(StreamEvent(StreamEventType.TOKEN, content=token))
+
+    def on_llm_end(self, response, *, run_id: UUID, **kwargs: Any):
+        self._streaming_runs.discard(run_id)
+
+    def on_llm_error(self, error, *, run_id: UUID, **kwargs: Any):
+        self._streaming_runs.discard(run_id)
+
+    def on_chain_start(
+        self,
+        serialized: Dict[str, Any],
+        inputs,
+        *,
+        run_id: UUID,
+        parent_run_id: Optional[UUID] = None,
+        **kwargs: Any,
+    ):
+        # the router calls the llm through an inner LLMChain, every chain
+        # below a router is tracked so its llm calls are not streamed either
+        if (
+            (serialized or {}).get("id", [""])[-1] in self._ROUTER_CHAINS
+            or parent_run_id in self._router_runs
+        ):
+            self._router_runs.add(run_id)
+
+    def on_chain_end(self, outputs, *, run_id: UUID, **kwargs: Any):
+        self._router_runs.discard(run_id)
+
+    def on_chain_error(self, error, *, run_id: UUID, **kwargs: Any):
+        self._router_runs.discard(run_id)
+
+    def on_tool_start(self, serialized: Dict[str, Any], input_str: str, **kwargs: Any):
+        name = (serialized or {}).get("name", "tool")
+        self._events.put(StreamEvent(StreamEventType.TOOL_START, content=name))
+
+    def on_tool_end(self, output: str, **kwargs: Any):
+        self._events.put(StreamEvent(StreamEventType.TOOL_END))
+
+    def on_retriever_start(
+        self, serialized: Dict[str, Any], query: str, **kwargs: Any
+    ):
+        self._events.put(StreamEvent(StreamEventType.RETRIEVER_START, content=query))
+
+    def on_retriever_end(self, documents, **kwargs: Any):
+        self._events.put(StreamEvent(StreamEventType.RETRIEVER_END))
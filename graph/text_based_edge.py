@@ -1,15 +1,18 @@
 import abc
-from typing import Type, Optional, Union
+from typing import Dict, List, Type, Optional, Union
 
-from langchain.chains import LLMChain
 from langchain.output_parsers import PydanticOutputParser
-from langchain.prompts import PromptTemplate
+from langchain.schema import OutputParserException
 from pydantic import BaseModel
 
-from data.chat import MessageHistory, Role
-from data.graph import MessageOutput
-from data.validation import Validation
+from data.chat import MessageHistory
+from data.graph import ConversationState, EdgeOutput, MessageOutput
+from data.validation import Validation, validated_model
+from graph.callbacks import get_callbacks
 from graph.edge import BaseEdge
+from graph.pre_extractor import PreExtractor
+from graph.prompts import compile_prompt
+from graph.shared import shared
 
 
 class PydanticTextBasedEdge(BaseEdge[MessageHistory, MessageOutput]):
@@ -27,86 +30,246 @@ class PydanticTextBasedEdge(BaseEdge[MessageHistory, MessageOutput]):
         llm_model,
         max_retries: Optional[int] = None,
         out_node=None,
+        priority: int = 0,
+        combined: bool = False,
+        pre_extractors: Optional[List[PreExtractor]] = None,
     ):
         """
         condition (str): a True/False question about the input
         parse_query (str): what the parser whould be extracting
         parse_class (Pydantic BaseModel): the structure of the parse
         llm (LangChain LLM): the large language model being used
+        priority (int): wins over lower priority edges of the same node
+        combined (bool): validate and extract with a single llm call, the
+            extraction call is only used when the combined answer is incomplete
+        pre_extractors (list): deterministic extractors tried before the llm,
+            a confident match continues without any llm call
         """
-        super().__init__(model=llm_model, max_retries=max_retries, out_node=out_node)
+        super().__init__(
+            model=llm_model,
+            max_retries=max_retries,
+            out_node=out_node,
+            priority=priority,
+            pre_extractors=pre_extractors,
+        )
         self.condition = condition
         self.parse_prompt = parse_prompt
         self.parse_class = parse_class
+        self._combined = combined
+
+    def _init_chain(self):
+        # parsers and chains only depend on the edge definition, they are
+        # built once and shared between every conversation
+        (
+            self._validation_parser,
+            self._extraction_parser,
+            self._validation_llm_chain,
+            self._extraction_llm_chain,
+            self._combined_parser,
+            self._combined_llm_chain,
+        ) = shared(
+            (
+                type(self),
+                id(self._llm_model),
+                self.condition,
+                self.parse_prompt,
+                self.parse_class,
+                self._combined,
+            ),
+            self._build_chains,
+        )
+
+    def _build_chains(self):
+        from graph.cached_chain import CachedLLMChain
+
         self._validation_parser = PydanticOutputParser(pydantic_object=Validation)
         self._extraction_parser = PydanticOutputParser(pydantic_object=self.parse_class)
-        self._validation_llm_chain = LLMChain(
-            llm=llm_model, prompt=self._get_validation_prompt_template()
+        self._validation_llm_chain = CachedLLMChain(
+            llm=self._llm_model, prompt=self._get_validation_prompt_template()
         )
-        self._extraction_llm_chain = LLMChain(
-            llm=llm_model, prompt=self._get_extraction_prompt_template()
+        self._extraction_llm_chain = CachedLLMChain(
+            llm=self._llm_model, prompt=self._get_extraction_prompt_template()
         )
 
+        self._combined_parser = None
+        self._combined_llm_chain = None
+        if self._combined:
+            self._combined_parser = PydanticOutputParser(
+                pydantic_object=validated_model(self.parse_class)
+            )
+            self._combined_llm_chain = CachedLLMChain(
+                llm=self._llm_model, prompt=self._get_combined_prompt_template()
+            )
+
+        return (
+            self._validation_parser,
+            self._extraction_parser,
+            self._validation_llm_chain,
+            self._extraction_llm_chain,
+            self._combined_parser,
+            self._combined_llm_chain,
+        )
+
+    # static instructions first and the per-turn history and input last, so
+    # consecutive calls share the longest possible prompt prefix
     def _get_validation_prompt_template(self):
         model_input = (
             "Answer the user query."
             "\n{format_instructions}"
+            "\nFollowing the output schema, does the input satisfy the condition?"
+            "\nCondition: {condition}"
             "\nConversation history:"
             "\n{history}"
+            "\nInput: {query}"
+        )
+
+        return compile_prompt(
+            model_input,
+            static_values={
+                "format_instructions": self._validation_parser.get_format_instructions(),
+                "condition": self.condition,
+            },
+            input_variables=["history", "query"],
+        )
+
+    def _get_combined_prompt_template(self):
+        model_input = (
+            "Answer the user query."
+            "\n{format_instructions}"
             "\nFollowing the output schema, does the input satisfy the condition?"
+            "\nOnly if it does, fill the result: {parse_prompt}"
             "\nCondition: {condition}"
+            "\nConversation history:"
+            "\n{history}"
             "\nInput: {query}"
         )
 
-        prompt = PromptTemplate(
-            template=model_input,
-            input_variables=["condition", "history"],
-            partial_variables={
-                "format_instructions": self._validation_parser.get_format_instructions()
+        return compile_prompt(
+            model_input,
+            static_values={
+                "format_instructions": self._combined_parser.get_format_instructions(),
+                "parse_prompt": self.parse_prompt,
+                "condition": self.condition,
             },
+            input_variables=["history", "query"],
         )
-        return prompt
 
     def _get_extraction_prompt_template(self):
         parse_query = "{parse_prompt}:" "\n{format_instructions}" "\n\nInput: {query}"
 
-        prompt = PromptTemplate(
-            template=parse_query,
-            input_variables=["parse_prompt"],
-            partial_variables={
-                "format_instructions": self._extraction_parser.get_format_instructions()
+        return compile_prompt(
+            parse_query,
+            static_values={
+                "parse_prompt": self.parse_prompt,
+                "format_instructions": self._extraction_parser.get_format_instructions(),
             },
+            input_variables=["query"],
         )
-        return prompt
+
+    def static_prompt_tokens(self) -> Dict[str, int]:
+        self.warm_up()
+        chains = {
+            "validation": self._validation_llm_chain,
+            "extraction": self._extraction_llm_chain,
+            "combined": self._combined_llm_chain,
+        }
+        return {
+            name: chain.prompt.static_tokens
+            for name, chain in chains.items()
+            if chain is not None
+        }
+
+    def _validation_inputs(self, user_input: MessageHistory) -> dict:
+        history = user_input.model_input().history
+        last_input = user_input.last_user_message()["content"]
+        return dict(query=last_input, history=history)
 
     def check(self, user_input: MessageHistory) -> bool:
         """ask the llm if the input satisfies the condition"""
-        history = "\n".join((str(user_input)).split("\n")[:-1])
-        last_input = (user_input.role_based_history(Role.USER)[-1])["content"]
-
         completion = self._validation_llm_chain.run(
-            query=last_input, condition=self.condition, history=history
+            **self._validation_inputs(user_input), callbacks=get_callbacks()
+        )
+        return self._validation_parser.parse(completion).is_valid
+
+    async def acheck(self, user_input: MessageHistory) -> bool:
+        completion = await self._validation_llm_chain.arun(
+            **self._validation_inputs(user_input), callbacks=get_callbacks()
         )
         return self._validation_parser.parse(completion).is_valid
 
     def _parse(self, user_input: MessageHistory) -> Union[str, BaseModel]:
         """ask the llm to parse the parse_class, based on the parse_prompt, from the input"""
         completion = self._extraction_llm_chain.run(
-            query=user_input, parse_prompt=self.parse_prompt
+            query=user_input, callbacks=get_callbacks()
         )
         base_model = self._extraction_parser.parse(completion)
 
         return base_model
 
+    async def _aparse(self, user_input: MessageHistory) -> Union[str, BaseModel]:
+        completion = await self._extraction_llm_chain.arun(
+            query=user_input, callbacks=get_callbacks()
+        )
+        return self._extraction_parser.parse(completion)
+
     def _predict(self, model_input: MessageHistory) -> str:
         return self._llm_model(model_input)
 
-    def execute(self, user_input: MessageHistory):
+    def _check_failed(self, state: ConversationState):
+        # the input does not satisfy the condition, the fail is counted but
+        # the edge never continues without the payload of its out node
+        self._add_fail(state)
+        return self._get_edge_output(should_continue=False, result=None, state=state)
+
+    def _combined_output(
+        self, completion: str, state: ConversationState
+    ) -> Optional[EdgeOutput]:
+        """Edge output of a combined completion, or None when the input is valid
+        but the payload is missing and the extraction call is needed"""
+        try:
+            validated = self._combined_parser.parse(completion)
+        except OutputParserException as parsing_exception:
+            return self._parse_failed(parsing_exception, state)
+
+        if not validated.is_valid:
+            return self._check_failed(state)
+        self._reset_fails(state)
+        if validated.result is None:
+            return None
+
+        return self._get_edge_output(
+            should_continue=True, result=validated.result, state=state
+        )
+
+    def _execute(self, user_input: MessageHistory, state: ConversationState):
+        if self._combined:
+            completion = self._combined_llm_chain.run(
+                callbacks=get_callbacks(),
+                **self._validation_inputs(user_input),
+            )
+            output = self._combined_output(completion, state)
+            if output is not None:
+                return output
+            return super()._execute(user_input, state)
+
         # input did't make it past the input condition for the edge
         if not self.check(user_input):
-            self._num_fails += 1
-            if self._max_retries is not None:
-                if self._num_fails >= self._max_retries:
-                    return self._get_edge_output(should_continue=True, result=None)
-            return self._get_edge_output(should_continue=False, result=None)
-        return super().execute(user_input)
+            return self._check_failed(state)
+        self._reset_fails(state)
+        return super()._execute(user_input, state)
+
+    async def _aexecute(self, user_input: MessageHistory, state: ConversationState):
+        if self._combined:
+            completion = await self._combined_llm_chain.arun(
+                callbacks=get_callbacks(),
+                **self._validation_inputs(user_input),
+            )
+            output = self._combined_output(completion, state)
+            if output is not None:
+                return output
+            return await super()._aexecute(user_input, state)
+
+        if not await self.acheck(user_input):
+            return self._check_failed(state)
+        self._reset_fails(state)
+        return await super()._aexecute(user_input, state)
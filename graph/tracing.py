@@ -0,0 +1,372 @@
+import abc
+import collections
+import contextlib
+import contextvars
+import json
+import secrets
+import threading
+import time
+from typing import Any, Deque, Dict, Iterator, List, Optional
+from uuid import UUID
+
+from langchain.callbacks.base import BaseCallbackHandler
+
+from data.history import count_tokens
+from data.tracing import Span, SpanKind
+from graph.callbacks import use_callbacks
+
+
+class SpanSink(abc.ABC):
+
+    """Receives every finished span, sinks are called from the threads the
+    spans finish on and must be thread safe"""
+
+    @abc.abstractmethod
+    def export(self, span: Span):
+        pass
+
+    def close(self):
+        pass
+
+
+class RingBufferSink(SpanSink):
+
+    """Keeps the last `max_spans` spans in memory"""
+
+    def __init__(self, max_spans: int = 4096):
+        self._spans: Deque[Span] = collections.deque(maxlen=max_spans)
+        self._lock = threading.Lock()
+
+    def export(self, span: Span):
+        with self._lock:
+            self._spans.append(span)
+
+    def spans(self, trace_id: Optional[str] = None) -> List[Span]:
+        with self._lock:
+            spans = list(self._spans)
+        if trace_id is None:
+            return spans
+        return [span for span in spans if span.trace_id == trace_id]
+
+
+class JsonlSink(SpanSink):
+
+    """Appends one JSON object per span to `path`"""
+
+    def __init__(self, path: str):
+        self._file = open(path, "a", encoding="utf-8")
+        self._lock = threading.Lock()
+
+    def _line(self, span: Span) -> str:
+        return json.dumps(span.to_dict(), default=str)
+
+    def export(self, span: Span):
+        line = self._line(span)
+        with self._lock:
+            self._file.write(line + "\n")
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+def _otlp_value(value: Any) -> Dict[str, Any]:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def to_otlp(span: Span, service_name: str = "customer-support") -> Dict[str, Any]:
+    """`span` as an OTLP/JSON ExportTraceServiceRequest, the format accepted by
+    OpenTelemetry collectors on /v1/traces and by their file receivers"""
+    attributes = dict(span.attributes, **{"graph.span_kind": str(span.kind)})
+    otlp_span = {
+        "traceId": span.trace_id,
+        "spanId": span.span_id,
+        "name": span.name,
+        # SPAN_KIND_INTERNAL
+        "kind": 1,
+        "startTimeUnixNano": str(span.start_ns),
+        "endTimeUnixNano": str(span.end_ns or span.start_ns),
+        "attributes": [
+            {"key": key, "value": _otlp_value(value)}
+            for key, value in attributes.items()
+            if value is not None
+        ],
+        # STATUS_CODE_ERROR or STATUS_CODE_UNSET
+        "status": {"code": 2, "message": span.error} if span.error else {},
+    }
+    if span.parent_id is not None:
+        otlp_span["parentSpanId"] = span.parent_id
+
+    return {
+        "resourceSpans": [
+            {
+                "resource": {
+                    "attributes": [
+                        {"key": "service.name", "value": _otlp_value(service_name)}
+                    ]
+                },
+                "scopeSpans": [
+                    {"scope": {"name": "graph.tracing"}, "spans": [otlp_span]}
+                ],
+            }
+        ]
+    }
+
+
+class OtlpJsonSink(JsonlSink):
+
+    """Appends one OTLP/JSON request per span to `path`, can be replayed into
+    any OpenTelemetry collector"""
+
+    def __init__(self, path: str, service_name: str = "customer-support"):
+        super().__init__(path)
+        self._service_name = service_name
+
+    def _line(self, span: Span) -> str:
+        return json.dumps(to_otlp(span, self._service_name), default=str)
+
+
+# span the code running in this context is part of
+_current_span: contextvars.ContextVar[Optional[Span]] = contextvars.ContextVar(
+    "graph_current_span", default=None
+)
+
+
+class Tracer:
+
+    """Creates the spans and hands the finished ones to the sinks"""
+
+    def __init__(self, sinks: List[SpanSink]):
+        self._sinks = sinks
+        self.handler = TracingHandler(self)
+
+    def start_span(
+        self,
+        name: str,
+        kind: SpanKind,
+        parent: Optional[Span] = None,
+        attributes: Optional[Dict[str, Any]] = None,
+    ) -> Span:
+        return Span(
+            name=name,
+            kind=kind,
+            trace_id=parent.trace_id if parent else secrets.token_hex(16),
+            span_id=secrets.token_hex(8),
+            parent_id=parent.span_id if parent else None,
+            start_ns=time.time_ns(),
+            attributes=dict(attributes or {}),
+        )
+
+    def end_span(self, span: Span, error: Optional[BaseException] = None):
+        span.end_ns = time.time_ns()
+        if error is not None:
+            span.error = f"{type(error).__name__}: {error}"
+        for sink in self._sinks:
+            sink.export(span)
+
+    @contextlib.contextmanager
+    def span(self, name: str, kind: SpanKind, **attributes: Any) -> Iterator[Span]:
+        """Times the block as a child of the current span"""
+        span = self.start_span(name, kind, _current_span.get(), attributes)
+        token = _current_span.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            self.end_span(span, e)
+            raise
+        else:
+            self.end_span(span)
+        finally:
+            _current_span.reset(token)
+
+    def close(self):
+        for sink in self._sinks:
+            sink.close()
+
+
+_tracer: contextvars.ContextVar[Optional[Tracer]] = contextvars.ContextVar(
+    "graph_tracer", default=None
+)
+
+
+def get_tracer() -> Optional[Tracer]:
+    return _tracer.get()
+
+
+@contextlib.contextmanager
+def use_tracer(tracer: Optional[Tracer]):
+    """Traces the graph and every llm, tool and retriever call made inside
+    the block, nothing is recorded when `tracer` is None"""
+    if tracer is None:
+        yield
+        return
+
+    token = _tracer.set(tracer)
+    try:
+        with use_callbacks([tracer.handler]):
+            yield
+    finally:
+        _tracer.reset(token)
+
+
+@contextlib.contextmanager
+def trace(name: str, kind: SpanKind, **attributes: Any) -> Iterator[Optional[Span]]:
+    """Span of the block when a tracer is in use, yields None otherwise"""
+    tracer = _tracer.get()
+    if tracer is None:
+        yield None
+        return
+    with tracer.span(name, kind, **attributes) as span:
+        yield span
+
+
+def set_attributes(**attributes: Any):
+    """Adds `attributes` to the current span, if any"""
+    span = _current_span.get()
+    if span is not None:
+        span.attributes.update(attributes)
+
+
+def increment_attributes(**increments: int):
+    """Adds `increments` to the counters of the current span, if any"""
+    span = _current_span.get()
+    if span is not None:
+        for name, increment in increments.items():
+            span.attributes[name] = span.attributes.get(name, 0) + increment
+
+
+class TracingHandler(BaseCallbackHandler):
+
+    """Turns the LangChain run events into spans, runs without a traced
+    parent run are attached to the node or edge span that started them"""
+
+    # called on the event loop in async runs, so the current span is visible
+    run_inline = True
+
+    def __init__(self, tracer: Tracer):
+        self._tracer = tracer
+        self._runs: Dict[UUID, Span] = {}
+        self._lock = threading.Lock()
+
+    def _start(
+        self,
+        run_id: UUID,
+        parent_run_id: Optional[UUID],
+        name: str,
+        kind: SpanKind,
+        **attributes: Any,
+    ):
+        with self._lock:
+            parent = self._runs.get(parent_run_id) if parent_run_id else None
+        span = self._tracer.start_span(
+            name, kind, parent or _current_span.get(), attributes
+        )
+        with self._lock:
+            self._runs[run_id] = span
+
+    def _end(
+        self, run_id: UUID, error: Optional[BaseException] = None, **attributes: Any
+    ):
+        with self._lock:
+            span = self._runs.pop(run_id, None)
+        if span is not None:
+            span.attributes.update(attributes)
+            self._tracer.end_span(span, error)
+
+    @staticmethod
+    def _name(serialized: Optional[Dict[str, Any]], default: str) -> str:
+        serialized = serialized or {}
+        return serialized.get("name") or (serialized.get("id") or [default])[-1]
+
+    def on_llm_start(
+        self, serialized, prompts, *, run_id, parent_run_id=None, **kwargs
+    ):
+        self._start(
+            run_id,
+            parent_run_id,
+            self._name(serialized, "llm"),
+            SpanKind.LLM,
+            prompt_tokens=sum(count_tokens(prompt) for prompt in prompts),
+        )
+
+    def on_chat_model_start(
+        self, serialized, messages, *, run_id, parent_run_id=None, **kwargs
+    ):
+        self._start(
+            run_id,
+            parent_run_id,
+            self._name(serialized, "chat_model"),
+            SpanKind.LLM,
+            prompt_tokens=sum(
+                count_tokens(str(message.content))
+                for batch in messages
+                for message in batch
+            ),
+        )
+
+    def on_llm_end(self, response, *, run_id: UUID, **kwargs: Any):
+        usage = (response.llm_output or {}).get("token_usage") or {}
+        attributes = {
+            "completion_tokens": usage.get("completion_tokens")
+            or sum(
+                count_tokens(generation.text)
+                for generations in response.generations
+                for generation in generations
+            )
+        }
+        if usage.get("prompt_tokens"):
+            attributes["prompt_tokens"] = usage["prompt_tokens"]
+        self._end(run_id, **attributes)
+
+    def on_llm_error(self, error, *, run_id: UUID, **kwargs: Any):
+        self._end(run_id, error)
+
+    def on_chain_start(
+        self, serialized, inputs, *, run_id, parent_run_id=None, **kwargs
+    ):
+        self._start(
+            run_id, parent_run_id, self._name(serialized, "chain"), SpanKind.CHAIN
+        )
+
+    def on_chain_end(self, outputs, *, run_id: UUID, **kwargs: Any):
+        self._end(run_id)
+
+    def on_chain_error(self, error, *, run_id: UUID, **kwargs: Any):
+        self._end(run_id, error)
+
+    def on_tool_start(
+        self, serialized, input_str, *, run_id, parent_run_id=None, **kwargs
+    ):
+        self._start(
+            run_id, parent_run_id, self._name(serialized, "tool"), SpanKind.TOOL
+        )
+
+    def on_tool_end(self, output, *, run_id: UUID, **kwargs: Any):
+        self._end(run_id)
+
+    def on_tool_error(self, error, *, run_id: UUID, **kwargs: Any):
+        self._end(run_id, error)
+
+    def on_retriever_start(
+        self, serialized, query, *, run_id, parent_run_id=None, **kwargs
+    ):
+        self._start(
+            run_id,
+            parent_run_id,
+            self._name(serialized, "retriever"),
+            SpanKind.RETRIEVER,
+            query_tokens=count_tokens(query),
+        )
+
+    def on_retriever_end(self, documents, *, run_id: UUID, **kwargs: Any):
+        self._end(run_id, documents=len(documents))
+
+    def on_retriever_error(self, error, *, run_id: UUID, **kwargs: Any):
+        self._end(run_id, error)
@@ -0,0 +1,487 @@
+import asyncio
+import copy
+import dataclasses
+import json
+import os
+import random
+import threading
+import time
+import weakref
+from concurrent.futures import Future
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Dict,
+    Hashable,
+    List,
+    Optional,
+    Tuple,
+    TypeVar,
+)
+
+import httpx
+import openai
+from langchain.callbacks.manager import (
+    AsyncCallbackManagerForLLMRun,
+    CallbackManagerForLLMRun,
+)
+from langchain.chat_models import ChatOpenAI
+from langchain.schema import ChatResult
+from langchain.schema.messages import BaseMessage
+
+from data.history import count_tokens
+from graph.shared import shared
+
+T = TypeVar("T")
+
+# completion tokens reserved for a request that does not set `max_tokens`
+DEFAULT_COMPLETION_TOKENS = 256
+
+# errors worth retrying, anything else is the caller's fault
+RETRYABLE_ERRORS = (
+    openai.RateLimitError,
+    openai.APIConnectionError,
+    openai.APITimeoutError,
+    openai.InternalServerError,
+)
+
+# outcome of a coalesced request whose leader was cancelled
+_ABANDONED = object()
+
+
+class StreamInterruptedError(Exception):
+
+    """A streamed completion failed after some of its tokens reached the
+    callbacks, it is not retried, the retry would send them again"""
+
+
+class _TokenTracker:
+
+    """Run manager of a streamed request that remembers whether a token was
+    handed to the callbacks, everything else goes to `run_manager`"""
+
+    def __init__(self, run_manager):
+        self._run_manager = run_manager
+        self.streamed = False
+
+    def on_llm_new_token(self, *args, **kwargs):
+        self.streamed = True
+        return self._run_manager.on_llm_new_token(*args, **kwargs)
+
+    def __getattr__(self, name: str):
+        return getattr(self._run_manager, name)
+
+
+class _AsyncTokenTracker(_TokenTracker):
+    async def on_llm_new_token(self, *args, **kwargs):
+        self.streamed = True
+        return await self._run_manager.on_llm_new_token(*args, **kwargs)
+
+
+@dataclasses.dataclass
+class RateLimits:
+    # None disables the limit
+    requests_per_minute: Optional[int] = 3500
+    tokens_per_minute: Optional[int] = 90000
+    # requests in flight at once among the threads, and on each event loop
+    max_concurrency: int = 16
+    max_retries: int = 6
+    # seconds, the backoff doubles on every attempt up to `max_backoff`
+    initial_backoff: float = 0.5
+    max_backoff: float = 30.0
+
+
+class TokenBucket:
+
+    """Refills `capacity` units per minute. A caller reserves what it needs
+    and waits until the bucket has refilled it, so callers are served in the
+    order they arrive and a large request is never starved by small ones."""
+
+    def __init__(self, capacity: int):
+        self._capacity = float(capacity)
+        self._rate = capacity / 60
+        self._level = float(capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, amount: float) -> float:
+        """Takes `amount` from the bucket, returns the seconds to wait for it"""
+        amount = min(amount, self._capacity)
+        with self._lock:
+            now = time.monotonic()
+            self._level = min(
+                self._capacity, self._level + (now - self._updated) * self._rate
+            )
+            self._updated = now
+            self._level -= amount
+            return max(0.0, -self._level / self._rate)
+
+    def acquire(self, amount: float = 1) -> float:
+        delay = self.reserve(amount)
+        if delay:
+            time.sleep(delay)
+        return delay
+
+    async def aacquire(self, amount: float = 1) -> float:
+        delay = self.reserve(amount)
+        if delay:
+            await asyncio.sleep(delay)
+        return delay
+
+
+class _LoopCompletions:
+
+    """`chat.completions` of the pool's async client of the running event
+    loop, httpx async connections cannot be shared between loops"""
+
+    def __init__(self, pool: "LLMClientPool"):
+        self._pool = pool
+
+    async def create(self, **kwargs):
+        return await self._pool.async_client().chat.completions.create(**kwargs)
+
+
+class LLMClientPool:
+
+    """Process wide layer between the chat models and the OpenAI API
+
+    Every model built by `chat_model` shares one HTTP connection pool, the
+    requests and tokens per minute buckets and the concurrency cap. Transient
+    errors are retried with jittered exponential backoff, honoring the
+    `retry-after` of 429 responses, and identical temperature 0 requests in
+    flight at the same time are sent once.
+    """
+
+    def __init__(
+        self,
+        limits: Optional[RateLimits] = None,
+        api_key: Optional[str] = None,
+        base_url: Optional[str] = None,
+        timeout: float = 60.0,
+    ):
+        """
+        limits (RateLimits): rate limits, concurrency cap and retry policy
+        api_key (str): defaults to OPENAI_API_KEY
+        base_url (str): defaults to OPENAI_API_BASE, point it to a local stub
+            server to test without the OpenAI API
+        timeout (float): seconds before a request is abandoned and retried
+        """
+        self.limits = limits or RateLimits()
+        self._api_key = api_key or os.getenv("OPENAI_API_KEY")
+        self._base_url = base_url or os.getenv("OPENAI_API_BASE")
+        self._timeout = timeout
+
+        self._requests = (
+            TokenBucket(self.limits.requests_per_minute)
+            if self.limits.requests_per_minute
+            else None
+        )
+        self._tokens = (
+            TokenBucket(self.limits.tokens_per_minute)
+            if self.limits.tokens_per_minute
+            else None
+        )
+        self._semaphore = threading.BoundedSemaphore(self.limits.max_concurrency)
+        self._loop_semaphores: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()
+        self._loop_clients: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()
+
+        self._http_limits = httpx.Limits(
+            max_connections=self.limits.max_concurrency,
+            max_keepalive_connections=self.limits.max_concurrency,
+        )
+        # retries are done by the pool, the client must not retry on its own
+        self._client = openai.OpenAI(
+            api_key=self._api_key,
+            base_url=self._base_url,
+            timeout=timeout,
+            max_retries=0,
+            http_client=httpx.Client(limits=self._http_limits, timeout=timeout),
+        )
+
+        self._lock = threading.Lock()
+        self._models: Dict[Hashable, ChatOpenAI] = {}
+        self._in_flight: Dict[Hashable, Future] = {}
+
+        self.requests = 0
+        self.retries = 0
+        self.coalesced = 0
+        self.throttled_seconds = 0.0
+
+    @property
+    def client(self) -> openai.OpenAI:
+        return self._client
+
+    def async_client(self) -> openai.AsyncOpenAI:
+        """The async client of the running event loop"""
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            client = self._loop_clients.get(loop)
+            if client is None:
+                client = self._loop_clients[loop] = openai.AsyncOpenAI(
+                    api_key=self._api_key,
+                    base_url=self._base_url,
+                    timeout=self._timeout,
+                    max_retries=0,
+                    http_client=httpx.AsyncClient(
+                        limits=self._http_limits, timeout=self._timeout
+                    ),
+                )
+            return client
+
+    def _loop_semaphore(self) -> asyncio.Semaphore:
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            semaphore = self._loop_semaphores.get(loop)
+            if semaphore is None:
+                semaphore = self._loop_semaphores[loop] = asyncio.Semaphore(
+                    self.limits.max_concurrency
+                )
+            return semaphore
+
+    def chat_model(
+        self, model_name: str = "gpt-3.5-turbo", temperature: float = 0.7, **kwargs
+    ) -> "PooledChatOpenAI":
+        """The pooled chat model with these settings, built once per pool"""
+        key = (model_name, temperature, json.dumps(kwargs, sort_keys=True, default=repr))
+        with self._lock:
+            if key not in self._models:
+                self._models[key] = PooledChatOpenAI(
+                    pool=self,
+                    model_name=model_name,
+                    temperature=temperature,
+                    openai_api_key=self._api_key,
+                    openai_api_base=self._base_url,
+                    max_retries=0,
+                    client=self._client.chat.completions,
+                    async_client=_LoopCompletions(self),
+                    **kwargs,
+                )
+            return self._models[key]
+
+    def _backoff(self, attempt: int, error: Exception) -> float:
+        delay = random.uniform(
+            0, min(self.limits.max_backoff, self.limits.initial_backoff * 2**attempt)
+        )
+        response = getattr(error, "response", None)
+        if response is not None:
+            try:
+                delay = max(delay, float(response.headers.get("retry-after", 0)))
+            except ValueError:
+                pass
+        return delay
+
+    def _count(self, throttled: float, retry: bool = False):
+        with self._lock:
+            self.throttled_seconds += throttled
+            if retry:
+                self.retries += 1
+            else:
+                self.requests += 1
+
+    def call(self, request: Callable[[], T], tokens: int) -> T:
+        """Runs `request` within the limits, retrying the transient errors"""
+        for attempt in range(self.limits.max_retries + 1):
+            throttled = 0.0
+            if self._requests is not None:
+                throttled += self._requests.acquire()
+            if self._tokens is not None:
+                throttled += self._tokens.acquire(tokens)
+            self._count(throttled)
+            try:
+                with self._semaphore:
+                    return request()
+            except RETRYABLE_ERRORS as e:
+                if attempt == self.limits.max_retries:
+                    raise
+                self._count(0.0, retry=True)
+                time.sleep(self._backoff(attempt, e))
+        raise AssertionError("unreachable")
+
+    async def acall(self, request: Callable[[], Awaitable[T]], tokens: int) -> T:
+        for attempt in range(self.limits.max_retries + 1):
+            throttled = 0.0
+            if self._requests is not None:
+                throttled += await self._requests.aacquire()
+            if self._tokens is not None:
+                throttled += await self._tokens.aacquire(tokens)
+            self._count(throttled)
+            try:
+                async with self._loop_semaphore():
+                    return await request()
+            except RETRYABLE_ERRORS as e:
+                if attempt == self.limits.max_retries:
+                    raise
+                self._count(0.0, retry=True)
+                await asyncio.sleep(self._backoff(attempt, e))
+        raise AssertionError("unreachable")
+
+    def _join(self, key: Optional[Hashable]) -> Tuple[Optional[Future], bool]:
+        """The in flight future of `key` and whether the caller must resolve it"""
+        if key is None:
+            return None, True
+        with self._lock:
+            future = self._in_flight.get(key)
+            if future is not None:
+                self.coalesced += 1
+                return future, False
+            future = self._in_flight[key] = Future()
+            return future, True
+
+    def _resolve(self, key: Optional[Hashable], future: Optional[Future], outcome):
+        if future is None:
+            return
+        with self._lock:
+            del self._in_flight[key]
+        if isinstance(outcome, BaseException):
+            future.set_exception(outcome)
+        else:
+            future.set_result(outcome)
+
+    def coalesce(self, key: Optional[Hashable], request: Callable[[], T]) -> T:
+        """Runs `request` unless a request with the same `key` is in flight,
+        in which case its result is shared. A None key is never coalesced."""
+        while True:
+            future, leader = self._join(key)
+            if not leader:
+                outcome = future.result()
+                if outcome is _ABANDONED:
+                    # the leader was a cancelled `acoalesce`
+                    continue
+                return copy.deepcopy(outcome)
+            try:
+                result = request()
+            except BaseException as e:
+                self._resolve(key, future, e)
+                raise
+            self._resolve(key, future, result)
+            return result
+
+    async def acoalesce(
+        self, key: Optional[Hashable], request: Callable[[], Awaitable[T]]
+    ) -> T:
+        while True:
+            future, leader = self._join(key)
+            if not leader:
+                # a cancelled follower must not cancel the shared future
+                outcome = await asyncio.shield(asyncio.wrap_future(future))
+                if outcome is _ABANDONED:
+                    continue
+                return copy.deepcopy(outcome)
+            try:
+                result = await request()
+            except asyncio.CancelledError:
+                # only the leader went away, e.g. a discarded speculative
+                # fallback, a follower sends the request again instead
+                self._resolve(key, future, _ABANDONED)
+                raise
+            except BaseException as e:
+                self._resolve(key, future, e)
+                raise
+            self._resolve(key, future, result)
+            return result
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "retries": self.retries,
+                "coalesced": self.coalesced,
+                "throttled_seconds": round(self.throttled_seconds, 3),
+            }
+
+
+class PooledChatOpenAI(ChatOpenAI):
+
+    """ChatOpenAI sending its requests through an LLMClientPool"""
+
+    pool: LLMClientPool
+
+    def _estimate_tokens(self, messages: List[BaseMessage]) -> int:
+        prompt = sum(count_tokens(str(message.content)) for message in messages)
+        return prompt + (self.max_tokens or DEFAULT_COMPLETION_TOKENS) * self.n
+
+    def _coalesce_key(
+        self, messages: List[BaseMessage], stop: Optional[List[str]], kwargs: dict
+    ) -> Optional[Hashable]:
+        """Only deterministic requests can share their completion"""
+        if self.temperature != 0 or self.n != 1:
+            return None
+        message_dicts, params = self._create_message_dicts(messages, stop)
+        params = {**params, **kwargs}
+        params.pop("stream", None)
+        return (
+            self.openai_api_base,
+            json.dumps([message_dicts, params], sort_keys=True, default=repr),
+        )
+
+    def _generate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        stream: Optional[bool] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        key = self._coalesce_key(messages, stop, kwargs)
+        leader = []
+
+        def attempt() -> ChatResult:
+            tracker = _TokenTracker(run_manager) if run_manager else None
+            try:
+                return super(PooledChatOpenAI, self)._generate(
+                    messages, stop=stop, run_manager=tracker, stream=stream, **kwargs
+                )
+            except RETRYABLE_ERRORS as e:
+                if tracker is not None and tracker.streamed:
+                    raise StreamInterruptedError(str(e)) from e
+                raise
+
+        def request() -> ChatResult:
+            leader.append(True)
+            return self.pool.call(attempt, self._estimate_tokens(messages))
+
+        result = self.pool.coalesce(key, request)
+        if not leader and run_manager and self._streams(stream):
+            # a shared completion arrives in one piece
+            run_manager.on_llm_new_token(result.generations[0].text)
+        return result
+
+    async def _agenerate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        stream: Optional[bool] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        key = self._coalesce_key(messages, stop, kwargs)
+        leader = []
+
+        async def attempt() -> ChatResult:
+            tracker = _AsyncTokenTracker(run_manager) if run_manager else None
+            try:
+                return await super(PooledChatOpenAI, self)._agenerate(
+                    messages, stop=stop, run_manager=tracker, stream=stream, **kwargs
+                )
+            except RETRYABLE_ERRORS as e:
+                if tracker is not None and tracker.streamed:
+                    raise StreamInterruptedError(str(e)) from e
+                raise
+
+        async def request() -> ChatResult:
+            leader.append(True)
+            return await self.pool.acall(attempt, self._estimate_tokens(messages))
+
+        result = await self.pool.acoalesce(key, request)
+        if not leader and run_manager and self._streams(stream):
+            await run_manager.on_llm_new_token(result.generations[0].text)
+        return result
+
+    def _streams(self, stream: Optional[bool]) -> bool:
+        return stream if stream is not None else self.streaming
+
+
+def default_pool() -> LLMClientPool:
+    """The pool shared by every model of the process"""
+    return shared(LLMClientPool, LLMClientPool)
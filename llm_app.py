@@ -2,6 +2,10 @@ import streamlit as st
 
 
 from customer_support import CustomerSupportPipeline
+from data.chat import Role
+from data.graph import StreamEventType
+from graph.shared import shared
+from session.store import SQLiteSessionStore
 from ui.graph_renderer import GraphRenderer
 
 import os
@@ -17,13 +21,35 @@ st.title("Hi, I'm your Shopify Agent")
 
 chatbot_started = False
 
+SESSION_DB = "chroma_db/sessions.sqlite3"
 
-def get_answer(query: str, pipeline):
+
+def get_session_store():
+    """One store per process, shared by every browser session"""
+    return shared(
+        (SQLiteSessionStore, SESSION_DB), lambda: SQLiteSessionStore(SESSION_DB)
+    )
+
+
+def stream_answer(query: str, pipeline, message_placeholder):
     """
-    Queries the model with a given question and returns the answer.
+    Queries the model with a given question, rendering the answer as it is
+    generated, returns the complete answers.
     """
-    res, is_over = pipeline.run(query)
-    return res, is_over
+    responses, is_over, streamed = [], False, ""
+    for event in pipeline.stream(query):
+        if event.type == StreamEventType.TOKEN:
+            streamed += event.content
+            message_placeholder.markdown(streamed + "▌")
+        elif event.type == StreamEventType.TOOL_START:
+            message_placeholder.markdown(f"_Running {event.content}..._")
+        elif event.type == StreamEventType.RETRIEVER_START:
+            message_placeholder.markdown("_Searching the Help Center..._")
+        elif event.type == StreamEventType.MESSAGE:
+            responses.append(event.message)
+        elif event.type == StreamEventType.DONE:
+            is_over = event.is_over
+    return responses, is_over
 
 
 def start_chatbot():
@@ -34,13 +60,27 @@ def start_chatbot():
             st.session_state.messages = []
 
         if "pipeline" not in st.session_state:
-            pipeline = CustomerSupportPipeline()
+            # the session id lives in the url, so a reload or another worker
+            # resumes the same conversation
+            session_id = st.experimental_get_query_params().get("session", [None])[0]
+            pipeline = CustomerSupportPipeline(
+                session_store=get_session_store(), session_id=session_id
+            )
+            st.experimental_set_query_params(session=pipeline.session_id)
             st.session_state.pipeline = pipeline
-            res, is_over = pipeline.run("")
-            for prompt in res:
-                st.session_state.messages.append(
-                    {"role": "assistant", "content": prompt.message}
-                )
+
+            if pipeline.current_node_id is None:
+                res, is_over = pipeline.run("")
+                for prompt in res:
+                    st.session_state.messages.append(
+                        {"role": "assistant", "content": prompt.message}
+                    )
+            else:
+                st.session_state.messages = [
+                    {"role": str(message["role"]), "content": message["content"]}
+                    for message in pipeline.messages
+                    if message["role"] in (Role.USER, Role.ASSISTANT)
+                ]
         else:
             pipeline = st.session_state.pipeline
 
@@ -55,8 +95,8 @@ def start_chatbot():
 
         with st.chat_message("assistant"):
             message_placeholder = st.empty()
-            responses, is_over = get_answer(
-                st.session_state.messages[-1]["content"], pipeline
+            responses, is_over = stream_answer(
+                st.session_state.messages[-1]["content"], pipeline, message_placeholder
             )
 
             for full_response in responses:
@@ -67,9 +107,7 @@ def start_chatbot():
                 )
 
     with tab2:
-        st.session_state._graph = GraphRenderer().get(
-            type(pipeline._current_node).__name__
-        )
+        st.session_state._graph = GraphRenderer().get(pipeline.current_node_id)
 
         st.graphviz_chart(st.session_state._graph, use_container_width=True)
 
@@ -0,0 +1,263 @@
+import abc
+import dataclasses
+import importlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+from pydantic import BaseModel
+
+
+@dataclasses.dataclass
+class SessionRecord:
+    """Everything needed to resume a conversation on any worker"""
+
+    session_id: str
+    messages: List[dict]
+    current_node: Optional[str] = None
+    # results of the edges that led to the nodes, by node id
+    node_inputs: Dict[str, Any] = dataclasses.field(default_factory=dict)
+    num_fails: Dict[str, int] = dataclasses.field(default_factory=dict)
+    updated_at: float = dataclasses.field(default_factory=time.time)
+
+
+def _class_path(cls: type) -> str:
+    return f"{cls.__module__}:{cls.__qualname__}"
+
+
+def _load_class(path: str) -> type:
+    module, name = path.split(":")
+    return getattr(importlib.import_module(module), name)
+
+
+def encode_value(value: Any) -> Any:
+    """JSON friendly version of a node input, pydantic models and dataclasses
+    keep their class so they are rebuilt on load"""
+    if isinstance(value, BaseModel):
+        return {"__model__": _class_path(type(value)), "data": value.model_dump()}
+    if dataclasses.is_dataclass(value) and not isinstance(value, type):
+        return {
+            "__dataclass__": _class_path(type(value)),
+            "data": {k: encode_value(v) for k, v in vars(value).items()},
+        }
+    return value
+
+
+def decode_value(value: Any) -> Any:
+    if isinstance(value, dict):
+        if "__model__" in value:
+            return _load_class(value["__model__"]).model_validate(value["data"])
+        if "__dataclass__" in value:
+            data = {k: decode_value(v) for k, v in value["data"].items()}
+            return _load_class(value["__dataclass__"])(**data)
+    return value
+
+
+class SessionStore(abc.ABC):
+
+    """Persists the conversations so any worker can serve the next turn"""
+
+    @abc.abstractmethod
+    def load(self, session_id: str) -> Optional[SessionRecord]:
+        pass
+
+    @abc.abstractmethod
+    def save(self, record: SessionRecord):
+        pass
+
+    @abc.abstractmethod
+    def delete(self, session_id: str):
+        pass
+
+    def flush(self):
+        """Writes the pending records, when the store batches them"""
+        pass
+
+    def close(self):
+        self.flush()
+
+
+class InMemorySessionStore(SessionStore):
+    def __init__(self):
+        self._records: Dict[str, SessionRecord] = {}
+        self._lock = threading.Lock()
+
+    def load(self, session_id: str) -> Optional[SessionRecord]:
+        with self._lock:
+            record = self._records.get(session_id)
+        return None if record is None else dataclasses.replace(record)
+
+    def save(self, record: SessionRecord):
+        with self._lock:
+            self._records[record.session_id] = dataclasses.replace(
+                record, messages=list(record.messages)
+            )
+
+    def delete(self, session_id: str):
+        with self._lock:
+            self._records.pop(session_id, None)
+
+
+class SQLiteSessionStore(SessionStore):
+
+    """Sessions in a SQLite database in WAL mode, readers never wait for the
+    writer so several worker processes can share the file.
+
+    Messages are append only, a save only writes the messages the database
+    does not have yet. Saves are queued and written in one transaction every
+    `flush_interval` seconds or once `batch_size` sessions are pending, the
+    queued records are visible to `load` right away.
+    """
+
+    def __init__(self, path: str, batch_size: int = 64, flush_interval: float = 0.5):
+        """
+        path (str): the database file
+        batch_size (int): pending sessions that trigger a write
+        flush_interval (float): seconds a save may wait before being written,
+            0 writes every save immediately
+        """
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._pending: Dict[str, SessionRecord] = {}
+        self._lock = threading.Lock()
+        self._db_lock = threading.Lock()
+        self._closed = threading.Event()
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            " session_id TEXT PRIMARY KEY,"
+            " current_node TEXT,"
+            " node_inputs TEXT NOT NULL,"
+            " num_fails TEXT NOT NULL,"
+            " message_count INTEGER NOT NULL,"
+            " updated_at REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS messages ("
+            " session_id TEXT NOT NULL,"
+            " seq INTEGER NOT NULL,"
+            " role TEXT NOT NULL,"
+            " content TEXT NOT NULL,"
+            " PRIMARY KEY (session_id, seq)) WITHOUT ROWID"
+        )
+        self._conn.commit()
+
+        self._flusher = None
+        if flush_interval > 0:
+            self._flusher = threading.Thread(
+                target=self._flush_periodically, name="SQLiteSessionStore", daemon=True
+            )
+            self._flusher.start()
+
+    def _flush_periodically(self):
+        while not self._closed.wait(self._flush_interval):
+            self.flush()
+
+    def load(self, session_id: str) -> Optional[SessionRecord]:
+        with self._lock:
+            pending = self._pending.get(session_id)
+        if pending is not None:
+            return dataclasses.replace(pending, messages=list(pending.messages))
+
+        with self._db_lock:
+            row = self._conn.execute(
+                "SELECT current_node, node_inputs, num_fails, updated_at"
+                " FROM sessions WHERE session_id = ?",
+                (session_id,),
+            ).fetchone()
+            if row is None:
+                return None
+            messages = self._conn.execute(
+                "SELECT role, content FROM messages WHERE session_id = ? ORDER BY seq",
+                (session_id,),
+            ).fetchall()
+
+        current_node, node_inputs, num_fails, updated_at = row
+        return SessionRecord(
+            session_id=session_id,
+            messages=[{"content": content, "role": role} for role, content in messages],
+            current_node=current_node,
+            node_inputs={
+                k: decode_value(v) for k, v in json.loads(node_inputs).items()
+            },
+            num_fails=json.loads(num_fails),
+            updated_at=updated_at,
+        )
+
+    def save(self, record: SessionRecord):
+        record = dataclasses.replace(record, messages=list(record.messages))
+        with self._lock:
+            self._pending[record.session_id] = record
+            full = len(self._pending) >= self._batch_size
+        if full or self._flush_interval <= 0:
+            self.flush()
+
+    def delete(self, session_id: str):
+        with self._lock:
+            self._pending.pop(session_id, None)
+        with self._db_lock:
+            self._conn.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+            self._conn.execute("DELETE FROM messages WHERE session_id = ?", (session_id,))
+            self._conn.commit()
+
+    def flush(self):
+        # batches are taken and written under the same lock so an older
+        # batch never overwrites a newer one
+        with self._db_lock:
+            with self._lock:
+                if not self._pending:
+                    return
+                records, self._pending = list(self._pending.values()), {}
+
+            with self._conn:
+                for record in records:
+                    self._write(record)
+
+    def _write(self, record: SessionRecord):
+        row = self._conn.execute(
+            "SELECT message_count FROM sessions WHERE session_id = ?",
+            (record.session_id,),
+        ).fetchone()
+        stored = row[0] if row is not None else 0
+        if stored > len(record.messages):
+            # the history was replaced by a shorter one
+            self._conn.execute(
+                "DELETE FROM messages WHERE session_id = ?", (record.session_id,)
+            )
+            stored = 0
+
+        self._conn.executemany(
+            "INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?)",
+            [
+                (record.session_id, seq, str(msg["role"]), msg["content"])
+                for seq, msg in enumerate(record.messages[stored:], start=stored)
+            ],
+        )
+        self._conn.execute(
+            "INSERT OR REPLACE INTO sessions VALUES (?, ?, ?, ?, ?, ?)",
+            (
+                record.session_id,
+                record.current_node,
+                json.dumps(
+                    {k: encode_value(v) for k, v in record.node_inputs.items()}
+                ),
+                json.dumps(record.num_fails),
+                len(record.messages),
+                record.updated_at,
+            ),
+        )
+
+    def close(self):
+        self._closed.set()
+        if self._flusher is not None:
+            self._flusher.join()
+        self.flush()
+        with self._db_lock:
+            self._conn.close()
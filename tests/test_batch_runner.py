@@ -0,0 +1,106 @@
+import asyncio
+import json
+import time
+
+from batch.runner import BatchRunner, CheckpointedOutput, Conversation
+from data.chat import Role
+from data.graph import MessageOutput
+
+
+class _EchoPipeline:
+
+    """Answers every input with itself, the conversation is over on "bye" """
+
+    def __init__(self):
+        self.current_node_id = None
+
+    def run(self, user_input):
+        self.current_node_id = "EchoNode"
+        return [MessageOutput(str(user_input), Role.ASSISTANT)], user_input == "bye"
+
+    async def arun(self, user_input):
+        await asyncio.sleep(0)
+        return self.run(user_input)
+
+
+def _conversations(count: int):
+    for number in range(count):
+        yield Conversation(f"c{number}", ["hi", "bye", "never sent"])
+
+
+def _records(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f]
+
+
+def test_every_conversation_is_replayed_until_it_is_over(tmp_path):
+    path = tmp_path / "out.jsonl"
+    with CheckpointedOutput(str(path)) as output:
+        stats = BatchRunner(lambda c: _EchoPipeline(), output, workers=3).run(
+            _conversations(5)
+        )
+
+    assert (stats.conversations, stats.turns, stats.failed) == (5, 15, 0)
+    summaries = [r for r in _records(path) if r["type"] == "conversation"]
+    assert {r["conversation_id"] for r in summaries} == {f"c{n}" for n in range(5)}
+    assert all(r["is_over"] and r["skipped_turns"] == 1 for r in summaries)
+
+
+def test_a_resumed_run_skips_the_finished_conversations(tmp_path):
+    path = tmp_path / "out.jsonl"
+    with CheckpointedOutput(str(path)) as output:
+        BatchRunner(lambda c: _EchoPipeline(), output).run(_conversations(2))
+    # a conversation cut short by a crash
+    with open(path, "a") as f:
+        f.write(json.dumps({"type": "turn", "conversation_id": "c2"}) + "\n")
+        f.write('{"type": "turn", "conv')
+
+    with CheckpointedOutput(str(path), resume=True) as output:
+        assert output.done == {"c0", "c1"}
+        stats = BatchRunner(lambda c: _EchoPipeline(), output, use_async=True).run(
+            _conversations(3)
+        )
+
+    assert (stats.conversations, stats.resumed) == (1, 2)
+    assert sum(r["type"] == "conversation" for r in _records(path)) == 3
+
+
+def test_the_async_workers_read_the_input_off_the_event_loop(tmp_path):
+    def slow_input():
+        for conversation in _conversations(3):
+            time.sleep(0.05)
+            yield conversation
+
+    ticks = []
+
+    def factory(conversation):
+        pipeline = _EchoPipeline()
+
+        async def arun(user_input):
+            ticks.append(time.perf_counter())
+            return pipeline.run(user_input)
+
+        pipeline.arun = arun
+        return pipeline
+
+    async def heartbeat(runner_task):
+        beats = 0
+        while not runner_task.done():
+            beats += 1
+            await asyncio.sleep(0.005)
+        return beats
+
+    with CheckpointedOutput(str(tmp_path / "out.jsonl")) as output:
+        runner = BatchRunner(factory, output, workers=2, use_async=True)
+
+        async def main():
+            task = asyncio.ensure_future(
+                runner._arun(runner._apending(runner._pending(slow_input())))
+            )
+            return await heartbeat(task)
+
+        beats = asyncio.run(main())
+
+    # 150 ms of reads, the loop keeps running meanwhile
+    assert beats > 10
+    assert len(ticks) == 9
@@ -0,0 +1,81 @@
+from typing import Optional
+
+from cache.response_cache import ResponseCache
+from data.chat import MessageHistory
+from data.graph import ConversationState, MessageOutput
+from data.history import LastMessages
+from graph.chain_based_node import MultiRetrievalNode
+
+
+class _Node(MultiRetrievalNode):
+
+    """Answers with the query the retrieval chain would get"""
+
+    def _get_retriever_infos(self):
+        return []
+
+    def _get_default_chain(self):
+        return None
+
+    def _routed_predict(self, messages: MessageHistory, state: ConversationState) -> str:
+        return f"answer to {self._routed_query(messages)!r}"
+
+    def greeting_message(self, state: ConversationState) -> Optional[MessageOutput]:
+        return None
+
+    def no_edges_found(self, user_input, state) -> Optional[MessageOutput]:
+        return None
+
+
+def _conversation(*turns: str, policy=None) -> MessageHistory:
+    history = MessageHistory(messages=[], policy=policy)
+    for turn in turns[:-1]:
+        history.add_user_message(content=turn)
+        history.add_assistant_message(content=f"about {turn}")
+    history.add_user_message(content=turns[-1])
+    return history
+
+
+def test_a_standalone_question_is_sent_alone():
+    node = _Node(None, None, [])
+    messages = _conversation("What is POS Pro?", "How do I add a product?")
+    assert node._routed_query(messages) == "How do I add a product?"
+
+
+def test_a_follow_up_is_sent_with_the_history_window():
+    node = _Node(None, None, [])
+    messages = _conversation(
+        "hello", "What is POS Pro?", "and how much is it?", policy=LastMessages(2)
+    )
+
+    query = node._routed_query(messages)
+
+    assert query == (
+        "\nuser: What is POS Pro?"
+        "\nassistant: about What is POS Pro?"
+        "\nuser: and how much is it?"
+    )
+
+
+def test_follow_ups_are_never_cached():
+    cache = ResponseCache()
+    node = _Node(None, None, [], response_cache=cache)
+    state = ConversationState()
+
+    first = node._answer(_conversation("What is POS Pro?", "how much is it?"), state)
+    second = node._answer(_conversation("What is Shopify Plus?", "how much is it?"), state)
+
+    assert first != second
+    assert cache.stats().hits == cache.stats().misses == 0
+
+
+def test_standalone_questions_are_cached():
+    cache = ResponseCache()
+    node = _Node(None, None, [], response_cache=cache)
+    state = ConversationState()
+
+    first = node._answer(_conversation("hello", "How do I add a product?"), state)
+    second = node._answer(_conversation("hi", "how do I add a product"), state)
+
+    assert first == second
+    assert cache.stats().hits == 1
@@ -0,0 +1,68 @@
+from data.chat import MessageHistory, Role
+
+
+def _reference_transcript(messages) -> str:
+    return "".join(f"\n{message['role']}: {message['content']}" for message in messages)
+
+
+def _history() -> MessageHistory:
+    history = MessageHistory(messages=[{"role": "assistant", "content": "hi"}])
+    history.add_user_message(content="my email is a@b.com")
+    history.add_system_message(content="User Info retrieved")
+    history.add_assistant_message(content="how can I help?")
+    history.add_user_message(content="call me")
+    return history
+
+
+def test_the_transcript_is_kept_in_sync_with_the_messages():
+    history = _history()
+
+    assert str(history) == _reference_transcript(history.messages)
+    assert history.history_without_last() == _reference_transcript(history.messages[:-1])
+    assert history.rendered_messages() == [
+        _reference_transcript([message]) for message in history.messages
+    ]
+
+
+def test_the_role_indexes_are_kept_in_sync_with_the_messages():
+    history = _history()
+
+    assert history.last_user_message()["content"] == "call me"
+    assert history.last_message(Role.SYSTEM)["content"] == "User Info retrieved"
+    assert [m["content"] for m in history.role_based_history(Role.USER)] == [
+        "my email is a@b.com",
+        "call me",
+    ]
+    assert history.last_message(Role.USER) is history.messages[-1]
+
+
+def test_the_role_history_is_a_copy():
+    history = _history()
+    history.role_based_history(Role.USER).clear()
+    assert len(history.role_based_history(Role.USER)) == 2
+
+
+def test_model_input_splits_the_last_user_message_from_the_history():
+    history = _history()
+
+    model_input = history.model_input()
+
+    assert model_input.input == "\nuser: call me"
+    assert model_input.history == history.history_without_last()
+    assert model_input.tokens_saved == 0
+
+
+def test_message_tokens_are_counted_once_per_message():
+    history = _history()
+    tokens = list(history.message_tokens())
+    history.add_assistant_message(content="calling you now")
+
+    assert history.message_tokens()[: len(tokens)] == tokens
+    assert len(history.message_tokens()) == len(history.messages)
+
+
+def test_an_empty_history_has_no_last_message():
+    history = MessageHistory(messages=[])
+    assert str(history) == ""
+    assert history.last_user_message() is None
+    assert history.role_based_history(Role.USER) == []
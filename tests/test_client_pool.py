@@ -0,0 +1,230 @@
+import asyncio
+import threading
+import time
+
+import httpx
+import openai
+import pytest
+from langchain.callbacks.base import BaseCallbackHandler
+from langchain.chat_models import ChatOpenAI
+from langchain.schema import HumanMessage
+
+from llm.client_pool import (
+    LLMClientPool,
+    RateLimits,
+    StreamInterruptedError,
+    TokenBucket,
+)
+
+
+@pytest.fixture
+def pool():
+    return LLMClientPool(
+        RateLimits(requests_per_minute=None, tokens_per_minute=None),
+        api_key="test",
+        base_url="http://localhost:1",
+    )
+
+
+def test_concurrent_identical_requests_are_sent_once(pool):
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def request():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return {"answer": 42}
+
+    results = []
+    leader = threading.Thread(target=lambda: results.append(pool.coalesce("k", request)))
+    leader.start()
+    started.wait(5)
+    follower = threading.Thread(
+        target=lambda: results.append(pool.coalesce("k", request))
+    )
+    follower.start()
+    while pool.coalesced == 0:
+        time.sleep(0.001)
+    release.set()
+    leader.join(5)
+    follower.join(5)
+
+    assert calls == [1]
+    assert results == [{"answer": 42}, {"answer": 42}]
+    # the follower gets a copy it is free to mutate
+    assert results[0] is not results[1]
+
+
+def test_the_error_of_the_leader_reaches_the_followers(pool):
+    async def main():
+        started = asyncio.Event()
+
+        async def failing():
+            started.set()
+            await asyncio.sleep(0.01)
+            raise ValueError("boom")
+
+        leader = asyncio.create_task(pool.acoalesce("k", failing))
+        await started.wait()
+        follower = asyncio.create_task(pool.acoalesce("k", failing))
+        return await asyncio.gather(leader, follower, return_exceptions=True)
+
+    results = asyncio.run(main())
+    assert [type(result) for result in results] == [ValueError, ValueError]
+
+
+def test_an_async_follower_resends_the_request_of_a_cancelled_leader(pool):
+    async def main():
+        started = asyncio.Event()
+
+        async def hanging():
+            started.set()
+            await asyncio.Event().wait()
+
+        async def answer():
+            return "answer"
+
+        leader = asyncio.create_task(pool.acoalesce("k", hanging))
+        await started.wait()
+        follower = asyncio.create_task(pool.acoalesce("k", answer))
+        await asyncio.sleep(0)
+        leader.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        return await follower
+
+    assert asyncio.run(main()) == "answer"
+
+
+def test_a_sync_follower_resends_the_request_of_a_cancelled_async_leader(pool):
+    async def main():
+        started = asyncio.Event()
+
+        async def hanging():
+            started.set()
+            await asyncio.Event().wait()
+
+        leader = asyncio.create_task(pool.acoalesce("k", hanging))
+        await started.wait()
+        follower = asyncio.create_task(
+            asyncio.to_thread(pool.coalesce, "k", lambda: "answer")
+        )
+        while pool.coalesced == 0:
+            await asyncio.sleep(0.001)
+        leader.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        return await follower
+
+    assert asyncio.run(main()) == "answer"
+
+
+def test_a_none_key_is_never_coalesced(pool):
+    assert pool.coalesce(None, lambda: 1) == 1
+    assert pool.stats()["coalesced"] == 0
+
+
+def _connection_error() -> openai.APIConnectionError:
+    return openai.APIConnectionError(request=httpx.Request("POST", "http://localhost:1"))
+
+
+@pytest.fixture
+def retrying_pool():
+    return LLMClientPool(
+        RateLimits(
+            requests_per_minute=None,
+            tokens_per_minute=None,
+            max_retries=2,
+            initial_backoff=0,
+            max_backoff=0,
+        ),
+        api_key="test",
+        base_url="http://localhost:1",
+    )
+
+
+def test_token_bucket_makes_callers_wait_for_the_refill():
+    bucket = TokenBucket(capacity=60)
+
+    assert bucket.reserve(60) == 0
+    assert bucket.reserve(30) == pytest.approx(30, abs=0.1)
+    # the waiting callers are served in order
+    assert bucket.reserve(1) == pytest.approx(31, abs=0.1)
+
+
+def test_transient_errors_are_retried(retrying_pool):
+    attempts = []
+
+    def request():
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise _connection_error()
+        return "ok"
+
+    assert retrying_pool.call(request, tokens=1) == "ok"
+    assert retrying_pool.retries == 2
+
+
+def test_retries_give_up_after_max_retries(retrying_pool):
+    attempts = []
+
+    def request():
+        attempts.append(1)
+        raise _connection_error()
+
+    with pytest.raises(openai.APIConnectionError):
+        retrying_pool.call(request, tokens=1)
+    assert len(attempts) == 3
+
+
+def test_other_errors_are_not_retried(retrying_pool):
+    attempts = []
+
+    def request():
+        attempts.append(1)
+        raise ValueError("bad request")
+
+    with pytest.raises(ValueError):
+        retrying_pool.call(request, tokens=1)
+    assert len(attempts) == 1
+
+
+def test_backoff_waits_at_least_retry_after(pool):
+    response = httpx.Response(
+        429,
+        headers={"retry-after": "7"},
+        request=httpx.Request("POST", "http://localhost:1"),
+    )
+    error = openai.RateLimitError("slow down", response=response, body=None)
+
+    assert pool._backoff(0, error) >= 7
+
+
+def test_a_stream_failing_after_its_first_token_is_not_retried(
+    retrying_pool, monkeypatch
+):
+    attempts = []
+
+    def generate(self, messages, stop=None, run_manager=None, stream=None, **kwargs):
+        attempts.append(1)
+        run_manager.on_llm_new_token("Hel")
+        raise _connection_error()
+
+    class _Tokens(BaseCallbackHandler):
+        def __init__(self):
+            self.tokens = []
+
+        def on_llm_new_token(self, token, **kwargs):
+            self.tokens.append(token)
+
+    monkeypatch.setattr(ChatOpenAI, "_generate", generate)
+    model = retrying_pool.chat_model("gpt-3.5-turbo", temperature=0.5, streaming=True)
+
+    handler = _Tokens()
+
+    with pytest.raises(StreamInterruptedError):
+        model.generate([[HumanMessage(content="hi")]], callbacks=[handler])
+    assert len(attempts) == 1
+    assert handler.tokens == ["Hel"]
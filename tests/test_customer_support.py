@@ -0,0 +1,81 @@
+import asyncio
+
+import pytest
+from langchain.embeddings import DeterministicFakeEmbedding
+
+from benchmarks.fake_llm import ScriptedChatModel
+from customer_support import CustomerSupportPipeline
+from session.store import InMemorySessionStore
+
+TURNS = [None, "my email is rafaelpossas@gmail.com"]
+
+
+@pytest.fixture
+def pipeline_factory(tmp_path):
+    llm = ScriptedChatModel(temperature=0)
+    embeddings = DeterministicFakeEmbedding(size=8)
+
+    def factory(**kwargs):
+        return CustomerSupportPipeline(
+            llm_model=llm,
+            embeddings=embeddings,
+            persist_root=str(tmp_path),
+            response_cache=False,
+            embedding_cache=False,
+            completion_cache=False,
+            warm_up=False,
+            **kwargs,
+        )
+
+    return factory
+
+
+def _transcript(outputs):
+    return [
+        ([message.message for message in messages], is_over)
+        for messages, is_over in outputs
+    ]
+
+
+def test_arun_answers_like_run(pipeline_factory):
+    pipeline = pipeline_factory()
+    outputs = [pipeline.run(turn) for turn in TURNS]
+
+    async def replay():
+        apipeline = pipeline_factory()
+        return [await apipeline.arun(turn) for turn in TURNS], apipeline
+
+    aoutputs, apipeline = asyncio.run(replay())
+
+    assert _transcript(aoutputs) == _transcript(outputs)
+    assert apipeline.current_node_id == pipeline.current_node_id == "AuthenticatedUserNode"
+    assert "Rafael" in outputs[-1][0][-1].message
+
+
+def test_pipelines_share_the_graph_but_not_the_conversation(pipeline_factory):
+    first, second = pipeline_factory(), pipeline_factory()
+    for pipeline in (first, second):
+        pipeline.run(None)
+
+    first.run("rafaelpossas@gmail.com")
+
+    assert first._graph is second._graph
+    assert first.current_node_id == "AuthenticatedUserNode"
+    assert second.current_node_id == "GreetingNode"
+    second.run("john@doe.com")
+    greeting = second.messages[-1]["content"]
+    assert "John" in greeting and "Rafael" not in greeting
+
+
+def test_a_session_resumes_where_it_stopped(pipeline_factory):
+    store = InMemorySessionStore()
+    pipeline = pipeline_factory(session_store=store)
+    for turn in TURNS:
+        pipeline.run(turn)
+
+    resumed = pipeline_factory(session_store=store, session_id=pipeline.session_id)
+
+    assert resumed.current_node_id == "AuthenticatedUserNode"
+    assert resumed.messages == pipeline.messages
+    assert resumed._state.node_inputs == pipeline._state.node_inputs
+    assert pipeline_factory(session_store=store).current_node_id is None
@@ -0,0 +1,126 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from langchain.embeddings import FakeEmbeddings
+
+from cache.embedding_cache import CachedEmbeddings, EmbeddingStore, LazyEmbeddings
+
+
+def _key(n: int) -> bytes:
+    return bytes([n]) * 32
+
+
+def _vector(value: float) -> np.ndarray:
+    return np.full((1, 3), value, dtype=np.float32)
+
+
+def test_put_and_get_survive_reopen(tmp_path):
+    path = str(tmp_path / "vectors")
+    store = EmbeddingStore(path)
+    store.put([_key(1), _key(2)], np.concatenate([_vector(1), _vector(2)]))
+
+    reopened = EmbeddingStore(path)
+    assert len(reopened) == 2
+    np.testing.assert_array_equal(reopened.get(_key(2)), [2, 2, 2])
+    assert reopened.get(_key(3)) is None
+
+
+def test_two_stores_sharing_the_files_keep_their_rows(tmp_path):
+    path = str(tmp_path / "vectors")
+    first = EmbeddingStore(path)
+    second = EmbeddingStore(path)
+
+    first.put([_key(1)], _vector(1))
+    second.put([_key(2)], _vector(2))
+    first.put([_key(3)], _vector(3))
+
+    np.testing.assert_array_equal(first.get(_key(1)), [1, 1, 1])
+    np.testing.assert_array_equal(first.get(_key(2)), [2, 2, 2])
+    np.testing.assert_array_equal(second.get(_key(2)), [2, 2, 2])
+    fresh = EmbeddingStore(path)
+    for n in (1, 2, 3):
+        np.testing.assert_array_equal(fresh.get(_key(n)), [n, n, n])
+
+
+def test_a_key_already_written_by_another_store_is_not_appended(tmp_path):
+    path = str(tmp_path / "vectors")
+    first = EmbeddingStore(path)
+    second = EmbeddingStore(path)
+
+    first.put([_key(1)], _vector(1))
+    second.put([_key(1)], _vector(9))
+
+    assert len(EmbeddingStore(path)) == 1
+    np.testing.assert_array_equal(second.get(_key(1)), [1, 1, 1])
+
+
+def test_an_interrupted_append_is_overwritten(tmp_path):
+    path = str(tmp_path / "vectors")
+    store = EmbeddingStore(path)
+    store.put([_key(1)], _vector(1))
+    # vectors of an append that died before writing its keys
+    with open(f"{path}.f32", "ab") as f:
+        f.write(_vector(7).tobytes())
+
+    reopened = EmbeddingStore(path)
+    assert len(reopened) == 1
+    reopened.put([_key(2)], _vector(2))
+    np.testing.assert_array_equal(EmbeddingStore(path).get(_key(2)), [2, 2, 2])
+
+
+class _CountingEmbeddings(FakeEmbeddings):
+    calls: int = 0
+
+    def embed_documents(self, texts):
+        self.calls += 1
+        return super().embed_documents(texts)
+
+
+def test_cached_embeddings_embed_a_text_once(tmp_path):
+    model = _CountingEmbeddings(size=4)
+    embeddings = CachedEmbeddings(model, path=str(tmp_path / "vectors"))
+
+    first = embeddings.embed_documents(["a", "b", "a"])
+    second = embeddings.embed_documents(["b", "a"])
+
+    assert model.calls == 1
+    assert second == [first[1], first[0]]
+    assert (embeddings.hits, embeddings.misses) == (2, 3)
+
+    reopened = CachedEmbeddings(model, path=str(tmp_path / "vectors"))
+    assert reopened.embed_documents(["a"]) == [first[0]]
+    assert model.calls == 1
+
+
+def test_queries_and_documents_are_cached_apart():
+    model = _CountingEmbeddings(size=4)
+    embeddings = CachedEmbeddings(model)
+    embeddings.embed_documents(["a"])
+    embeddings.embed_query("a")
+    assert embeddings.misses == 2
+
+
+def test_vectors_evicted_from_memory_are_read_from_disk(tmp_path):
+    model = _CountingEmbeddings(size=4)
+    embeddings = CachedEmbeddings(model, path=str(tmp_path / "vectors"), max_entries=1)
+    first = embeddings.embed_documents(["a", "b"])
+
+    assert len(embeddings._lru) == 1
+    assert embeddings.embed_documents(["a", "b"]) == first
+    assert model.calls == 1
+
+
+def test_lazy_embeddings_build_the_model_once():
+    built = []
+
+    def factory():
+        built.append(FakeEmbeddings(size=4))
+        return built[-1]
+
+    embeddings = LazyEmbeddings(factory, model_id="fake")
+    assert not built
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(embeddings.embed_query, ["a"] * 16))
+
+    assert len(built) == 1
@@ -0,0 +1,82 @@
+import threading
+
+from data.chat import MessageHistory
+from data.history import (
+    FullHistory,
+    LastMessages,
+    RollingSummary,
+    TokenBudget,
+    count_tokens,
+)
+
+
+def _history(policy, turns: int = 6) -> MessageHistory:
+    history = MessageHistory(messages=[], policy=policy)
+    for turn in range(turns):
+        history.add_user_message(content=f"question {turn}")
+        history.add_assistant_message(content=f"answer {turn}")
+    history.add_user_message(content="last question")
+    return history
+
+
+def test_full_history_keeps_every_earlier_message():
+    history = _history(FullHistory())
+    assert history.model_input().history == history.history_without_last()
+    assert history.model_input().tokens_saved == 0
+
+
+def test_last_messages_keeps_the_most_recent_ones():
+    history = _history(LastMessages(2))
+
+    model_input = history.model_input()
+
+    assert model_input.history == "\nuser: question 5\nassistant: answer 5"
+    assert model_input.input == "\nuser: last question"
+    assert model_input.tokens_saved > 0
+
+
+def test_last_messages_of_zero_sends_no_history():
+    assert _history(LastMessages(0)).model_input().history == ""
+
+
+def test_the_token_budget_is_never_exceeded():
+    budget = 20
+    history = _history(TokenBudget(budget), turns=20)
+
+    window = history.model_input().history
+
+    assert count_tokens(window) <= budget
+    assert window.endswith("\nassistant: answer 19")
+    assert history.history_without_last().endswith(window)
+
+
+def test_a_message_larger_than_the_budget_is_left_out():
+    history = _history(TokenBudget(1))
+    assert history.model_input().history == ""
+
+
+def test_the_rolling_summary_replaces_the_older_messages():
+    folded = []
+    release = threading.Event()
+
+    def summarize(summary: str, new_lines: str) -> str:
+        release.wait(5)
+        folded.append(new_lines)
+        return f"{summary}+{new_lines.count(chr(10))} lines"
+
+    policy = RollingSummary(summarize, keep_last=2)
+    history = _history(policy)
+
+    # the summary is refreshed in the background, the messages it does not
+    # cover yet are sent verbatim meanwhile
+    assert history.model_input().history == history.history_without_last()
+    release.set()
+    policy._pending.result(timeout=5)
+
+    window = history.model_input().history
+
+    assert window == (
+        "\nSummary of the earlier conversation: +10 lines"
+        "\nuser: question 5\nassistant: answer 5"
+    )
+    assert len(folded) == 1
@@ -0,0 +1,41 @@
+import pytest
+from langchain.embeddings import FakeEmbeddings
+
+from tools.ingest import ALL_TIERS, collect_chunks, ingest
+
+
+@pytest.fixture
+def tiers(tmp_path):
+    for tier in ("free", "paid"):
+        (tmp_path / tier).mkdir()
+        (tmp_path / tier / f"{tier}.txt").write_text(f"only in the {tier} tier")
+        (tmp_path / tier / "shared.txt").write_text("in both tiers")
+    return {tier: str(tmp_path / tier) for tier in ("free", "paid")}
+
+
+def test_a_chunk_of_several_tiers_is_collected_once(tiers):
+    chunks = {chunk.text: chunk for chunk in collect_chunks(tiers).values()}
+
+    assert len(chunks) == 3
+    shared = chunks["in both tiers"]
+    assert shared.tiers == ["free", "paid"]
+    assert shared.metadata(list(tiers)) == {
+        "free": True,
+        "paid": True,
+        "tier": ALL_TIERS,
+        "source": ",".join(shared.sources),
+    }
+
+
+def test_only_the_changed_chunks_are_ingested(tiers, tmp_path):
+    pytest.importorskip("chromadb")
+    persist_root = str(tmp_path / "store")
+    embeddings = FakeEmbeddings(size=4)
+
+    report = ingest(embeddings, persist_root, tiers, batch_size=1, workers=2)
+    assert (report.added, report.deleted) == (3, 0)
+    assert ingest(embeddings, persist_root, tiers).skipped
+
+    (tmp_path / "paid" / "paid.txt").write_text("the new paid tier")
+    report = ingest(embeddings, persist_root, tiers)
+    assert (report.added, report.deleted, report.unchanged) == (1, 1, 2)
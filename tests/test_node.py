@@ -0,0 +1,219 @@
+import asyncio
+import queue
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+import pytest
+from langchain.schema import OutputParserException
+
+from data.chat import Role
+from data.graph import ConversationState, EdgeOutput, MessageOutput
+from graph.callbacks import get_callbacks, use_callbacks
+from graph.edge import BaseEdge
+from graph.node import BaseNode
+from graph.streaming import StreamingHandler
+
+
+class _Edge(BaseEdge[str, str]):
+
+    """Continues with `result` after `delay` seconds, fails to parse when
+    `result` is None"""
+
+    def __init__(self, name, result=None, delay=0.0, priority=0, out_node=None):
+        super().__init__(model=None, out_node=out_node, priority=priority)
+        self.name = name
+        self.result = result
+        self.delay = delay
+
+    @property
+    def edge_id(self) -> str:
+        return self.name
+
+    def _get_message_output(self, msg_input) -> None:
+        return None
+
+    def check(self, model_output: str) -> bool:
+        return True
+
+    def _outcome(self) -> str:
+        if self.result is None:
+            raise OutputParserException(f"{self.name} failed", llm_output=self.name)
+        return self.result
+
+    def _parse(self, model_input: str) -> str:
+        time.sleep(self.delay)
+        return self._outcome()
+
+    async def _aparse(self, model_input: str) -> str:
+        await asyncio.sleep(self.delay)
+        return self._outcome()
+
+
+class _Node(BaseNode[str]):
+    def greeting_message(self, state: ConversationState) -> Optional[MessageOutput]:
+        return MessageOutput("hello", Role.ASSISTANT)
+
+    def no_edges_found(self, user_input: str, state: ConversationState):
+        return MessageOutput(f"sorry, {user_input}?", Role.ASSISTANT)
+
+
+def _execute(node: BaseNode, user_input: str, state: ConversationState, use_async: bool):
+    if use_async:
+        return asyncio.run(node.aexecute(user_input, state))
+    return node.execute(user_input, state)
+
+
+def test_async_execution_matches_the_sync_one():
+    target = _Node()
+    node = _Node([_Edge("fails"), _Edge("continues", "payload", out_node=target)])
+
+    outputs = []
+    for use_async in (False, True):
+        state = ConversationState()
+        output = _execute(node, "input", state, use_async)
+        outputs.append((output.should_continue, output.result, state.num_fails))
+        assert target.node_input(state) == "payload"
+
+    assert outputs[0] == outputs[1] == (True, "payload", {"fails": 1, "continues": 0})
+
+
+def test_the_fallback_answers_when_no_edge_continues():
+    node = _Node([_Edge("fails")])
+    for use_async in (False, True):
+        output = _execute(node, "what", ConversationState(), use_async)
+        assert output == MessageOutput("sorry, what?", Role.ASSISTANT)
+
+
+def test_one_event_loop_serves_many_conversations_at_once():
+    node = _Node([_Edge("continues", "payload", delay=0.05)])
+
+    async def main():
+        return await asyncio.gather(
+            *(node.aexecute("input", ConversationState()) for _ in range(100))
+        )
+
+    start = time.perf_counter()
+    outputs = asyncio.run(main())
+
+    assert all(isinstance(output, EdgeOutput) for output in outputs)
+    assert time.perf_counter() - start < 1.0
+
+
+class _AnnouncingEdge(_Edge):
+
+    """Tells the user facing callbacks it runs and counts a fail, whatever
+    its result"""
+
+    def _announce(self, state: ConversationState):
+        for handler in get_callbacks() or []:
+            handler.on_tool_start({"name": self.name}, "")
+        state.num_fails[self.name] = state.num_fails.get(self.name, 0) + 1
+
+    def execute(self, user_input: str, state: ConversationState):
+        time.sleep(self.delay)
+        self._announce(state)
+        return self._get_edge_output(self.result is not None, self.result, state)
+
+    async def aexecute(self, user_input: str, state: ConversationState):
+        await asyncio.sleep(self.delay)
+        self._announce(state)
+        return self._get_edge_output(self.result is not None, self.result, state)
+
+
+def _run_to_continue(node: BaseNode, state: ConversationState, use_async: bool):
+    if use_async:
+        return asyncio.run(node.arun_to_continue("input", state))
+    return node.run_to_continue("input", state)
+
+
+@pytest.mark.parametrize("use_async", [False, True])
+def test_concurrent_edges_cost_one_round_trip(use_async):
+    edges = [_Edge(f"edge{n}", delay=0.1) for n in range(4)]
+    edges.append(_Edge("continues", "payload", delay=0.1))
+    node = _Node(edges, concurrent_edges=True)
+
+    start = time.perf_counter()
+    output = _run_to_continue(node, ConversationState(), use_async)
+
+    assert output.result == "payload"
+    assert time.perf_counter() - start < 0.3
+
+
+@pytest.mark.parametrize("use_async", [False, True])
+def test_the_winner_is_picked_by_priority_then_list_order(use_async):
+    node = _Node(
+        [
+            _Edge("fast", "fast", delay=0.0),
+            _Edge("first", "first", delay=0.05, priority=1),
+            _Edge("second", "second", delay=0.0, priority=1),
+        ],
+        concurrent_edges=True,
+    )
+
+    output = _run_to_continue(node, ConversationState(), use_async)
+
+    assert output.result == "first"
+
+
+@pytest.mark.parametrize("use_async", [False, True])
+def test_the_edges_after_the_winner_leave_no_trace(use_async):
+    node = _Node(
+        [
+            _AnnouncingEdge("fails", delay=0.0, priority=2),
+            _AnnouncingEdge("wins", "payload", delay=0.05, priority=1),
+            _AnnouncingEdge("too_late", "late", delay=0.2),
+        ],
+        concurrent_edges=True,
+    )
+    state = ConversationState()
+    events = queue.Queue()
+
+    with use_callbacks([StreamingHandler(events)]):
+        output = _run_to_continue(node, state, use_async)
+    # gives the losing edge the time to finish in the background
+    time.sleep(0.3)
+
+    assert output.result == "payload"
+    assert state.num_fails == {"fails": 1, "wins": 1}
+    assert [event.content for event in events.queue] == ["fails", "wins"]
+
+
+def test_conversations_sharing_a_graph_keep_their_own_state():
+    target = _Node()
+    payloads = {}
+
+    class _EchoEdge(_Edge):
+        def _parse(self, model_input: str) -> str:
+            time.sleep(0.01)
+            if model_input.startswith("fail"):
+                return super()._parse(model_input)
+            return f"payload of {model_input}"
+
+    node = _Node([_EchoEdge("echo", out_node=target)])
+
+    def converse(name: str):
+        state = ConversationState()
+        node.execute(f"fail {name}", state)
+        node.execute(f"fail {name}", state)
+        node.execute(name, state)
+        payloads[name] = (target.node_input(state), dict(state.num_fails))
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(converse, [f"user{n}" for n in range(16)]))
+
+    assert payloads == {
+        f"user{n}": (f"payload of user{n}", {"echo": 0}) for n in range(16)
+    }
+
+
+def test_failures_are_counted_per_conversation():
+    node = _Node([_AnnouncingEdge("fails")])
+    first, second = ConversationState(), ConversationState()
+
+    for _ in range(3):
+        node.execute("input", first)
+    node.execute("input", second)
+
+    assert first.num_fails == {"fails": 3}
+    assert second.num_fails == {"fails": 1}
@@ -0,0 +1,92 @@
+import re
+
+import pytest
+from pydantic import BaseModel, field_validator
+
+from agents.support import CALL_REQUEST_EXTRACTORS, USER_LOOKUP_EXTRACTORS
+from data.validation import PhoneCallRequest
+from graph.pre_extractor import RegexExtractor, RuleExtractor
+
+
+class _Order(BaseModel):
+    number: str
+
+    @field_validator("number")
+    @classmethod
+    def _not_zero(cls, number):
+        if int(number) == 0:
+            raise ValueError("no order zero")
+        return number
+
+
+def _extract(extractors, message):
+    for extractor in extractors:
+        result = extractor.extract(message)
+        if result is not None:
+            return result
+    return None
+
+
+def test_regex_extractor_builds_the_class_from_the_named_groups():
+    extractor = RegexExtractor(r"order #?(?P<number>\d+)", _Order)
+
+    assert extractor.extract("Where is ORDER #1234?") == _Order(number="1234")
+    assert extractor.extract("where is my parcel?") is None
+
+
+def test_a_match_that_does_not_validate_is_no_match():
+    extractor = RegexExtractor(re.compile(r"order (?P<number>\d+)"), _Order)
+    assert extractor.extract("order 000") is None
+
+
+def test_rule_extractor_delegates_to_its_rule():
+    extractor = RuleExtractor(lambda message: _Order(number="7") if "7" in message else None)
+
+    assert extractor.extract("order 7") == _Order(number="7")
+    assert extractor.extract("order 8") is None
+
+
+@pytest.mark.parametrize(
+    "message",
+    [
+        "Please call me at 555-555-5555",
+        "555-555-5555, can you ring me?",
+        "CALL ME\non 555-555-5555 please",
+    ],
+)
+def test_explicit_call_requests_are_extracted(message):
+    assert _extract(CALL_REQUEST_EXTRACTORS, message) == PhoneCallRequest(
+        phone_number="555-555-5555"
+    )
+
+
+@pytest.mark.parametrize(
+    "message",
+    [
+        "Don't call me at 555-555-5555",
+        "555-555-5555 is my number, but never call it",
+        "Please call me",
+        "my number is 555-555-5555",
+    ],
+)
+def test_negated_or_incomplete_call_requests_are_left_to_the_llm(message):
+    assert _extract(CALL_REQUEST_EXTRACTORS, message) is None
+
+
+@pytest.mark.parametrize(
+    "message, name",
+    [
+        ("my email is RafaelPossas@gmail.com", "Rafael Possas"),
+        ("john@doe.com", "John Doe"),
+        ("you can reach me at 045-233-3668", "Carl Sagan"),
+    ],
+)
+def test_users_are_looked_up_by_email_or_phone(message, name):
+    assert _extract(USER_LOOKUP_EXTRACTORS, message).name == name
+
+
+@pytest.mark.parametrize(
+    "message", ["hello there", "nobody@example.com", "call 999-999-9999"]
+)
+def test_unknown_users_are_left_to_the_agent(message):
+    assert _extract(USER_LOOKUP_EXTRACTORS, message) is None
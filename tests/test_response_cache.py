@@ -0,0 +1,127 @@
+import time
+from typing import List
+
+from langchain.schema.embeddings import Embeddings
+
+from cache.response_cache import InMemoryBackend, ResponseCache, SQLiteBackend
+
+VOCABULARY = ["how", "do", "can", "i", "add", "a", "product", "what", "is", "pos", "pro"]
+
+
+class _WordEmbeddings(Embeddings):
+
+    """Bag of words over VOCABULARY, similar queries share their words"""
+
+    def embed_query(self, text: str) -> List[float]:
+        words = text.split()
+        return [float(words.count(word)) for word in VOCABULARY]
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [self.embed_query(text) for text in texts]
+
+
+def test_queries_are_matched_after_normalization():
+    cache = ResponseCache()
+    cache.put("free", "How do I add a product?", "answer")
+
+    assert cache.get("free", "how do i  add a PRODUCT") == "answer"
+    assert cache.get("premium", "How do I add a product?") is None
+    assert (cache.stats().hits, cache.stats().misses) == (1, 1)
+
+
+def test_an_expired_answer_is_a_miss_and_is_dropped():
+    backend = InMemoryBackend()
+    cache = ResponseCache(ttl_seconds=0.05, backend=backend)
+    cache.put("free", "what is pos pro", "answer")
+    time.sleep(0.1)
+
+    assert cache.get("free", "what is pos pro") is None
+    assert backend.entries("free") == []
+
+
+def test_a_similar_query_above_the_threshold_is_a_semantic_hit():
+    cache = ResponseCache(embeddings=_WordEmbeddings(), similarity_threshold=0.8)
+    cache.put("free", "how do i add a product", "answer")
+
+    assert cache.get("free", "how can i add a product") == "answer"
+    assert cache.get("free", "what is pos pro") is None
+    assert cache.get("premium", "how can i add a product") is None
+    assert cache.stats().semantic_hits == 1
+
+
+def test_a_semantic_hit_is_never_served_once_expired():
+    cache = ResponseCache(
+        embeddings=_WordEmbeddings(), similarity_threshold=0.8, ttl_seconds=0.05
+    )
+    cache.put("free", "how do i add a product", "answer")
+    time.sleep(0.1)
+
+    assert cache.get("free", "how can i add a product") is None
+
+
+def test_a_semantic_hit_is_never_served_once_evicted():
+    cache = ResponseCache(
+        embeddings=_WordEmbeddings(),
+        similarity_threshold=0.8,
+        backend=InMemoryBackend(max_entries=1),
+    )
+    cache.put("free", "how do i add a product", "answer")
+    # builds the similarity index of the namespace
+    assert cache.get("free", "how can i add a product") == "answer"
+    cache.put("free", "what is pos pro", "other answer")
+
+    assert cache.get("free", "how can i add a product") is None
+
+
+def test_the_in_memory_backend_evicts_the_least_recently_used():
+    cache = ResponseCache(backend=InMemoryBackend(max_entries=2))
+    cache.put("free", "first", "1")
+    cache.put("free", "second", "2")
+    cache.get("free", "first")
+    cache.put("free", "third", "3")
+
+    assert cache.get("free", "first") == "1"
+    assert cache.get("free", "second") is None
+
+
+def test_the_sqlite_backend_keeps_the_answers_across_instances(tmp_path):
+    path = str(tmp_path / "responses.sqlite3")
+    ResponseCache(embeddings=_WordEmbeddings(), backend=SQLiteBackend(path)).put(
+        "free", "how do i add a product", "answer"
+    )
+
+    cache = ResponseCache(
+        embeddings=_WordEmbeddings(),
+        similarity_threshold=0.8,
+        backend=SQLiteBackend(path),
+    )
+    assert cache.get("free", "how do i add a product") == "answer"
+    assert cache.get("free", "how can i add a product") == "answer"
+
+
+def test_the_sqlite_backend_evicts_the_least_recently_used(tmp_path):
+    backend = SQLiteBackend(str(tmp_path / "responses.sqlite3"), max_entries=2)
+    cache = ResponseCache(backend=backend)
+    for query in ("first", "second", "third"):
+        cache.put("free", query, query)
+        time.sleep(0.01)
+
+    assert cache.get("free", "first") is None
+    assert [entry.query for entry in backend.entries("free")] == ["second", "third"]
+
+
+def test_the_answers_of_another_worker_are_seen_after_a_refresh(tmp_path):
+    path = str(tmp_path / "responses.sqlite3")
+    reader = ResponseCache(
+        embeddings=_WordEmbeddings(),
+        similarity_threshold=0.8,
+        backend=SQLiteBackend(path),
+        index_refresh_seconds=0.05,
+    )
+    writer = ResponseCache(embeddings=_WordEmbeddings(), backend=SQLiteBackend(path))
+    assert reader.get("free", "how can i add a product") is None
+
+    writer.put("free", "how do i add a product", "answer")
+    time.sleep(0.1)
+
+    assert reader.get("free", "how can i add a product") == "answer"
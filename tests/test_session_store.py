@@ -0,0 +1,101 @@
+import sqlite3
+
+import pytest
+
+from data.chat import Role
+from data.graph import MessageOutput
+from data.validation import PhoneCallRequest, UserProfile
+from session.store import (
+    InMemorySessionStore,
+    SessionRecord,
+    SQLiteSessionStore,
+    decode_value,
+    encode_value,
+)
+
+PROFILE = UserProfile(
+    name="Rafael",
+    email="rafaelpossas@gmail.com",
+    subscription="premium",
+    user_id=1,
+    phone="0452 333 666",
+    language="en",
+)
+
+
+def _record(session_id="s1", messages=2) -> SessionRecord:
+    return SessionRecord(
+        session_id=session_id,
+        messages=[{"role": "user", "content": f"message {n}"} for n in range(messages)],
+        current_node="AuthenticatedUserNode",
+        node_inputs={"AuthenticatedUserNode": PROFILE},
+        num_fails={"CallCustomerEdge": 2},
+    )
+
+
+@pytest.mark.parametrize(
+    "value",
+    [
+        PROFILE,
+        PhoneCallRequest(phone_number="555-555-5555"),
+        MessageOutput("hello", Role.ASSISTANT),
+        "plain text",
+        None,
+    ],
+)
+def test_node_inputs_are_rebuilt_with_their_class(value):
+    assert decode_value(encode_value(value)) == value
+    assert type(decode_value(encode_value(value))) is type(value)
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def store(request, tmp_path):
+    if request.param == "memory":
+        yield InMemorySessionStore()
+        return
+    store = SQLiteSessionStore(str(tmp_path / "sessions.sqlite3"), flush_interval=0)
+    yield store
+    store.close()
+
+
+def test_a_saved_session_is_loaded_back(store):
+    store.save(_record())
+
+    loaded = store.load("s1")
+
+    assert loaded.messages == _record().messages
+    assert loaded.node_inputs == {"AuthenticatedUserNode": PROFILE}
+    assert loaded.num_fails == {"CallCustomerEdge": 2}
+    assert store.load("unknown") is None
+
+
+def test_a_deleted_session_is_gone(store):
+    store.save(_record())
+    store.delete("s1")
+    assert store.load("s1") is None
+
+
+def test_pending_saves_are_visible_before_they_are_written(tmp_path):
+    path = str(tmp_path / "sessions.sqlite3")
+    store = SQLiteSessionStore(path, batch_size=10, flush_interval=60)
+    store.save(_record())
+
+    assert store.load("s1").messages == _record().messages
+    assert SQLiteSessionStore(path, flush_interval=0).load("s1") is None
+    store.close()
+    assert SQLiteSessionStore(path, flush_interval=0).load("s1").messages == (
+        _record().messages
+    )
+
+
+def test_only_the_new_messages_are_written(tmp_path):
+    path = str(tmp_path / "sessions.sqlite3")
+    store = SQLiteSessionStore(path, flush_interval=0)
+    store.save(_record(messages=2))
+    store.save(_record(messages=5))
+    store.save(_record(messages=1))
+
+    rows = sqlite3.connect(path).execute("SELECT seq, content FROM messages").fetchall()
+    assert rows == [(0, "message 0")]
+    assert store.load("s1").messages == _record(messages=1).messages
+    store.close()
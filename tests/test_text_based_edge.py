@@ -0,0 +1,83 @@
+import json
+
+import pytest
+from langchain.llms.fake import FakeListLLM
+
+from agents.support import CallCustomerEdge
+from data.chat import MessageHistory
+from data.graph import ConversationState
+from data.validation import PhoneCallRequest
+
+
+def _history(message: str) -> MessageHistory:
+    history = MessageHistory(messages=[])
+    history.add_user_message(content=message)
+    return history
+
+
+def _edge(responses, combined=True) -> CallCustomerEdge:
+    return CallCustomerEdge(
+        FakeListLLM(responses=responses), max_retries=3, combined=combined
+    )
+
+
+NOT_VALID = json.dumps({"is_valid": False, "result": None})
+CALL = json.dumps({"is_valid": True, "result": {"phone_number": "555-555-5555"}})
+
+
+@pytest.mark.parametrize("combined", [True, False])
+def test_a_failing_check_never_continues_without_a_payload(combined):
+    not_valid = NOT_VALID if combined else json.dumps({"is_valid": False})
+    edge = _edge([not_valid] * 5, combined=combined)
+    state = ConversationState()
+
+    outputs = [edge.execute(_history("what is a refund?"), state) for _ in range(5)]
+
+    assert not any(output.should_continue for output in outputs)
+    assert [output.num_fails for output in outputs] == [1, 2, 3, 4, 5]
+
+
+def test_unparsable_completions_never_continue():
+    edge = _edge(["not json"] * 4)
+    state = ConversationState()
+
+    outputs = [edge.execute(_history("call me"), state) for _ in range(4)]
+
+    assert not any(output.should_continue for output in outputs)
+
+
+def test_a_passing_check_resets_the_fails():
+    edge = _edge([NOT_VALID, NOT_VALID, NOT_VALID, CALL])
+    state = ConversationState()
+    for _ in range(3):
+        edge.execute(_history("what is a refund?"), state)
+
+    output = edge.execute(_history("please call me"), state)
+
+    assert output.should_continue
+    assert output.result == PhoneCallRequest(phone_number="555-555-5555")
+    assert output.num_fails == 0
+
+
+def test_the_extraction_call_completes_a_valid_answer_without_result():
+    valid = json.dumps({"is_valid": True, "result": None})
+    phone = json.dumps({"phone_number": "555-555-5555"})
+    edge = _edge([valid, phone])
+
+    output = edge.execute(_history("please call me"), ConversationState())
+
+    assert output.should_continue
+    assert output.result.phone_number == "555-555-5555"
+
+
+def test_a_pre_extracted_call_request_needs_no_llm_call():
+    from agents.support import CALL_REQUEST_EXTRACTORS
+
+    edge = CallCustomerEdge(
+        FakeListLLM(responses=[]), combined=True, pre_extractors=CALL_REQUEST_EXTRACTORS
+    )
+
+    output = edge.execute(_history("call me on 555-555-5555"), ConversationState())
+
+    assert output.should_continue
+    assert output.result.phone_number == "555-555-5555"
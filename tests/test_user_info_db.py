@@ -0,0 +1,97 @@
+import pytest
+
+from tools import user_info_db
+from tools.user_info_db import (
+    UserDirectory,
+    find_user_profile,
+    search_user_info_on_db,
+    search_user_profile_on_db,
+    search_user_subscription_on_db,
+)
+
+CARL = {
+    "name": "Carl Sagan",
+    "email": "carl@sagan.com",
+    "user_id": "3",
+    "phone": "0452 333 668",
+    "language": "Italian",
+}
+
+
+@pytest.fixture
+def directory():
+    return UserDirectory()
+
+
+@pytest.mark.parametrize(
+    "kwargs",
+    [
+        dict(email=" Rafaelpossas@Gmail.com "),
+        dict(phone="(0452) 333-666"),
+        dict(user_id=1),
+        dict(email="unknown@example.com", phone="0452333666"),
+    ],
+)
+def test_users_are_found_by_email_phone_or_id(directory, kwargs):
+    profile = directory.lookup(**kwargs)
+
+    assert profile.name == "Rafael Possas"
+    assert profile.subscription == "premium"
+
+
+def test_lookup_many_keeps_the_order_of_the_queries(directory):
+    profiles = directory.lookup_many(["john@doe.com", "nobody@example.com", "1", "2"])
+
+    assert [p.name if p else None for p in profiles] == [
+        "John Doe",
+        None,
+        "Rafael Possas",
+        "John Doe",
+    ]
+
+
+def test_an_updated_user_is_indexed_again(directory):
+    directory.lookup(user_id="3")
+    directory.add_user(dict(CARL, email="carl@cosmos.com"), "free")
+
+    assert directory.lookup(email="carl@sagan.com") is None
+    profile = directory.lookup(email="carl@cosmos.com")
+    assert (profile.user_id, profile.subscription) == (3, "free")
+
+
+def test_profiles_are_served_from_memory_until_they_expire(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(user_info_db.time, "monotonic", lambda: now[0])
+    directory = UserDirectory(ttl_seconds=60)
+
+    directory.lookup(email="john@doe.com")
+    directory.lookup(email="john@doe.com")
+    now[0] += 61
+    directory.lookup(email="john@doe.com")
+    directory.lookup(email="nobody@example.com")
+
+    stats = directory.stats()
+    assert (stats.hits, stats.misses, stats.not_found) == (1, 2, 1)
+    assert stats.hit_rate == 0.25
+
+
+def test_a_directory_reopens_its_database(tmp_path):
+    path = str(tmp_path / "users.sqlite3")
+    UserDirectory(path).add_user(
+        dict(CARL, user_id="4", email="ann@druyan.com", phone="0452 333 669"), "free"
+    )
+
+    reopened = UserDirectory(path)
+    assert reopened.lookup(phone="0452 333 669").email == "ann@druyan.com"
+    assert reopened.lookup(email="carl@sagan.com").name == "Carl Sagan"
+
+
+def test_the_tools_answer_from_the_shared_directory():
+    assert search_user_profile_on_db.run("0452 333 667")[0]["name"] == "John Doe"
+    assert search_user_profile_on_db.run("nobody@example.com") == []
+    assert search_user_info_on_db.run("john@doe.com")[0]["user_id"] == "2"
+    assert search_user_subscription_on_db.run("2") == [
+        {"user_id": "2", "subscription": "free"}
+    ]
+    assert find_user_profile(email="carl@sagan.com").language == "Italian"
+    assert find_user_profile(phone="999") is None
@@ -0,0 +1,175 @@
+import abc
+import heapq
+import math
+from collections import Counter
+from typing import Dict, List, Optional, Sequence, Set, Tuple
+
+from langchain.callbacks.manager import CallbackManagerForRetrieverRun
+from langchain.schema import BaseRetriever, Document
+from langchain.schema.vectorstore import VectorStore
+
+from graph.router import content_words
+
+
+class BM25Index:
+
+    """In-process inverted index ranking documents with Okapi BM25"""
+
+    def __init__(self, texts: Sequence[str], k1: float = 1.5, b: float = 0.75):
+        self._k1 = k1
+        self._b = b
+        # term -> [(document index, term frequency)]
+        self._postings: Dict[str, List[Tuple[int, int]]] = {}
+        self._lengths: List[int] = []
+
+        for index, text in enumerate(texts):
+            terms = Counter(content_words(text))
+            self._lengths.append(sum(terms.values()))
+            for term, frequency in terms.items():
+                self._postings.setdefault(term, []).append((index, frequency))
+
+        self._average_length = (
+            sum(self._lengths) / len(self._lengths) if self._lengths else 0.0
+        )
+        documents = len(self._lengths)
+        self._idf = {}
+        for term, postings in self._postings.items():
+            frequency = len(postings)
+            self._idf[term] = math.log(
+                1 + (documents - frequency + 0.5) / (frequency + 0.5)
+            )
+
+    def search(
+        self, query: str, k: int, allowed: Optional[Set[int]] = None
+    ) -> List[Tuple[int, float]]:
+        """Best `k` (document index, score) pairs, only among `allowed` if given"""
+        scores: Dict[int, float] = {}
+        for term in set(content_words(query)):
+            idf = self._idf.get(term)
+            if idf is None:
+                continue
+            for index, frequency in self._postings[term]:
+                if allowed is not None and index not in allowed:
+                    continue
+                length = self._lengths[index] / self._average_length
+                norm = self._k1 * (1 - self._b + self._b * length)
+                score = idf * frequency * (self._k1 + 1) / (frequency + norm)
+                scores[index] = scores.get(index, 0.0) + score
+        return heapq.nlargest(k, scores.items(), key=lambda item: item[1])
+
+
+class Reranker(abc.ABC):
+
+    """Reorders the retrieved documents by their relevance to the query"""
+
+    @abc.abstractmethod
+    def rerank(self, query: str, documents: List[Document], k: int) -> List[Document]:
+        pass
+
+
+class CrossEncoderReranker(Reranker):
+
+    """Scores every (query, document) pair with a small cross-encoder on CPU,
+    requires sentence-transformers"""
+
+    def __init__(self, model_name: str = "cross-encoder/ms-marco-MiniLM-L-6-v2"):
+        try:
+            from sentence_transformers import CrossEncoder
+        except ImportError as e:
+            raise ImportError(
+                "CrossEncoderReranker requires sentence-transformers, "
+                "install it with `pip install sentence-transformers`"
+            ) from e
+        self._model = CrossEncoder(model_name, device="cpu")
+
+    def rerank(self, query: str, documents: List[Document], k: int) -> List[Document]:
+        if not documents:
+            return []
+        scores = self._model.predict([(query, doc.page_content) for doc in documents])
+        ranked = sorted(zip(scores, range(len(documents))), reverse=True)
+        return [documents[index] for _, index in ranked[:k]]
+
+
+def matches_filter(metadata: dict, where: Optional[dict]) -> bool:
+    return not where or all(metadata.get(key) == value for key, value in where.items())
+
+
+class HybridRetriever(BaseRetriever):
+
+    """Fuses the vector store results with BM25 keyword matches by reciprocal
+    rank, optionally reranked, so keyword heavy questions (hardware models,
+    payment providers, legal terms) are not missed by the dense search"""
+
+    vectorstore: VectorStore
+    index: BM25Index
+    documents: List[Document]
+    # metadata every returned document must match, applied to both searches
+    where: Optional[dict] = None
+    # documents returned
+    k: int = 3
+    # candidates taken from each search before fusing
+    fetch_k: int = 10
+    # reciprocal rank fusion constant, higher values flatten the ranks
+    rrf_k: int = 60
+    reranker: Optional[Reranker] = None
+    allowed: Optional[Set[int]] = None
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    @classmethod
+    def from_documents(
+        cls,
+        vectorstore: VectorStore,
+        documents: List[Document],
+        index: Optional[BM25Index] = None,
+        where: Optional[dict] = None,
+        **kwargs,
+    ) -> "HybridRetriever":
+        """`documents` are the contents of `vectorstore`, `index` can be shared
+        by the retrievers over the same documents"""
+        index = index or BM25Index([doc.page_content for doc in documents])
+        allowed = None
+        if where:
+            allowed = {
+                i
+                for i, doc in enumerate(documents)
+                if matches_filter(doc.metadata, where)
+            }
+        return cls(
+            vectorstore=vectorstore,
+            index=index,
+            documents=documents,
+            where=where,
+            allowed=allowed,
+            **kwargs,
+        )
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        dense = self.vectorstore.similarity_search(
+            query, k=self.fetch_k, filter=self.where
+        )
+        sparse = [
+            self.documents[index]
+            for index, _ in self.index.search(query, self.fetch_k, self.allowed)
+        ]
+
+        # documents are keyed by content, a chunk is stored once
+        scores: Dict[str, float] = {}
+        by_content: Dict[str, Document] = {}
+        for ranking in (dense, sparse):
+            for rank, doc in enumerate(ranking):
+                scores[doc.page_content] = scores.get(doc.page_content, 0.0) + 1 / (
+                    self.rrf_k + rank + 1
+                )
+                by_content.setdefault(doc.page_content, doc)
+        fused = [
+            by_content[content]
+            for content in sorted(scores, key=scores.get, reverse=True)
+        ]
+
+        if self.reranker is not None:
+            return self.reranker.rerank(query, fused, self.k)
+        return fused[: self.k]
@@ -0,0 +1,259 @@
+"""Incremental ingestion of the Help Center knowledge bases
+
+Chunks the text files of every tier into a single Chroma collection. Each
+chunk is named by the hash of its content, so a chunk found in several tiers
+is stored and embedded once and tagged with all of them. Only the chunks the
+collection does not have yet are embedded and the ones that are gone are
+deleted. The new chunks are embedded a batch per thread, the embedding model
+is the cost of an ingestion, and written to the collection in order as the
+batches complete. A manifest of the file hashes makes a rerun with unchanged
+files a no-op.
+
+    python -m tools.ingest --persist-root chroma_db free=assets/free paid=assets/paid
+"""
+import argparse
+import dataclasses
+import glob
+import hashlib
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Sequence
+
+from langchain.schema.embeddings import Embeddings
+
+from cache.embedding_cache import CachedEmbeddings, model_id
+
+MANIFEST_FILE = "manifest.json"
+EMBEDDING_CACHE_FILE = "embedding_cache"
+COLLECTION_DIRECTORY = "help_center"
+CHUNK_SIZE = 2000
+CHUNK_OVERLAP = 500
+
+# tier name -> knowledge base directory
+TIERS = {"free": "assets/free", "paid": "assets/paid"}
+# value of the `tier` metadata of the chunks shared by every tier
+ALL_TIERS = "both"
+
+
+@dataclasses.dataclass
+class Chunk:
+    id: str
+    text: str
+    sources: List[str]
+    tiers: List[str]
+
+    def metadata(self, tier_names: Sequence[str]) -> dict:
+        """Chroma metadata values are scalars, the tiers are stored as one
+        flag per tier for filtering and as a `tier` label"""
+        metadata = {tier: tier in self.tiers for tier in tier_names}
+        metadata["tier"] = self.tiers[0] if len(self.tiers) == 1 else ALL_TIERS
+        metadata["source"] = ",".join(self.sources)
+        return metadata
+
+
+@dataclasses.dataclass
+class IngestReport:
+    added: int = 0
+    deleted: int = 0
+    # chunks whose tiers or sources changed
+    updated: int = 0
+    unchanged: int = 0
+    # nothing changed since the last run, the store was not opened
+    skipped: bool = False
+
+
+def file_hash(path: str) -> str:
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def chunk_id(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def embeddings_id(embeddings: Embeddings) -> str:
+    """Identifies the embedding model, changing it re-embeds everything"""
+    return model_id(embeddings)
+
+
+def source_files(directory: str) -> List[str]:
+    return sorted(glob.glob(os.path.join(directory, "*.txt")))
+
+
+def split_file(
+    path: str, chunk_size: int = CHUNK_SIZE, chunk_overlap: int = CHUNK_OVERLAP
+) -> List[str]:
+    from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+    splitter = RecursiveCharacterTextSplitter(
+        chunk_size=chunk_size, chunk_overlap=chunk_overlap
+    )
+    with open(path, encoding="utf-8") as f:
+        return splitter.split_text(f.read())
+
+
+def collect_chunks(tiers: Dict[str, str]) -> Dict[str, Chunk]:
+    """Chunks of every tier by id, the files are split in parallel"""
+    files = [
+        (tier, path)
+        for tier, directory in tiers.items()
+        for path in source_files(directory)
+    ]
+    with ThreadPoolExecutor(max_workers=max(len(tiers), 1)) as executor:
+        splits = list(executor.map(lambda item: split_file(item[1]), files))
+
+    chunks: Dict[str, Chunk] = {}
+    for (tier, path), texts in zip(files, splits):
+        for text in texts:
+            id_ = chunk_id(text)
+            chunk = chunks.setdefault(
+                id_, Chunk(id=id_, text=text, sources=[], tiers=[])
+            )
+            if path not in chunk.sources:
+                chunk.sources.append(path)
+            if tier not in chunk.tiers:
+                chunk.tiers.append(tier)
+    return chunks
+
+
+def _read_manifest(path: str) -> Optional[dict]:
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_manifest(path: str, manifest: dict):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def persist_directory(persist_root: str) -> str:
+    return os.path.join(persist_root, COLLECTION_DIRECTORY)
+
+
+def ingest(
+    embeddings: Embeddings,
+    persist_root: str = "chroma_db",
+    tiers: Optional[Dict[str, str]] = None,
+    batch_size: int = 64,
+    force: bool = False,
+    workers: int = 4,
+) -> IngestReport:
+    """Brings the Help Center collection in line with the tier text files
+
+    embeddings (Embeddings): the model the collection is embedded with
+    persist_root (str): where the collection is persisted
+    tiers (dict): tier name -> knowledge base directory, defaults to `TIERS`
+    batch_size (int): chunks embedded per embedding call
+    force (bool): compare the collection with the files even if the manifest matches
+    workers (int): batches embedded at once
+    """
+    from langchain.vectorstores import Chroma
+
+    tiers = tiers or TIERS
+    report = IngestReport()
+    store_directory = persist_directory(persist_root)
+    os.makedirs(store_directory, exist_ok=True)
+    manifest_path = os.path.join(store_directory, MANIFEST_FILE)
+
+    manifest = {
+        "embeddings": embeddings_id(embeddings),
+        "chunk_size": CHUNK_SIZE,
+        "chunk_overlap": CHUNK_OVERLAP,
+        "tiers": {
+            tier: {path: file_hash(path) for path in source_files(directory)}
+            for tier, directory in tiers.items()
+        },
+    }
+    if not force and _read_manifest(manifest_path) == manifest:
+        report.skipped = True
+        return report
+
+    chunks = collect_chunks(tiers)
+    tier_names = list(tiers)
+    vectordb = Chroma(persist_directory=store_directory, embedding_function=embeddings)
+    stored = vectordb.get(include=["metadatas"])
+    stored_metadata = dict(zip(stored["ids"], stored["metadatas"]))
+
+    stale = sorted(stored_metadata.keys() - chunks.keys())
+    if stale:
+        vectordb.delete(ids=stale)
+    report.deleted = len(stale)
+
+    # chunks already embedded whose tiers or sources changed keep their vector
+    changed = [
+        chunk
+        for id_, chunk in chunks.items()
+        if id_ in stored_metadata
+        and stored_metadata[id_] != chunk.metadata(tier_names)
+    ]
+    if changed:
+        vectordb._collection.update(
+            ids=[chunk.id for chunk in changed],
+            metadatas=[chunk.metadata(tier_names) for chunk in changed],
+        )
+    report.updated = len(changed)
+
+    new = [chunk for id_, chunk in chunks.items() if id_ not in stored_metadata]
+    batches = [new[start : start + batch_size] for start in range(0, len(new), batch_size)]
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        vectors = executor.map(
+            lambda batch: embeddings.embed_documents([chunk.text for chunk in batch]),
+            batches,
+        )
+        # the collection has a single writer, the batches are written while
+        # the next ones are embedded
+        for batch, batch_vectors in zip(batches, vectors):
+            vectordb._collection.upsert(
+                ids=[chunk.id for chunk in batch],
+                embeddings=batch_vectors,
+                metadatas=[chunk.metadata(tier_names) for chunk in batch],
+                documents=[chunk.text for chunk in batch],
+            )
+    report.added = len(new)
+    report.unchanged = len(chunks) - len(new) - len(changed)
+
+    vectordb.persist()
+    _write_manifest(manifest_path, manifest)
+    return report
+
+
+def main():
+    from langchain.embeddings import SentenceTransformerEmbeddings
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("tiers", nargs="*", metavar="TIER=DIRECTORY",
+                        help="knowledge bases to ingest, defaults to free and paid")
+    parser.add_argument("--persist-root", default="chroma_db")
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--force", action="store_true",
+                        help="compare the collection with the files even if nothing changed")
+    parser.add_argument("--workers", type=int, default=4,
+                        help="batches embedded at once")
+    args = parser.parse_args()
+
+    tiers = dict(tier.split("=", 1) for tier in args.tiers) or TIERS
+    # a rebuilt collection reuses the vectors of the chunks embedded before
+    embeddings = CachedEmbeddings(
+        SentenceTransformerEmbeddings(model_name="all-MiniLM-L6-v2"),
+        path=os.path.join(args.persist_root, EMBEDDING_CACHE_FILE),
+    )
+    report = ingest(
+        embeddings, args.persist_root, tiers, args.batch_size, args.force, args.workers
+    )
+    if report.skipped:
+        print("up to date")
+    else:
+        print(
+            f"{report.added} added, {report.deleted} deleted, {report.updated} updated,"
+            f" {report.unchanged} unchanged"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+from typing import Optional
+
+from langchain.chains.question_answering import load_qa_chain
+from langchain.document_loaders import DirectoryLoader
+from langchain.embeddings import SentenceTransformerEmbeddings
+from langchain.schema import Document
+from langchain.schema.embeddings import Embeddings
+from langchain.schema.vectorstore import VectorStore
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+from langchain.vectorstores import Chroma
+
+from llm.client_pool import default_pool
+from tools.hybrid_retriever import BM25Index, HybridRetriever, Reranker
+from tools.ingest import ingest, persist_directory
+
+
+class HelpCenterAgent:
+    FREE_SUB_DOC_PATH = "assets/free"
+    PREMIUM_SUB_DOC_PATH = "assets/paid"
+    FREE_TIER = "free"
+    PREMIUM_TIER = "paid"
+
+    def __init__(
+        self,
+        embeddings: Optional[Embeddings] = None,
+        persist_root: str = "chroma_db",
+        hybrid: bool = True,
+        reranker: Optional[Reranker] = None,
+        k: int = 3,
+        llm_model=None,
+    ):
+        """
+        embeddings (Embeddings): defaults to the all-MiniLM-L6-v2 sentence transformer
+        persist_root (str): directory the Chroma stores are persisted to
+        hybrid (bool): fuse the vector search with BM25 keyword matches
+        reranker (Reranker): reorders the hybrid results, e.g. CrossEncoderReranker
+        k (int): chunks handed to the QA chain per question
+        llm_model (LangChain chat model): answers from the chunks, defaults to
+            gpt-3.5-turbo through the process wide LLMClientPool
+        """
+        self._embeddings = (
+            embeddings
+            if embeddings is not None
+            else SentenceTransformerEmbeddings(model_name="all-MiniLM-L6-v2")
+        )
+        self._persist_root = persist_root
+
+        self._hybrid = hybrid
+        self._reranker = reranker
+        self._k = k
+
+        self._db = self._create_index()
+        if hybrid:
+            contents = self._db.get(include=["documents", "metadatas"])
+            self._documents = [
+                Document(page_content=text, metadata=metadata)
+                for text, metadata in zip(contents["documents"], contents["metadatas"])
+            ]
+            # one keyword index for both tiers, filtered like the collection
+            self._bm25 = BM25Index([doc.page_content for doc in self._documents])
+
+        self._qa_chain = self._create_qa_chain(llm_model)
+
+    def _create_index(self):
+        """Opens the Help Center collection, both tiers share it and only the
+        chunks that changed since the last ingestion are embedded"""
+        ingest(
+            self._embeddings,
+            self._persist_root,
+            tiers={
+                self.FREE_TIER: self.FREE_SUB_DOC_PATH,
+                self.PREMIUM_TIER: self.PREMIUM_SUB_DOC_PATH,
+            },
+        )
+
+        return Chroma(
+            persist_directory=persist_directory(self._persist_root),
+            embedding_function=self._embeddings,
+        )
+
+    def _tier_retriever(self, tier: str):
+        if not self._hybrid:
+            return self._db.as_retriever(
+                search_kwargs={"k": self._k, "filter": {tier: True}}
+            )
+        return HybridRetriever.from_documents(
+            self._db,
+            self._documents,
+            index=self._bm25,
+            where={tier: True},
+            k=self._k,
+            reranker=self._reranker,
+        )
+
+    def free_sub_retriever(self):
+        return self._tier_retriever(self.FREE_TIER)
+
+    def paid_sub_retriever(self):
+        return self._tier_retriever(self.PREMIUM_TIER)
+
+    def _run_query(self, vectordb: VectorStore, query: str):
+        matching_docs_score = vectordb.similarity_search_with_score(query)
+
+        matching_docs = [doc for doc, score in matching_docs_score]
+        answer = self._qa_chain.run(input_documents=matching_docs, question=query)
+
+        # Prepare the sources
+        sources = [
+            {"content": doc.page_content, "metadata": doc.metadata, "score": score}
+            for doc, score in matching_docs_score
+        ]
+
+        return {"answer": answer, "sources": sources}
+
+    @classmethod
+    def _create_qa_chain(cls, llm_model=None):
+        model_name = "gpt-3.5-turbo"
+        llm = llm_model or default_pool().chat_model(model_name)
+
+        chain = load_qa_chain(llm, chain_type="stuff", verbose=True)
+
+        return chain
+
+    @classmethod
+    def load_docs(cls, directory: str):
+        """
+        Load documents from the given directory.
+        """
+        loader = DirectoryLoader(directory)
+        documents = loader.load()
+
+        return documents
+
+    @classmethod
+    def split_docs(cls, documents, chunk_size=2000, chunk_overlap=500):
+        """
+        Split the documents into chunks.
+        """
+        text_splitter = RecursiveCharacterTextSplitter(
+            chunk_size=chunk_size, chunk_overlap=chunk_overlap
+        )
+        docs = text_splitter.split_documents(documents)
+
+        return docs
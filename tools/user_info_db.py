@@ -0,0 +1,296 @@
+import dataclasses
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from langchain.tools import tool
+
+from data.validation import UserProfile
+from graph.shared import shared
+
+# demo records, the UserDirectory is seeded with them
+user_sub = [
+    {"user_id": "1", "subscription": "premium"},
+    {"user_id": "2", "subscription": "free"},
+    {"user_id": "3", "subscription": "premium"},
+]
+user_info = [
+    {
+        "name": "Rafael Possas",
+        "email": "rafaelpossas@gmail.com",
+        "user_id": "1",
+        "phone": "0452 333 666",
+        "language": "English",
+    },
+    {
+        "name": "John Doe",
+        "email": "john@doe.com",
+        "user_id": "2",
+        "phone": "0452 333 667",
+        "language": "Spanish",
+    },
+    {
+        "name": "Carl Sagan",
+        "email": "carl@sagan.com",
+        "user_id": "3",
+        "phone": "0452 333 668",
+        "language": "Italian",
+    },
+]
+
+
+@dataclasses.dataclass
+class DirectoryStats:
+    # profiles served from memory
+    hits: int = 0
+    # profiles read from the database
+    misses: int = 0
+    # lookups no user matches
+    not_found: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses + self.not_found
+        return self.hits / lookups if lookups else 0.0
+
+
+def _digits(text: str) -> str:
+    return re.sub(r"\D", "", text)
+
+
+class UserDirectory:
+
+    """Users and their subscriptions in a SQLite database. Emails, phone
+    numbers and user ids are resolved to a user by in-memory hash indexes,
+    and the profiles read, subscription included, are kept in memory for
+    `ttl_seconds`, so a lookup is one dict access once the user was seen.
+    """
+
+    def __init__(
+        self,
+        path: str = ":memory:",
+        ttl_seconds: Optional[float] = 5 * 60,
+        max_profiles: int = 10000,
+        seed: bool = True,
+    ):
+        """
+        path (str): the database file, in memory by default
+        ttl_seconds (float): how long a profile is served from memory, None to
+            keep it until the user is updated
+        max_profiles (int): profiles kept in memory, least recently used first out
+        seed (bool): add the demo users when the database has none
+        """
+        self._ttl_seconds = ttl_seconds
+        self._max_profiles = max_profiles
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS users ("
+            " user_id TEXT PRIMARY KEY,"
+            " name TEXT NOT NULL,"
+            " email TEXT NOT NULL,"
+            " phone TEXT NOT NULL,"
+            " language TEXT NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS subscriptions ("
+            " user_id TEXT PRIMARY KEY,"
+            " subscription TEXT NOT NULL)"
+        )
+        self._conn.commit()
+
+        # normalized email or phone digits to user id, and the known user ids
+        self._by_email: Dict[str, str] = {}
+        self._by_phone: Dict[str, str] = {}
+        self._user_ids: Dict[str, Tuple[str, str]] = {}
+        self._profiles: "OrderedDict[str, Tuple[float, UserProfile]]" = OrderedDict()
+        self._stats = DirectoryStats()
+
+        if seed and not self._conn.execute("SELECT 1 FROM users LIMIT 1").fetchone():
+            subscriptions = {s["user_id"]: s["subscription"] for s in user_sub}
+            for user in user_info:
+                self.add_user(user, subscriptions.get(user["user_id"]))
+        else:
+            self._load_indexes()
+
+    def _load_indexes(self):
+        rows = self._conn.execute("SELECT user_id, email, phone FROM users").fetchall()
+        with self._lock:
+            for user_id, email, phone in rows:
+                self._index(user_id, email, phone)
+
+    def _index(self, user_id: str, email: str, phone: str):
+        previous = self._user_ids.get(user_id)
+        if previous is not None:
+            self._by_email.pop(previous[0], None)
+            self._by_phone.pop(previous[1], None)
+        keys = (email.lower(), _digits(phone))
+        self._user_ids[user_id] = keys
+        self._by_email[keys[0]] = user_id
+        self._by_phone[keys[1]] = user_id
+
+    def stats(self) -> DirectoryStats:
+        with self._lock:
+            return dataclasses.replace(self._stats)
+
+    def add_user(self, user: dict, subscription: Optional[str] = None):
+        """Adds or updates a user, `user` has the fields of `user_info`"""
+        user_id = str(user["user_id"])
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO users (user_id, name, email, phone, language)"
+                " VALUES (?, ?, ?, ?, ?)",
+                (user_id, user["name"], user["email"], user["phone"], user["language"]),
+            )
+            if subscription is not None:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO subscriptions (user_id, subscription)"
+                    " VALUES (?, ?)",
+                    (user_id, subscription),
+                )
+            self._conn.commit()
+            self._index(user_id, user["email"], user["phone"])
+            self._profiles.pop(user_id, None)
+
+    def resolve(self, query: str) -> Optional[str]:
+        """User id of an email, a phone number or a user id"""
+        query = query.strip()
+        if "@" in query:
+            return self._by_email.get(query.lower())
+        if query in self._user_ids:
+            return query
+        return self._by_phone.get(_digits(query))
+
+    def lookup(
+        self,
+        email: Optional[str] = None,
+        phone: Optional[str] = None,
+        user_id: Optional[str] = None,
+    ) -> Optional[UserProfile]:
+        """The profile with subscription of the user with this email, phone
+        number or user id, tried in that order"""
+        resolved = None
+        if email is not None:
+            resolved = self._by_email.get(email.strip().lower())
+        if resolved is None and phone is not None:
+            resolved = self._by_phone.get(_digits(phone))
+        if resolved is None and user_id is not None and str(user_id) in self._user_ids:
+            resolved = str(user_id)
+        return self._profiles_of([resolved])[0]
+
+    def lookup_many(self, queries: Iterable[str]) -> List[Optional[UserProfile]]:
+        """Profiles of emails, phone numbers or user ids, in order, the users
+        not in memory are read with a single query"""
+        return self._profiles_of([self.resolve(query) for query in queries])
+
+    def _profiles_of(self, user_ids: List[Optional[str]]) -> List[Optional[UserProfile]]:
+        now = time.monotonic()
+        found: Dict[str, UserProfile] = {}
+        with self._lock:
+            for user_id in user_ids:
+                if user_id is None or user_id in found:
+                    continue
+                cached = self._profiles.get(user_id)
+                if cached is None:
+                    continue
+                if self._ttl_seconds is not None and now - cached[0] > self._ttl_seconds:
+                    del self._profiles[user_id]
+                    continue
+                self._profiles.move_to_end(user_id)
+                found[user_id] = cached[1]
+
+            missing = {u for u in user_ids if u is not None and u not in found}
+            read = self._read(missing) if missing else {}
+            for user_id, profile in read.items():
+                self._profiles[user_id] = (now, profile)
+                self._profiles.move_to_end(user_id)
+            while len(self._profiles) > self._max_profiles:
+                self._profiles.popitem(last=False)
+            found.update(read)
+
+            profiles = [found.get(user_id) if user_id else None for user_id in user_ids]
+            self._stats.hits += sum(1 for u in user_ids if u is not None and u not in missing)
+            self._stats.misses += sum(1 for u in user_ids if u in read)
+            self._stats.not_found += sum(1 for profile in profiles if profile is None)
+        return profiles
+
+    def _read(self, user_ids: Iterable[str]) -> Dict[str, UserProfile]:
+        user_ids = list(user_ids)
+        rows = []
+        # below the bound parameters limit of older SQLite builds
+        for start in range(0, len(user_ids), 500):
+            chunk = user_ids[start:start + 500]
+            rows += self._conn.execute(
+                "SELECT u.user_id, u.name, u.email, u.phone, u.language, s.subscription"
+                " FROM users u JOIN subscriptions s ON s.user_id = u.user_id"
+                f" WHERE u.user_id IN ({', '.join('?' * len(chunk))})",
+                chunk,
+            ).fetchall()
+        return {
+            row[0]: UserProfile(
+                user_id=row[0],
+                name=row[1],
+                email=row[2],
+                phone=row[3],
+                language=row[4],
+                subscription=row[5],
+            )
+            for row in rows
+        }
+
+    def user_rows(self, email: str) -> List[dict]:
+        """The `user_info` records of an email"""
+        user_id = self._by_email.get(email.strip().lower())
+        if user_id is None:
+            return []
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT name, email, user_id, phone, language FROM users WHERE user_id = ?",
+                (user_id,),
+            ).fetchall()
+        fields = ["name", "email", "user_id", "phone", "language"]
+        return [dict(zip(fields, row)) for row in rows]
+
+    def subscription_rows(self, user_id: str) -> List[dict]:
+        """The `user_sub` records of a user id"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT user_id, subscription FROM subscriptions WHERE user_id = ?",
+                (user_id.strip(),),
+            ).fetchall()
+        return [{"user_id": row[0], "subscription": row[1]} for row in rows]
+
+
+def user_directory() -> UserDirectory:
+    """The directory shared by the tools and the rule based lookups"""
+    return shared(UserDirectory, UserDirectory)
+
+
+@tool("user_profile_db", return_direct=True)
+def search_user_profile_on_db(query: str):
+    """Searches a user by email, phone number or user id, subscription included"""
+    profile = user_directory().lookup_many([query])[0]
+    return [] if profile is None else [profile.model_dump()]
+
+
+@tool("user_info_db", return_direct=True)
+def search_user_info_on_db(email: str):
+    """Searches users by email"""
+    return user_directory().user_rows(email)
+
+
+@tool("user_subscription_db", return_direct=True)
+def search_user_subscription_on_db(id: str):
+    """Searches users subscription by user id"""
+    return user_directory().subscription_rows(id)
+
+
+def find_user_profile(
+    email: Optional[str] = None, phone: Optional[str] = None
+) -> Optional[UserProfile]:
+    """The profile with subscription of the user with this email or phone
+    number, what the user info agent builds with the profile tool"""
+    return user_directory().lookup(email=email, phone=phone)